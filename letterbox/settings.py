@@ -29,6 +29,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'rest_framework',
     'letters',
 ]
 
@@ -38,9 +39,16 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     # WhiteNoise must be listed directly after SecurityMiddleware for static files
-    'whitenoise.middleware.WhiteNoiseMiddleware', 
+    # (an async-capable subclass, so ASGI requests stay on the event loop)
+    'letters.middleware.StaticFilesMiddleware',
+    # Per-view timings, query counts and sizes for /metrics (letters.metrics)
+    'letters.middleware.MetricsMiddleware',
+    # GET and HEAD read from a replica when DATABASE_REPLICA_URLS is set (letters.replicas)
+    'letters.middleware.ReplicaRoutingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
+    # Adds ETags and answers If-None-Match with 304 so API clients can revalidate cheaply
+    'django.middleware.http.ConditionalGetMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
@@ -48,6 +56,16 @@ MIDDLEWARE = [
 ]
 
 
+# Requests running more queries than this are logged and counted.
+LETTERS_QUERY_BUDGET = int(os.environ.get('QUERY_BUDGET', 25))
+
+# Adds a Server-Timing header (db, template and total time) to every response.
+LETTERS_SERVER_TIMING = os.environ.get('SERVER_TIMING', '').lower() in ('1', 'true', 'yes')
+
+# Lets a Prometheus scraper read /metrics with "Authorization: Bearer <token>".
+LETTERS_METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+
 # --- URLS / WSGI ---
 
 ROOT_URLCONF = 'letterbox.urls'
@@ -59,7 +77,8 @@ WSGI_APPLICATION = 'letterbox.wsgi.application'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # DjangoTemplates, timing each render for letters.metrics
+        'BACKEND': 'letters.metrics.TimedDjangoTemplates',
         'DIRS': [BASE_DIR / 'templates'],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -82,11 +101,146 @@ DATABASES = {
     'default': dj_database_url.config(
         # CRITICAL: This line tells dj-database-url where to find the connection string.
         default=os.environ.get('DATABASE_URL'), 
-        conn_max_age=600,
+        # Under ASGI each request runs its queries on a thread of its own, so
+        # persistent connections would pile up one per request; keep them
+        # off and pool outside Django instead (see Django's database docs).
+        conn_max_age=int(os.environ.get('CONN_MAX_AGE', 0)),
         conn_health_checks=True,
     )
 }
 
+# Read replicas, as comma-separated URLs: GET requests read from one of
+# them unless the user wrote in the last REPLICA_STICKY_SECONDS (see
+# letters.replicas). Under test they mirror the test database.
+LETTERS_READ_REPLICAS = []
+for _number, _url in enumerate(filter(None, os.environ.get('DATABASE_REPLICA_URLS', '').split(',')), 1):
+    DATABASES[f'replica{_number}'] = {
+        **dj_database_url.parse(
+            _url.strip(),
+            conn_max_age=int(os.environ.get('CONN_MAX_AGE', 0)),
+            conn_health_checks=True,
+        ),
+        'TEST': {'MIRROR': 'default'},
+    }
+    LETTERS_READ_REPLICAS.append(f'replica{_number}')
+
+LETTERS_REPLICA_STICKY_SECONDS = int(os.environ.get('REPLICA_STICKY_SECONDS', 10))
+
+DATABASE_ROUTERS = ['letters.replicas.ReplicaRouter']
+
+# Behind PgBouncer in transaction pooling mode a cursor cannot outlive
+# its transaction, so QuerySet.iterator() (exports, the importer) must
+# fetch client-side. Pair this with CONN_MAX_AGE: the pooler makes
+# persistent connections to it cheap.
+if os.environ.get('PGBOUNCER', '').lower() in ('1', 'true', 'yes'):
+    for _database in DATABASES.values():
+        _database['DISABLE_SERVER_SIDE_CURSORS'] = True
+
+
+# --- CACHES ---
+
+# The "pages" alias holds what the dashboard and conversation pages are
+# built from (letters.caching); "auth" holds sessions, users between
+# requests (letters.auth) and login throttle buckets (letters.throttle).
+# Local memory is the default: it evicts the least recently used entries
+# past MAX_ENTRIES but is private to each process, so with more than one
+# worker set PAGE_CACHE_BACKEND and AUTH_CACHE_BACKEND to "file" or "db"
+# (the latter needs `python manage.py createcachetable`). This matters for
+# correctness, not only hit rates, wherever a cached entry decides access:
+# a logout or deactivation must reach every worker, and so must an accepted
+# or removed connection. Sessions and users are only cached when "auth" is
+# shared, and the connection graph only when "pages" is (see
+# AUTH_CACHE_SHARED and PAGE_CACHE_SHARED below).
+def cache_backend(kind, name):
+    return {
+        'locmem': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': f'letters-{name}',
+        },
+        'file': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.environ.get(f'{name.upper()}_CACHE_LOCATION', os.path.join(BASE_DIR, f'.{name}_cache')),
+        },
+        'db': {
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': f'letters_{name}_cache',
+        },
+        # Caches nothing; for measuring the uncached pages.
+        'dummy': {
+            'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+        },
+    }[kind]
+
+
+PAGE_CACHE_SHARED = os.environ.get('PAGE_CACHE_BACKEND', 'locmem') in ('db', 'file')
+
+# Who is connected to whom decides who may read and write to whom
+# (letters.graph), so it is only cached where every worker sees the same
+# entries; otherwise each check reads Connection.
+LETTERS_GRAPH_CACHE = PAGE_CACHE_SHARED
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'pages': {
+        **cache_backend(os.environ.get('PAGE_CACHE_BACKEND', 'locmem'), 'page'),
+        'TIMEOUT': 60 * 60,
+        'OPTIONS': {'MAX_ENTRIES': int(os.environ.get('PAGE_CACHE_MAX_ENTRIES', 10000))},
+    },
+    'auth': {
+        **cache_backend(os.environ.get('AUTH_CACHE_BACKEND', 'locmem'), 'auth'),
+        'OPTIONS': {'MAX_ENTRIES': int(os.environ.get('AUTH_CACHE_MAX_ENTRIES', 10000))},
+    },
+}
+
+
+# --- SESSIONS & LOGIN ---
+
+# Caching sessions and users is only safe when every worker shares the
+# "auth" cache: a logout, password change or deactivation clears the
+# entries of the worker that handled it, and a private cache elsewhere
+# would keep honouring them.
+AUTH_CACHE_SHARED = os.environ.get('AUTH_CACHE_BACKEND', 'locmem') in ('db', 'file')
+
+# With a shared "auth" cache, sessions are read from it and written
+# through to the database, so a cache miss or restart never logs anyone
+# out; otherwise they are plain database sessions.
+SESSION_ENGINE = 'django.contrib.sessions.backends.' + os.environ.get(
+    'SESSION_BACKEND', 'cached_db' if AUTH_CACHE_SHARED else 'db'
+)
+SESSION_CACHE_ALIAS = 'auth'
+
+# ModelBackend, keeping users in the shared "auth" cache between requests.
+AUTHENTICATION_BACKENDS = [
+    'letters.auth.CachedModelBackend' if AUTH_CACHE_SHARED else 'django.contrib.auth.backends.ModelBackend'
+]
+
+# (burst, attempts per minute) for login per IP and per username and for
+# signup per IP, checked before any password is hashed (letters.throttle).
+LETTERS_THROTTLE_RATES = {
+    'login-ip': (20, 10),
+    'login-user': (5, 2),
+    'signup-ip': (5, 1),
+}
+# Without a shared "auth" cache each worker keeps its own buckets, so split
+# the limits between the WEB_CONCURRENCY workers (gunicorn's default count)
+# to keep their sum what is configured above.
+if not AUTH_CACHE_SHARED:
+    _workers = max(int(os.environ.get('WEB_CONCURRENCY', 1)), 1)
+    LETTERS_THROTTLE_RATES = {
+        scope: (max(burst // _workers, 1), per_minute / _workers)
+        for scope, (burst, per_minute) in LETTERS_THROTTLE_RATES.items()
+    }
+
+# Proxies in front of the app that append to X-Forwarded-For (1 on Render);
+# 0 uses REMOTE_ADDR as the client address.
+LETTERS_PROXY_COUNT = int(os.environ.get('PROXY_COUNT', 0))
+
+# manage.py archive_letters moves letters and superseded versions untouched
+# for this many days to the compressed archive table.
+LETTERS_ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', 365))
+
 
 # --- STATIC FILES (WhiteNoise) ---
 
@@ -97,8 +251,30 @@ STATIC_URL = '/static/'
 # for WhiteNoise to serve.
 STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 
-# Configuration for WhiteNoise to handle static files efficiently
-STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
+# Hashed, precompressed copies served with a year-long immutable
+# Cache-Control (letters.storage). STORAGES replaces STATICFILES_STORAGE,
+# which Django 5.1 stopped reading.
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'letters.storage.StaticFilesStorage',
+    },
+}
+
+
+# --- REST API ---
+
+REST_FRAMEWORK = {
+    'DEFAULT_AUTHENTICATION_CLASSES': [
+        'rest_framework.authentication.SessionAuthentication',
+        'rest_framework.authentication.BasicAuthentication',
+    ],
+    'DEFAULT_PERMISSION_CLASSES': [
+        'rest_framework.permissions.IsAuthenticated',
+    ],
+}
 
 
 # --- AUTHENTICATION ---
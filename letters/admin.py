@@ -1,6 +1,11 @@
 from django.contrib import admin
-from .models import Connection, Letter, LetterVersion
+from .models import ArchivedLetter, ChangeLogEntry, Connection, ContactSummary, Letter, LetterVersion, Task, UserStats
 
+admin.site.register(ArchivedLetter)
+admin.site.register(ChangeLogEntry)
 admin.site.register(Connection)
+admin.site.register(ContactSummary)
 admin.site.register(Letter)
 admin.site.register(LetterVersion)
+admin.site.register(Task)
+admin.site.register(UserStats)
@@ -2,4 +2,7 @@ from django.apps import AppConfig
 
 class LettersConfig(AppConfig): # cite: uploaded:apps.py
     default_auto_field = 'django.db.models.BigAutoField' # cite: uploaded:apps.py
-    name = 'letters' # cite: uploaded:apps.py
\ No newline at end of file
+    name = 'letters' # cite: uploaded:apps.py
+
+    def ready(self):
+        from . import metrics, signals, tasks  # noqa: F401
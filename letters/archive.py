@@ -0,0 +1,196 @@
+"""
+Cold storage for old letters, run by ``manage.py archive_letters``.
+
+Two passes, each in batches of one transaction:
+
+- Letters whose every version is older than the cutoff, with no proposal
+  open, move whole to ``ArchivedLetter`` and leave ``Letter`` and
+  ``LetterVersion``.
+- Letters that stay live move their superseded versions (approved but no
+  longer current) older than the cutoff.
+
+Versions are archived as full text, compressed together per letter, so
+the archive needs no delta chains; a version left behind that was stored
+as a delta is rewritten as a snapshot first. Archived letters are read-only
+and drop out of letter search, but the conversation, history and export
+read them back along with the live rows (see ``merged_keyset_page``), as
+do the API's letter list, detail, versions and change feed.
+"""
+from collections import Counter
+from itertools import groupby
+
+from django.core.cache import caches
+from django.db import connection, transaction
+from django.db.models import Exists, F, OuterRef, Q
+
+from .models import ArchivedLetter, ArchivedVersion, Letter, LetterVersion, pack_versions
+from .search import get_letter_search_backend
+
+TABLE_ROWS_KEY = "archive:table-rows"
+TABLE_ROWS_TIMEOUT = 5 * 60
+
+
+def archivable_letters(cutoff):
+    recent_or_pending = LetterVersion.objects.filter(letter=OuterRef("pk")).filter(
+        Q(approved=False) | Q(created_at__gte=cutoff)
+    )
+    return Letter.objects.filter(created_at__lt=cutoff).filter(~Exists(recent_or_pending))
+
+
+def superseded_versions(cutoff):
+    return LetterVersion.objects.filter(approved=True, created_at__lt=cutoff).exclude(
+        id=F("letter__current_version")
+    )
+
+
+def archive_letters(cutoff, batch_size=500):
+    """Archive whole letters untouched since ``cutoff``; returns counts of what moved."""
+    totals = Counter()
+    last_id = 0
+    while True:
+        ids = list(
+            archivable_letters(cutoff).filter(id__gt=last_id).order_by("id").values_list("id", flat=True)[:batch_size]
+        )
+        if not ids:
+            break
+        last_id = ids[-1]
+        with transaction.atomic():
+            totals.update(_archive_letters(ids, cutoff))
+    return totals
+
+
+def archive_versions(cutoff, batch_size=500):
+    """Archive superseded versions older than ``cutoff`` of letters that stay live."""
+    totals = Counter()
+    last_id = 0
+    while True:
+        ids = list(
+            superseded_versions(cutoff).filter(letter_id__gt=last_id).order_by("letter_id")
+            .values_list("letter_id", flat=True).distinct()[:batch_size]
+        )
+        if not ids:
+            break
+        last_id = ids[-1]
+        with transaction.atomic():
+            totals.update(_archive_versions(ids, cutoff))
+    return totals
+
+
+def _histories(letters):
+    """Every version of ``letters`` with its text, oldest first, by letter id."""
+    versions = list(LetterVersion.objects.filter(letter_id__in=letters).order_by("letter_id", "created_at", "id"))
+    LetterVersion.objects.fill_content(versions)
+    for version in versions:
+        version.letter = letters[version.letter_id]
+    return {letter_id: list(group) for letter_id, group in groupby(versions, lambda v: v.letter_id)}
+
+
+def _row(letter, earlier, moved, whole, totals):
+    history = earlier + [
+        ArchivedVersion(v.id, v.created_at, v.approved, v.id == letter.current_version_id, v.content)
+        for v in moved
+    ]
+    history.sort(key=lambda v: (v.created_at, v.id))
+    data = pack_versions(history)
+    text_bytes = sum(len(v.content.encode()) for v in history)
+    totals["versions"] += len(moved)
+    totals["text_bytes"] += text_bytes
+    totals["packed_bytes"] += len(data)
+    return ArchivedLetter(
+        id=letter.id, sender_id=letter.sender_id, receiver_id=letter.receiver_id,
+        created_at=letter.created_at, preview=letter.preview, whole=whole,
+        versions=data, version_count=len(history), text_bytes=text_bytes,
+    )
+
+
+def _save(rows):
+    # A letter archived whole may already have a row for versions moved earlier.
+    ArchivedLetter.objects.bulk_create(
+        rows, update_conflicts=True, unique_fields=["id"],
+        update_fields=["preview", "whole", "versions", "version_count", "text_bytes", "archived_at"],
+    )
+
+
+def _archive_letters(ids, cutoff):
+    letters = Letter.objects.select_for_update().in_bulk(ids)
+    histories = _histories(letters)
+    earlier = ArchivedLetter.objects.in_bulk(list(letters))
+    totals = Counter()
+    rows, moved = [], []
+    for letter_id, letter in letters.items():
+        versions = histories.get(letter_id, [])
+        # Checked again under the lock: a proposal may have come in since
+        # the batch was picked.
+        if any(not v.approved or v.created_at >= cutoff for v in versions):
+            continue
+        previous = earlier[letter_id].history if letter_id in earlier else []
+        rows.append(_row(letter, previous, versions, True, totals))
+        moved.extend(versions)
+    if not rows:
+        return totals
+
+    _save(rows)
+    get_letter_search_backend().remove_many(moved)
+    # Deleting sends Letter's post_delete, which clears the cached pages.
+    Letter.objects.filter(id__in=[row.id for row in rows]).delete()
+    totals["letters"] += len(rows)
+    return totals
+
+
+def _archive_versions(ids, cutoff):
+    letters = Letter.objects.select_for_update().in_bulk(ids)
+    histories = _histories(letters)
+    earlier = ArchivedLetter.objects.in_bulk(list(letters))
+    totals = Counter()
+    rows, moved, rewritten = [], [], []
+    for letter_id, versions in histories.items():
+        letter = letters[letter_id]
+        gone = [
+            v for v in versions
+            if v.approved and v.id != letter.current_version_id and v.created_at < cutoff
+        ]
+        if not gone:
+            continue
+        gone_ids = {v.id for v in gone}
+        for version in versions:
+            if version.id not in gone_ids and version.delta_base_id:
+                # Reassigning the text makes it a snapshot.
+                version.content = version.content
+                rewritten.append(version)
+        previous = earlier[letter_id].history if letter_id in earlier else []
+        rows.append(_row(letter, previous, gone, False, totals))
+        moved.extend(gone)
+    if not rows:
+        return totals
+
+    LetterVersion.objects.bulk_update(rewritten, ["stored_content", "delta_base", "delta_parent", "delta_depth"])
+    _save(rows)
+    get_letter_search_backend().remove_many(moved)
+    LetterVersion.objects.filter(id__in=[v.id for v in moved]).delete()
+    totals["live_letters"] += len(rows)
+    totals["snapshots"] += len(rewritten)
+    return totals
+
+
+def count_rows():
+    """Rows in the hot and archive tables; estimated from statistics on PostgreSQL."""
+    counts = {}
+    for model in (Letter, LetterVersion, ArchivedLetter):
+        table = model._meta.db_table
+        if connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass", [table])
+                counts[table] = max(cursor.fetchone()[0], 0)
+        else:
+            counts[table] = model.objects.count()
+    return counts
+
+
+def table_rows(refresh=False):
+    """:func:`count_rows`, recounted at most every few minutes for ``/metrics``."""
+    cache = caches["default"]
+    counts = None if refresh else cache.get(TABLE_ROWS_KEY)
+    if counts is None:
+        counts = count_rows()
+        cache.set(TABLE_ROWS_KEY, counts, TABLE_ROWS_TIMEOUT)
+    return counts
@@ -0,0 +1,38 @@
+"""
+An authentication backend that keeps users in the ``auth`` cache, so an
+authenticated request reads its ``User`` from the cache instead of the
+database. ``letters.signals`` drops the entry whenever the user is saved
+or deleted (password change, deactivation, ``last_login``).
+
+Every worker must see those deletions, so settings only install this
+backend when the ``auth`` alias is a shared backend (``AUTH_CACHE_BACKEND``
+set to ``db`` or ``file``); otherwise users come from the database.
+"""
+from asgiref.sync import sync_to_async
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import caches
+
+CACHE_ALIAS = "auth"
+TIMEOUT = 15 * 60
+
+
+def user_key(user_id):
+    return f"user:{user_id}"
+
+
+def forget_user(user_id):
+    caches[CACHE_ALIAS].delete(user_key(user_id))
+
+
+class CachedModelBackend(ModelBackend):
+    def get_user(self, user_id):
+        cache = caches[CACHE_ALIAS]
+        user = cache.get(user_key(user_id))
+        if user is None:
+            user = super().get_user(user_id)
+            if user is not None:
+                cache.set(user_key(user_id), user, TIMEOUT)
+        return user
+
+    async def aget_user(self, user_id):
+        return await sync_to_async(self.get_user)(user_id)
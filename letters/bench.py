@@ -0,0 +1,1003 @@
+"""
+Benchmark suites for ``manage.py benchmark``.
+
+A suite is a function registered with ``@suite("name")`` that takes its
+parameters as keyword arguments and returns a JSON-serialisable report.
+Suites run against a throwaway copy of the database, never the live one.
+"""
+import asyncio
+import http.client
+import os
+import random
+import socket
+import sqlite3
+import string
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import timedelta
+from urllib.parse import quote
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.utils import timezone
+
+SUITES = {}
+
+
+def suite(name):
+    def register(func):
+        SUITES[name] = func
+        return func
+    return register
+
+
+@contextmanager
+def scratch_database():
+    old_name = connection.settings_dict["NAME"]
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(samples):
+    return {
+        "n": len(samples),
+        "p50_ms": round(percentile(samples, 50) * 1000, 3),
+        "p95_ms": round(percentile(samples, 95) * 1000, 3),
+        "max_ms": round(max(samples) * 1000, 3),
+    }
+
+
+def measure(func, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+
+SYLLABLES = ["an", "be", "ca", "do", "el", "fi", "ga", "ho", "ir", "jo", "ka", "li",
+             "mo", "na", "or", "pe", "ra", "si", "ta", "ul", "vi", "wa", "yo", "ze"]
+
+
+def random_username(rng, taken):
+    while True:
+        name = "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+        name += "".join(rng.choice(string.digits) for _ in range(rng.randint(0, 4)))
+        if name not in taken:
+            taken.add(name)
+            return name
+
+
+def seed_users(count, seed=0, batch_size=5000):
+    rng = random.Random(seed)
+    taken = set(User.objects.values_list("username", flat=True))
+    names = []
+    for start in range(0, count, batch_size):
+        batch = [
+            User(username=random_username(rng, taken), password="!")
+            for _ in range(min(batch_size, count - start))
+        ]
+        User.objects.bulk_create(batch, batch_size=batch_size)
+        names.extend(user.username for user in batch)
+    return names
+
+
+# A Zipf-weighted vocabulary, so a few words are everywhere and most are rare,
+# roughly like real prose.
+VOCABULARY = sorted({a + b + c for a in SYLLABLES for b in SYLLABLES for c in SYLLABLES})[:5000]
+WEIGHTS = [1 / (rank + 1) for rank in range(len(VOCABULARY))]
+
+
+def random_text(rng, words=40):
+    return " ".join(rng.choices(VOCABULARY, WEIGHTS, k=words))
+
+
+def seed_letters(users, letters, seed=0, batch_size=2000):
+    """Spread ``letters`` approved single-version letters over random pairs of ``users``."""
+    from .models import Letter, LetterVersion
+
+    rng = random.Random(seed)
+    ids = list(User.objects.filter(username__in=users).values_list("id", flat=True))
+    for start in range(0, letters, batch_size):
+        batch = []
+        for _ in range(min(batch_size, letters - start)):
+            sender, receiver = rng.sample(ids, 2)
+            batch.append(Letter(sender_id=sender, receiver_id=receiver))
+        Letter.objects.bulk_create(batch)
+        LetterVersion.objects.bulk_create(
+            LetterVersion(letter=letter, content=random_text(rng), approved=True)
+            for letter in batch
+        )
+    return ids
+
+
+@suite("user_search")
+def user_search(users=100_000, repeat=50, seed=0):
+    """Latency of the basic LIKE scan against the vendor search backend."""
+    from .search import BasicUserSearch, get_user_search_backend
+
+    start = time.perf_counter()
+    names = seed_users(users, seed=seed)
+    seeded_in = time.perf_counter() - start
+
+    rng = random.Random(seed + 1)
+    samples = rng.sample(names, min(repeat, len(names)))
+
+    def typo(name):
+        i = rng.randrange(len(name))
+        return name[:i] + rng.choice(string.ascii_lowercase) + name[i + 1:]
+
+    queries = {
+        "exact": samples,
+        "prefix3": [name[:3] for name in samples],
+        "substring5": [name[1:6] for name in samples],
+        "typo": [typo(name) for name in samples],
+    }
+
+    report = {"users": users, "seed_seconds": round(seeded_in, 2), "results": {}}
+    for backend in (BasicUserSearch(), get_user_search_backend()):
+        results = report["results"].setdefault(type(backend).__name__, {})
+        for kind, terms in queries.items():
+            terms = iter(terms * 2)
+            results[kind] = measure(
+                lambda: backend.search(next(terms), exclude_ids=(), limit=20), len(samples)
+            )
+    return report
+
+
+@suite("letter_search")
+def letter_search(users=200, letters=100_000, repeat=50, seed=0):
+    """Per-user full-text search latency against a LIKE scan of the same user's letters."""
+    from .search import BasicLetterSearch, get_letter_search_backend
+
+    start = time.perf_counter()
+    ids = seed_letters(seed_users(users, seed=seed), letters, seed=seed)
+    backend = get_letter_search_backend()
+    backend.rebuild()
+    seeded_in = time.perf_counter() - start
+
+    rng = random.Random(seed + 1)
+    searchers = list(User.objects.filter(id__in=ids))
+
+    report = {"users": users, "letters": letters, "seed_seconds": round(seeded_in, 2), "results": {}}
+    for search in (BasicLetterSearch(), backend):
+        results = report["results"].setdefault(type(search).__name__, {})
+        for words in (1, 2):
+            results[f"{words}_word"] = measure(
+                lambda: search.search(
+                    rng.choice(searchers), random_text(rng, words), limit=20
+                ),
+                repeat,
+            )
+    return report
+
+
+@suite("version_storage")
+def version_storage(letters=100, edits=40, words=300, repeat=50, seed=0):
+    """Bytes stored for edit histories and rebuild latency by delta depth."""
+    from . import services
+    from .models import LetterVersion
+
+    rng = random.Random(seed)
+    sender, receiver = (User.objects.get(username=name) for name in seed_users(2, seed=seed))
+
+    start = time.perf_counter()
+    for _ in range(letters):
+        letter = services.send_letter(sender, receiver, random_text(rng, words))
+        text = letter.versions.get().content
+        for _ in range(edits):
+            tokens = text.split(" ")
+            for _ in range(rng.randint(1, 5)):
+                tokens[rng.randrange(len(tokens))] = random_text(rng, 1)
+            text = " ".join(tokens)
+            services.approve_version(services.propose_modification(letter, text))
+    seeded_in = time.perf_counter() - start
+
+    full = stored = 0
+    by_depth = {}
+    for chunk_start in range(0, LetterVersion.objects.count(), 2000):
+        chunk = list(LetterVersion.objects.order_by("id")[chunk_start:chunk_start + 2000])
+        for version in LetterVersion.objects.fill_content(chunk):
+            full += len(version.content.encode())
+            stored += len(version.stored_content.encode())
+            by_depth.setdefault(version.delta_depth, []).append(version.id)
+
+    def rebuild(ids):
+        version = LetterVersion.objects.get(id=rng.choice(ids))
+        LetterVersion.objects.fill_content([version])
+
+    return {
+        "versions": letters * (edits + 1),
+        "seed_seconds": round(seeded_in, 2),
+        "full_bytes": full,
+        "stored_bytes": stored,
+        "saved_pct": round(100 * (1 - stored / full), 1),
+        "rebuild_by_depth": {
+            depth: measure(lambda: rebuild(ids), repeat)
+            for depth, ids in sorted(by_depth.items())
+        },
+    }
+
+
+@suite("push")
+def push(connections=1000, rounds=20, seed=0):
+    """
+    Event streams one ASGI worker holds open, the memory each costs, and
+    how long a committed change takes to reach all of them.
+    """
+    from django.core.asgi import get_asgi_application
+    from django.test import Client
+    from django.test.utils import override_settings
+
+    from .realtime import get_broker
+
+    users = list(User.objects.filter(username__in=seed_users(connections, seed=seed)))
+    cookies = []
+    for user in users:
+        client = Client()
+        client.force_login(user)
+        cookies.append(f"sessionid={client.cookies['sessionid'].value}".encode())
+
+    application = get_asgi_application()
+    broker = get_broker()
+
+    async def run():
+        disconnect = asyncio.Event()
+        opened = asyncio.Queue()
+        received = asyncio.Queue()
+
+        async def stream(cookie):
+            scope = {
+                "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+                "method": "GET", "scheme": "http", "path": "/events/", "raw_path": b"/events/",
+                "query_string": b"", "root_path": "", "client": ("127.0.0.1", 0),
+                "server": ("testserver", 80),
+                "headers": [(b"host", b"testserver"), (b"cookie", cookie)],
+            }
+            requested = False
+
+            async def receive():
+                nonlocal requested
+                if not requested:
+                    requested = True
+                    return {"type": "http.request", "body": b"", "more_body": False}
+                await disconnect.wait()
+                return {"type": "http.disconnect"}
+
+            async def send(message):
+                body = message.get("body", b"")
+                if body.startswith(b"retry:"):
+                    opened.put_nowait(time.perf_counter())
+                elif body.startswith(b"data:"):
+                    received.put_nowait(time.perf_counter())
+
+            await application(scope, receive, send)
+
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        tasks = [asyncio.ensure_future(stream(cookie)) for cookie in cookies]
+        for _ in cookies:
+            await opened.get()
+        open_seconds = time.perf_counter() - start
+        held = broker.connection_count()
+        per_connection = (tracemalloc.get_traced_memory()[0] - before) / len(cookies)
+        tracemalloc.stop()
+
+        # Publish from a worker thread, as a sync view committing a change does.
+        loop = asyncio.get_running_loop()
+        fan_out = []
+        for n in range(rounds):
+            start = time.perf_counter()
+            await loop.run_in_executor(None, lambda: [
+                broker.publish(user.id, {"kind": "letter", "action": "created", "id": n})
+                for user in users
+            ])
+            for _ in users:
+                last = await received.get()
+            fan_out.append(last - start)
+
+        disconnect.set()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return {
+            "connections": held,
+            "open_seconds": round(open_seconds, 2),
+            "bytes_per_connection": round(per_connection),
+            "fan_out_all": summarize(fan_out),
+            "left_open": broker.connection_count(),
+        }
+
+    with override_settings(ALLOWED_HOSTS=["testserver"]):
+        return asyncio.run(run())
+
+
+@suite("bulk")
+def bulk(receivers=500, rounds=3, seed=0):
+    """Letters sent and versions approved per second, one by one against in bulk."""
+    from . import services
+    from .models import Connection, ContactSummary, LetterVersion
+
+    rng = random.Random(seed)
+    names = seed_users(receivers + 1, seed=seed)
+    sender = User.objects.get(username=names[0])
+    others = list(User.objects.filter(username__in=names[1:]))
+    connections = Connection.objects.bulk_create(
+        Connection(requester=sender, receiver=other, accepted=True) for other in others
+    )
+    ContactSummary.objects.bulk_create(
+        ContactSummary(owner_id=owner, contact_id=contact, connection=c, accepted=True)
+        for c in connections
+        for owner, contact in ((c.requester_id, c.receiver_id), (c.receiver_id, c.requester_id))
+    )
+
+    def rate(func, rows):
+        start = time.perf_counter()
+        func()
+        return rows / (time.perf_counter() - start)
+
+    def propose(letters):
+        return [services.propose_modification(letter, random_text(rng)).id for letter in letters]
+
+    results = {"send": {"single": [], "bulk": []}, "approve": {"single": [], "bulk": []}}
+    for _ in range(rounds):
+        text = random_text(rng)
+        letters = []
+        results["send"]["single"].append(rate(
+            lambda: letters.extend(services.send_letter(sender, other, text) for other in others),
+            len(others),
+        ))
+        results["send"]["bulk"].append(rate(
+            lambda: letters.extend(services.send_letters(sender, others, text)), len(others)
+        ))
+
+        pending = LetterVersion.objects.filter(id__in=propose(letters[:len(others)]))
+        results["approve"]["single"].append(rate(
+            lambda: [services.approve_version(version) for version in pending.select_related("letter")],
+            len(others),
+        ))
+        ids = propose(letters[len(others):])
+        results["approve"]["bulk"].append(rate(
+            lambda: services.approve_versions(sender, ids), len(ids)
+        ))
+
+    return {
+        "receivers": receivers,
+        "rows_per_sec": {
+            op: {mode: round(percentile(rates, 50)) for mode, rates in modes.items()}
+            for op, modes in results.items()
+        },
+        "speedup": {
+            op: round(percentile(modes["bulk"], 50) / percentile(modes["single"], 50), 1)
+            for op, modes in results.items()
+        },
+    }
+
+
+@suite("export")
+def export_history(letters=5000, edits=19, words=120, seed=0):
+    """Export throughput and peak memory for one large history, at a tenth and at full size."""
+    from . import delta, export
+    from .models import Letter, LetterVersion
+
+    rng = random.Random(seed)
+    sender, receiver = (User.objects.get(username=name) for name in seed_users(2, seed=seed))
+
+    start = time.perf_counter()
+    for batch_start in range(0, letters, 500):
+        batch = Letter.objects.bulk_create(
+            Letter(sender=sender, receiver=receiver) for _ in range(min(500, letters - batch_start))
+        )
+        texts = [random_text(rng, words) for _ in batch]
+        parents = LetterVersion.objects.bulk_create(
+            LetterVersion(letter=letter, content=text, approved=True) for letter, text in zip(batch, texts)
+        )
+        for _ in range(edits):
+            children = []
+            for i, parent in enumerate(parents):
+                tokens = texts[i].split(" ")
+                tokens[rng.randrange(len(tokens))] = random_text(rng, 1)
+                text = " ".join(tokens)
+                child = LetterVersion(letter=batch[i], approved=True)
+                child.stored_content = delta.make_delta(texts[i], text)
+                child.delta_parent = parent
+                child.delta_base_id = parent.delta_base_id or parent.id
+                child.delta_depth = parent.delta_depth + 1
+                children.append(child)
+                texts[i] = text
+            parents = LetterVersion.objects.bulk_create(children)
+    seeded_in = time.perf_counter() - start
+
+    everything = export.letters_of(sender)
+    sizes = {"tenth": everything.filter(id__lte=everything.order_by("id")[letters // 10 - 1].id), "full": everything}
+    report = {"letters": letters, "versions": letters * (edits + 1), "seed_seconds": round(seeded_in, 2), "results": {}}
+    for fmt in ("ndjson", "zip"):
+        for label, queryset in sizes.items():
+            tracemalloc.start()
+            start = time.perf_counter()
+            size = sum(len(chunk) for chunk in export.export(queryset, fmt))
+            elapsed = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            count = queryset.count() * (edits + 1)
+            report["results"][f"{fmt}_{label}"] = {
+                "versions": count,
+                "bytes": size,
+                "seconds": round(elapsed, 2),
+                "versions_per_sec": round(count / elapsed),
+                "peak_mb": round(peak / 2 ** 20, 2),
+            }
+    return report
+
+
+def seed_graph(users, degree, letters, depth, words=60, seed=0, days=0):
+    """
+    Users with about ``degree`` accepted connections each, and ``letters``
+    letters spread over those connections with ``depth`` versions apiece,
+    imported through ``letters.importer`` so summaries and deltas are real.
+    With ``days`` the letters are dated over that many days back, each
+    version an hour after the one before.
+    """
+    from .importer import Importer
+    from .models import Connection, ContactSummary
+
+    rng = random.Random(seed)
+    now = timezone.now()
+    names = seed_users(users, seed=seed)
+    ids = dict(User.objects.filter(username__in=names).values_list("username", "id"))
+    edges = set()
+    for name in names:
+        for other in rng.sample(names, min(degree // 2 + 1, len(names) - 1)):
+            if other != name:
+                edges.add((min(name, other), max(name, other)))
+    edges = sorted(edges)
+    connections = Connection.objects.bulk_create(
+        Connection(requester_id=ids[a], receiver_id=ids[b], accepted=True) for a, b in edges
+    )
+    ContactSummary.objects.bulk_create(
+        ContactSummary(owner_id=owner, contact_id=contact, connection=c, accepted=True)
+        for c in connections
+        for owner, contact in ((c.requester_id, c.receiver_id), (c.receiver_id, c.requester_id))
+    )
+
+    def record():
+        sender, receiver = rng.choice(edges)
+        if rng.random() < 0.5:
+            sender, receiver = receiver, sender
+        text = random_text(rng, words)
+        created_at = now - timedelta(days=rng.uniform(0, days)) if days else None
+        versions = []
+        for n in range(depth):
+            version = {"content": text, "approved": True}
+            if created_at:
+                version["created_at"] = (created_at + timedelta(hours=n)).isoformat()
+            versions.append(version)
+            tokens = text.split(" ")
+            tokens[rng.randrange(len(tokens))] = random_text(rng, 1)
+            text = " ".join(tokens)
+        record = {"sender": sender, "receiver": receiver, "versions": versions}
+        if created_at:
+            record["created_at"] = created_at.isoformat()
+        return record
+
+    Importer("bench").run(record() for _ in range(letters))
+    return names, edges
+
+
+@suite("views")
+def views(users=500, degree=10, letters=5000, depth=5, repeat=50, memory_repeat=10, warm=0, seed=0):
+    """
+    Latency, query count and peak memory of the main pages, requested
+    through the test client against a seeded connection graph. With
+    ``warm=0`` the page cache is emptied before every request.
+    """
+    from django.test import Client
+    from django.test.utils import CaptureQueriesContext, override_settings
+    from django.urls import reverse
+
+    from .caching import get_cache
+    from .models import Letter, LetterVersion
+
+    start = time.perf_counter()
+    names, edges = seed_graph(users, degree, letters, depth, seed=seed)
+    seeded_in = time.perf_counter() - start
+
+    rng = random.Random(seed + 1)
+    users_by_name = {user.username: user for user in User.objects.filter(username__in=names)}
+    clients = {}
+
+    def client_for(user):
+        if user.id not in clients:
+            clients[user.id] = Client()
+            clients[user.id].force_login(user)
+        return clients[user.id]
+
+    def edge():
+        a, b = rng.choice(edges)
+        return (users_by_name[a], users_by_name[b]) if rng.random() < 0.5 else (users_by_name[b], users_by_name[a])
+
+    def dashboard():
+        return users_by_name[rng.choice(names)], "get", reverse("dashboard"), None
+
+    def search_user():
+        return users_by_name[rng.choice(names)], "get", reverse("search_user"), {"username": rng.choice(names)[:3]}
+
+    def conversation():
+        user, contact = edge()
+        return user, "get", reverse("conversation", args=[contact.id]), None
+
+    def send_letter():
+        user, contact = edge()
+        return user, "post", reverse("send_letter", args=[contact.id]), {"content": random_text(rng)}
+
+    received = list(Letter.objects.values_list("id", "receiver__username"))
+
+    def modify_letter():
+        letter_id, receiver = rng.choice(received)
+        return (
+            users_by_name[receiver], "post", reverse("modify", args=[letter_id]),
+            {"proposed_content": random_text(rng)},
+        )
+
+    pending = []
+
+    def approve_modification():
+        version_id, sender = pending.pop()
+        return users_by_name[sender], "post", reverse("approve_modification", args=[version_id]), None
+
+    def request(target):
+        user, method, path, data = target
+        if not warm:
+            get_cache().clear()
+        return getattr(client_for(user), method)(path, data)
+
+    report = {
+        "users": users, "connections": len(edges), "letters": letters, "versions": letters * depth,
+        "seed_seconds": round(seeded_in, 2), "results": {},
+    }
+    pages = [dashboard, search_user, conversation, send_letter, modify_letter, approve_modification]
+    with override_settings(ALLOWED_HOSTS=["testserver"]):
+        for page in pages:
+            if page is approve_modification:
+                pending.extend(
+                    LetterVersion.objects.filter(approved=False)
+                    .order_by("id").values_list("id", "letter__sender__username")
+                )
+                rng.shuffle(pending)
+            samples, queries, errors = [], [], 0
+            for _ in range(repeat):
+                target = page()
+                client_for(target[0])  # log in outside the timing
+                with CaptureQueriesContext(connection) as captured:
+                    begin = time.perf_counter()
+                    response = request(target)
+                    samples.append(time.perf_counter() - begin)
+                queries.append(len(captured))
+                errors += response.status_code >= 400
+
+            # A separate pass, since tracing allocations slows every request down.
+            peaks = []
+            tracemalloc.start()
+            for _ in range(memory_repeat):
+                if page is approve_modification and not pending:
+                    break
+                target = page()
+                client_for(target[0])
+                tracemalloc.reset_peak()
+                before = tracemalloc.get_traced_memory()[0]
+                request(target)
+                peaks.append(tracemalloc.get_traced_memory()[1] - before)
+            tracemalloc.stop()
+
+            report["results"][page.__name__] = {
+                **summarize(samples),
+                "queries_p50": percentile(queries, 50),
+                "queries_max": max(queries),
+                "peak_kb_p50": round(percentile(peaks, 50) / 1024, 1) if peaks else None,
+                "peak_kb_max": round(max(peaks) / 1024, 1) if peaks else None,
+                "errors": errors,
+            }
+    return report
+
+
+@suite("payload")
+def payload(users=50, degree=5, letters=500, depth=3, seed=0):
+    """
+    Bytes sent for the main pages on a first and on a repeat visit: the
+    HTML, raw and gzipped, and the stylesheets, scripts and fonts it links
+    to. Static files are collected into a scratch STATIC_ROOT and fetched
+    through WhiteNoise, so hashing, compression and Cache-Control are as
+    deployed. A repeat visit refetches whatever is not cached as immutable;
+    third-party assets cannot be fetched here and are only counted.
+    """
+    import gzip
+    import re
+
+    from django.conf import settings
+    from django.core.management import call_command
+    from django.test import Client
+    from django.test.utils import override_settings
+    from django.urls import reverse
+
+    from .models import Letter
+
+    names, edges = seed_graph(users, degree, letters, depth, seed=seed)
+    users_by_name = {user.username: user for user in User.objects.filter(username__in=names)}
+    user, contact = (users_by_name[name] for name in edges[0])
+    letter = Letter.objects.filter(sender=user).order_by("id").first() or Letter.objects.order_by("id").first()
+    pages = {
+        "login": (None, reverse("login")),
+        "dashboard": (user, reverse("dashboard")),
+        "conversation": (user, reverse("conversation", args=[contact.id])),
+        "search_user": (user, reverse("search_user") + "?username=" + names[1][:3]),
+        "letter_history": (letter.sender, reverse("letter_history", args=[letter.id])),
+        "approvals": (user, reverse("approvals")),
+    }
+    linked = re.compile(r"""<(?:link|script)\b[^>]*?\b(?:href|src)=["']([^"']+)["']""")
+
+    report = {"users": users, "letters": letters, "pages": {}, "assets": {}}
+    with tempfile.TemporaryDirectory() as root, override_settings(STATIC_ROOT=root, ALLOWED_HOSTS=["testserver"]):
+        call_command("collectstatic", interactive=False, verbosity=0)
+        assets = {}
+
+        def fetch_asset(url):
+            if url not in assets:
+                response = Client().get(url, HTTP_ACCEPT_ENCODING="gzip, br")
+                body = b"".join(response.streaming_content) if response.streaming else response.content
+                cache_control = response.get("Cache-Control", "")
+                assets[url] = {
+                    "status": response.status_code,
+                    "bytes": len(body),
+                    "encoding": response.get("Content-Encoding", "identity"),
+                    "cache_control": cache_control,
+                    "immutable": "immutable" in cache_control,
+                }
+            return assets[url]
+
+        for page, (viewer, path) in pages.items():
+            client = Client()
+            if viewer is not None:
+                client.force_login(viewer)
+            response = client.get(path)
+            html = response.content
+            local = [url for url in linked.findall(html.decode()) if url.startswith(settings.STATIC_URL)]
+            external = [url for url in linked.findall(html.decode()) if url.startswith(("http:", "https:", "//"))]
+            fetched = [fetch_asset(url) for url in local]
+            html_gzip = len(gzip.compress(html, 6))
+            report["pages"][page] = {
+                "status": response.status_code,
+                "html_bytes": len(html),
+                "html_gzip_bytes": html_gzip,
+                "first_visit_bytes": html_gzip + sum(asset["bytes"] for asset in fetched),
+                "repeat_visit_bytes": html_gzip + sum(asset["bytes"] for asset in fetched if not asset["immutable"]),
+                "requests": 1 + len(local) + len(external),
+                "repeat_requests": 1 + sum(not asset["immutable"] for asset in fetched) + len(external),
+                "third_party": external,
+            }
+        report["assets"] = assets
+    return report
+
+
+@suite("archive")
+def archive_tiering(users=300, degree=10, letters=20000, depth=4, days=730, cutoff_days=365, edited=20,
+                    repeat=50, seed=0):
+    """
+    Hot-table rows and page latency before and after ``archive_letters``,
+    on letters dated over ``days`` days with the cutoff at ``cutoff_days``;
+    ``edited`` percent of them had their latest version approved today, so
+    only their superseded versions move. The same pages are requested both
+    times with the caches emptied before each request; ``letter_history``
+    reads archived letters back after.
+    """
+    from django.test import Client
+    from django.test.utils import CaptureQueriesContext, override_settings
+    from django.urls import reverse
+
+    from django.core.cache import caches
+
+    from . import archive, metrics
+    from .models import Letter, LetterVersion
+
+    names, edges = seed_graph(users, degree, letters, depth, seed=seed, days=days)
+    current = list(Letter.objects.values_list("current_version_id", flat=True))
+    random.Random(seed).shuffle(current)
+    LetterVersion.objects.filter(id__in=current[:len(current) * edited // 100]).update(created_at=timezone.now())
+    users_by_id = {user.id: user for user in User.objects.filter(username__in=names)}
+    users_by_name = {user.username: user for user in users_by_id.values()}
+    written = list(Letter.objects.values_list("id", "sender_id"))
+    clients = {}
+
+    def client_for(user):
+        if user.id not in clients:
+            clients[user.id] = Client()
+            clients[user.id].force_login(user)
+        return clients[user.id]
+
+    def measure_pages():
+        rng = random.Random(seed + 1)
+
+        def dashboard():
+            return users_by_name[rng.choice(names)], reverse("dashboard")
+
+        def conversation():
+            a, b = rng.choice(edges)
+            return users_by_name[a], reverse("conversation", args=[users_by_name[b].id])
+
+        def letter_history():
+            letter_id, sender_id = rng.choice(written)
+            return users_by_id[sender_id], reverse("letter_history", args=[letter_id])
+
+        results = {}
+        for page in (dashboard, conversation, letter_history):
+            samples, queries, errors = [], [], 0
+            metrics.registry.clear()
+            for _ in range(repeat):
+                user, path = page()
+                client = client_for(user)
+                caches["pages"].clear()
+                caches["auth"].clear()
+                with CaptureQueriesContext(connection) as captured:
+                    begin = time.perf_counter()
+                    response = client.get(path)
+                    samples.append(time.perf_counter() - begin)
+                queries.append(len(captured))
+                errors += response.status_code >= 400
+            measured = metrics.registry.snapshot()[page.__name__]
+            results[page.__name__] = {
+                **summarize(samples),
+                "db_mean_ms": round(measured["db_seconds"] / measured["count"] * 1000, 3),
+                "queries_p50": percentile(queries, 50),
+                "errors": errors,
+            }
+        return results
+
+    report = {"users": users, "connections": len(edges), "letters": letters, "versions": letters * depth}
+    with override_settings(ALLOWED_HOSTS=["testserver"]):
+        measure_pages()  # warm up: template loading, client logins
+        report["before"] = {"rows": archive.count_rows(), "pages": measure_pages()}
+        cutoff = timezone.now() - timedelta(days=cutoff_days)
+        start = time.perf_counter()
+        moved = archive.archive_letters(cutoff)
+        moved.update(archive.archive_versions(cutoff))
+        report["archive_seconds"] = round(time.perf_counter() - start, 2)
+        report["moved"] = dict(moved)
+        if moved["packed_bytes"]:
+            report["compression_ratio"] = round(moved["text_bytes"] / moved["packed_bytes"], 2)
+        report["after"] = {"rows": archive.count_rows(), "pages": measure_pages()}
+    return report
+
+
+@suite("login")
+def login(**params):
+    from django.test.utils import override_settings
+
+    with override_settings(ALLOWED_HOSTS=["testserver"]):
+        return _login(**params)
+
+
+def _login(attempts=100, addresses=20, usernames=10, requests=200, seed=0):
+    """
+    CPU spent on a credential-stuffing burst (``attempts`` wrong passwords
+    spread over ``addresses`` and ``usernames``) with the login throttle on
+    and off, and queries and latency of an authenticated request with
+    database sessions against cached sessions and users.
+    """
+    from django.core.cache import caches
+    from django.test import Client
+    from django.test.utils import CaptureQueriesContext, override_settings
+    from django.urls import reverse
+
+    rng = random.Random(seed)
+    names = seed_users(usernames, seed=seed)
+    victim = User.objects.get(username=names[0])
+    victim.set_password("correct horse")
+    victim.save()
+    burst = [
+        (rng.choice(names), f"10.{i % addresses // 256}.{i % addresses % 256}.1")
+        for i in range(attempts)
+    ]
+
+    report = {"attempts": attempts, "addresses": addresses, "usernames": usernames, "attack": {}}
+    for mode, rates in (("unthrottled", {scope: None for scope in ("login-ip", "login-user")}), ("throttled", {})):
+        with override_settings(LETTERS_THROTTLE_RATES=rates):
+            caches["auth"].clear()
+            client = Client()
+            statuses = []
+            cpu, wall = time.process_time(), time.perf_counter()
+            for username, address in burst:
+                response = client.post(
+                    reverse("login"), {"username": username, "password": "guess"}, REMOTE_ADDR=address
+                )
+                statuses.append(response.status_code)
+            cpu, wall = time.process_time() - cpu, time.perf_counter() - wall
+            victim_login = Client().post(
+                reverse("login"), {"username": victim.username, "password": "correct horse"},
+                REMOTE_ADDR="192.0.2.1",
+            ).status_code
+        report["attack"][mode] = {
+            "passwords_hashed": statuses.count(200),
+            "throttled": statuses.count(429),
+            "cpu_seconds": round(cpu, 2),
+            "cpu_ms_per_attempt": round(cpu / attempts * 1000, 2),
+            "wall_seconds": round(wall, 2),
+            "victim_login_status": victim_login,
+        }
+
+    report["authenticated_request"] = {}
+    setups = {
+        "db_sessions": ("django.contrib.sessions.backends.db", "django.contrib.auth.backends.ModelBackend"),
+        "cached": ("django.contrib.sessions.backends.cached_db", "letters.auth.CachedModelBackend"),
+    }
+    for mode, (engine, backend) in setups.items():
+        with override_settings(SESSION_ENGINE=engine, AUTHENTICATION_BACKENDS=[backend]):
+            caches["auth"].clear()
+            client = Client()
+            client.force_login(victim)
+            url = reverse("search_user")
+            client.get(url)
+            with CaptureQueriesContext(connection) as captured:
+                client.get(url)
+            report["authenticated_request"][mode] = {
+                "queries": len(captured),
+                **measure(lambda: client.get(url), requests),
+            }
+    return report
+
+
+def shared_database_url(directory):
+    """A ``DATABASE_URL`` other processes can open for the scratch database."""
+    settings = connection.settings_dict
+    if connection.vendor == "sqlite":
+        # The SQLite test database lives in memory; copy it to a file.
+        path = os.path.join(directory, "bench.sqlite3")
+        target = sqlite3.connect(path)
+        connection.ensure_connection()
+        connection.connection.backup(target)
+        target.close()
+        return f"sqlite:///{path}"
+    scheme = {"postgresql": "postgres", "mysql": "mysql"}[connection.vendor]
+    credentials = quote(settings["USER"] or "", safe="")
+    if settings["PASSWORD"]:
+        credentials += ":" + quote(settings["PASSWORD"], safe="")
+    return f"{scheme}://{credentials}@{settings['HOST'] or 'localhost'}:{settings['PORT'] or ''}/{settings['NAME']}"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@contextmanager
+def server(application, worker_class, workers, env):
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", application, "-k", worker_class, "-w", str(workers),
+         "-b", f"127.0.0.1:{port}", "--log-level", "warning"],
+        env=env,
+    )
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                if process.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError(f"{application} did not start")
+                time.sleep(0.1)
+        yield port
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+
+
+def fetch(port, cookie, path):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    try:
+        conn.request("GET", path, headers={"Cookie": cookie})
+        response = conn.getresponse()
+        response.read()
+        return response.status
+    finally:
+        conn.close()
+
+
+@suite("concurrency")
+def concurrency(users=200, degree=10, letters=5000, depth=3, workers=2, clients=32,
+                requests=2000, db_latency_ms=2, page_cache="dummy", seed=0):
+    """
+    Requests per second for dashboard, conversation and search_user with
+    ``clients`` concurrent clients, against the same number of gunicorn
+    ``workers`` serving WSGI (sync workers) and ASGI (uvicorn workers).
+    Every query waits ``db_latency_ms`` first, for the network round trip
+    to a real database server; ``page_cache=dummy`` turns the page cache off.
+    """
+    from django.test import Client
+
+    start = time.perf_counter()
+    names, edges = seed_graph(users, degree, letters, depth, seed=seed)
+    seeded_in = time.perf_counter() - start
+
+    rng = random.Random(seed + 1)
+    users_by_name = {user.username: user for user in User.objects.filter(username__in=names)}
+    cookies = {}
+    for name in {name for edge in edges for name in edge}:
+        client = Client()
+        client.force_login(users_by_name[name])
+        cookies[name] = f"sessionid={client.cookies['sessionid'].value}"
+
+    def target(page):
+        a, b = rng.choice(edges)
+        user, other = (a, b) if rng.random() < 0.5 else (b, a)
+        path = {
+            "dashboard": "/dashboard/",
+            "conversation": f"/conversation/{users_by_name[other].id}/",
+            "search_user": f"/search/?username={rng.choice(names)[:3]}",
+        }[page]
+        return page, cookies[user], path
+
+    pages = ("dashboard", "conversation", "search_user")
+    load = [target(pages[i % len(pages)]) for i in range(requests)]
+
+    report = {
+        "users": users, "connections": len(edges), "letters": letters, "workers": workers,
+        "clients": clients, "db_latency_ms": db_latency_ms, "seed_seconds": round(seeded_in, 2),
+        "results": {},
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        env = {
+            **os.environ,
+            "DJANGO_SETTINGS_MODULE": "letters.bench_settings",
+            "DATABASE_URL": shared_database_url(directory),
+            "ALLOWED_HOSTS": "127.0.0.1",
+            "DEBUG": "",
+            "PAGE_CACHE_BACKEND": page_cache,
+            "BENCH_DB_LATENCY_MS": str(db_latency_ms),
+        }
+        deployments = {
+            "wsgi": ("letterbox.wsgi:application", "sync"),
+            "asgi": ("letterbox.asgi:application", "uvicorn_worker.UvicornWorker"),
+        }
+        for mode, (application, worker_class) in deployments.items():
+            with server(application, worker_class, workers, env) as port:
+                for page, cookie, path in load[:len(pages) * 5]:
+                    fetch(port, cookie, path)
+
+                def timed(item):
+                    page, cookie, path = item
+                    begin = time.perf_counter()
+                    status = fetch(port, cookie, path)
+                    return page, status, time.perf_counter() - begin
+
+                begin = time.perf_counter()
+                with ThreadPoolExecutor(clients) as pool:
+                    results = list(pool.map(timed, load))
+                elapsed = time.perf_counter() - begin
+
+            report["results"][mode] = {
+                "requests_per_sec": round(len(results) / elapsed, 1),
+                "errors": sum(status >= 400 for _, status, _ in results),
+                **{
+                    page: summarize([seconds for name, _, seconds in results if name == page])
+                    for page in pages
+                },
+            }
+    report["speedup"] = round(
+        report["results"]["asgi"]["requests_per_sec"] / report["results"]["wsgi"]["requests_per_sec"], 2
+    )
+    return report
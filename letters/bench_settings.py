@@ -0,0 +1,30 @@
+"""
+Settings for the servers ``manage.py benchmark concurrency`` starts: the
+project settings, plus ``BENCH_DB_LATENCY_MS`` of sleep before every query
+to stand in for the network round trip to a database server. The servers
+render pages without running collectstatic first.
+"""
+import os
+import time
+
+from django.db.backends.signals import connection_created
+
+from letterbox.settings import *  # noqa: F401,F403
+
+WHITENOISE_MANIFEST_STRICT = False
+
+DB_LATENCY = float(os.environ.get("BENCH_DB_LATENCY_MS", 0)) / 1000
+
+
+def delay(execute, sql, params, many, context):
+    time.sleep(DB_LATENCY)
+    return execute(sql, params, many, context)
+
+
+def add_latency(sender, connection, **kwargs):
+    if delay not in connection.execute_wrappers:
+        connection.execute_wrappers.append(delay)
+
+
+if DB_LATENCY:
+    connection_created.connect(add_latency)
@@ -0,0 +1,131 @@
+"""
+Per-user and per-pair caching of what the dashboard and conversation pages
+are built from.
+
+Keys carry a generation number per scope: ``user:<id>`` for a user's
+dashboard, ``pair:<low>:<high>`` for the conversation between two users,
+``graph:<id>`` for a user's connections (``letters.graph``).
+Writes bump the generation (``letters.signals`` for ``Connection``,
+``Letter`` and ``LetterVersion`` saves, services for the rest), which
+orphans every key built on the old one; nothing is ever deleted, the
+backend evicts orphans as they age out.
+
+Entries live in the ``pages`` cache alias (see ``CACHES`` in settings).
+Those built from a read replica expire after the replica sticky window
+(``letters.replicas``).
+Hits and misses are counted per page name and served to staff at
+``/api/cache-stats/``.
+"""
+import time
+
+from asgiref.sync import sync_to_async
+from django.core.cache import caches
+from django.db import transaction
+
+from . import replicas
+
+CACHE_ALIAS = "pages"
+TIMEOUT = 60 * 60
+
+PAGES = ("dashboard", "conversation")
+
+
+def get_cache():
+    return caches[CACHE_ALIAS]
+
+
+def user_scope(user_id):
+    return f"user:{user_id}"
+
+
+def pair_scope(a_id, b_id):
+    return "pair:%d:%d" % (min(a_id, b_id), max(a_id, b_id))
+
+
+def graph_scope(user_id):
+    return f"graph:{user_id}"
+
+
+def generations(scopes):
+    cache = get_cache()
+    keys = [f"gen:{scope}" for scope in scopes]
+    found = cache.get_many(keys)
+    for key in keys:
+        if key not in found:
+            # Start from the clock rather than 1, so a generation that was
+            # evicted and recreated cannot land on a number already used.
+            initial = time.time_ns()
+            cache.add(key, initial, None)
+            found[key] = cache.get(key, initial)
+    return [found[key] for key in keys]
+
+
+def _bump(scopes):
+    cache = get_cache()
+    for scope in scopes:
+        key = f"gen:{scope}"
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, time.time_ns(), None)
+
+
+def invalidate(*scopes):
+    """
+    Bump ``scopes`` now and again once the transaction commits: the first
+    keeps this transaction from reading its own stale entries, the second
+    drops anything another request cached from pre-commit data meanwhile.
+    """
+    _bump(scopes)
+    transaction.on_commit(lambda: _bump(scopes))
+
+
+def cached(name, parts, scopes, build, timeout=TIMEOUT):
+    """Return ``build()``, cached under ``name``/``parts`` for the current generation of ``scopes``."""
+    key, value = _lookup(name, parts, scopes)
+    if value is None:
+        value = build()
+        get_cache().set(key, value, replicas.cache_timeout(timeout))
+    return value
+
+
+async def acached(name, parts, scopes, build, timeout=TIMEOUT):
+    """:func:`cached` for async views, where ``build`` is a coroutine function."""
+    key, value = await sync_to_async(_lookup)(name, parts, scopes)
+    if value is None:
+        value = await build()
+        await get_cache().aset(key, value, replicas.cache_timeout(timeout))
+    return value
+
+
+def _lookup(name, parts, scopes):
+    key = ":".join(map(str, (name, *parts, *generations(scopes))))
+    value = get_cache().get(key)
+    _count(name, "hits" if value is not None else "misses")
+    return key, value
+
+
+def _count(name, outcome):
+    cache = get_cache()
+    key = f"stats:{name}:{outcome}"
+    try:
+        cache.incr(key)
+    except ValueError:
+        if not cache.add(key, 1, None):
+            cache.incr(key)
+
+
+def stats():
+    cache = get_cache()
+    keys = [f"stats:{name}:{outcome}" for name in PAGES for outcome in ("hits", "misses")]
+    counts = cache.get_many(keys)
+    report = {}
+    for name in PAGES:
+        hits = counts.get(f"stats:{name}:hits", 0)
+        misses = counts.get(f"stats:{name}:misses", 0)
+        report[name] = {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": round(hits / (hits + misses), 3) if hits + misses else None,
+        }
+    return report
@@ -0,0 +1,61 @@
+"""
+Compact text deltas for ``LetterVersion`` storage.
+
+A delta is a JSON list of operations applied left to right to the parent
+text: a non-negative int copies that many characters, a negative int skips
+them, a string is inserted. Diffing works on words with their trailing
+whitespace, which keeps it fast on long letters while still producing small
+deltas for the typical proposal that rewords a sentence or two.
+"""
+import json
+import re
+from difflib import SequenceMatcher
+
+# Rebuilding a version never applies more than this many deltas.
+SNAPSHOT_INTERVAL = 16
+
+TOKENS = re.compile(r"\S+\s*|\s+")
+
+
+def make_delta(old, new):
+    a = TOKENS.findall(old)
+    b = TOKENS.findall(new)
+    ops = []
+    for tag, i1, i2, j1, j2 in SequenceMatcher(None, a, b, autojunk=False).get_opcodes():
+        if tag == "equal":
+            ops.append(sum(map(len, a[i1:i2])))
+            continue
+        if i2 > i1:
+            ops.append(-sum(map(len, a[i1:i2])))
+        if j2 > j1:
+            ops.append("".join(b[j1:j2]))
+    return json.dumps(ops, separators=(",", ":"), ensure_ascii=False)
+
+
+def apply_delta(old, delta):
+    out = []
+    pos = 0
+    for op in json.loads(delta):
+        if isinstance(op, str):
+            out.append(op)
+        elif op >= 0:
+            out.append(old[pos:pos + op])
+            pos += op
+        else:
+            pos -= op
+    return "".join(out)
+
+
+def compress(parent_text, parent_depth, text):
+    """
+    Return the delta to store for ``text`` on top of a parent at
+    ``parent_depth``, or ``None`` when it should be stored as a snapshot:
+    the chain is already ``SNAPSHOT_INTERVAL`` long or the delta would not
+    be smaller than the text itself.
+    """
+    if parent_depth + 1 >= SNAPSHOT_INTERVAL:
+        return None
+    delta = make_delta(parent_text, text)
+    if len(delta) >= len(text):
+        return None
+    return delta
@@ -0,0 +1,181 @@
+"""
+Streaming export of a user's letters.
+
+One NDJSON line per letter with its full version history, oldest version
+first, in the shape ``manage.py import_letters`` reads back. Letters are
+read in chunks with ``.iterator()`` and each chunk's versions in a single
+ordered query; delta-stored versions are rebuilt as the chunk streams past,
+since a delta's parent always comes earlier in the same letter, so memory
+stays flat however long the history is. Versions and letters moved to the
+archive (``letters.archive``) are merged back in, archived letters last.
+"""
+import io
+import json
+import zipfile
+from itertools import groupby
+
+from asgiref.sync import sync_to_async
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+
+from .delta import apply_delta
+from .models import ArchivedLetter, Letter, LetterVersion
+from .search import chunked
+
+FORMATS = {
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "json": ("application/json", "json"),
+    "zip": ("application/zip", "zip"),
+}
+
+# Bytes gathered before a chunk is handed to the response or file.
+CHUNK_BYTES = 64 * 1024
+
+
+def letters_of(user, contact=None):
+    letters = Letter.objects.filter(Q(sender=user) | Q(receiver=user))
+    if contact is not None:
+        letters = letters.filter(Q(sender=contact) | Q(receiver=contact))
+    return letters.select_related("sender", "receiver").order_by("id")
+
+
+def archived_of(user, contact=None):
+    """The archived counterpart of :func:`letters_of`."""
+    letters = ArchivedLetter.objects.filter(Q(sender=user) | Q(receiver=user), whole=True)
+    if contact is not None:
+        letters = letters.filter(Q(sender=contact) | Q(receiver=contact))
+    return letters.select_related("sender", "receiver").order_by("id")
+
+
+def _archived_versions(letter):
+    return [
+        {"id": v.id, "created_at": v.created_at, "approved": v.approved, "current": v.current, "content": v.content}
+        for v in letter.history
+    ]
+
+
+def records(letters, chunk_size=500, archived=None):
+    """Yield one dict per letter in ``letters``, then in ``archived``, versions included."""
+    for batch in chunked(letters.iterator(chunk_size=chunk_size), chunk_size):
+        by_id = {letter.id: letter for letter in batch}
+        earlier = ArchivedLetter.objects.in_bulk(list(by_id))
+        versions = LetterVersion.objects.filter(letter_id__in=by_id).order_by(
+            "letter_id", "created_at", "id"
+        ).only("letter_id", "stored_content", "delta_parent", "created_at", "approved")
+        for letter_id, group in groupby(versions.iterator(chunk_size=chunk_size), lambda v: v.letter_id):
+            letter = by_id[letter_id]
+            texts = {}
+            history = _archived_versions(earlier[letter_id]) if letter_id in earlier else []
+            for version in group:
+                if version.delta_parent_id is None:
+                    text = version.stored_content
+                else:
+                    text = apply_delta(texts[version.delta_parent_id], version.stored_content)
+                texts[version.id] = text
+                history.append({
+                    "id": version.id,
+                    "created_at": version.created_at,
+                    "approved": version.approved,
+                    "current": version.id == letter.current_version_id,
+                    "content": text,
+                })
+            if letter_id in earlier:
+                history.sort(key=lambda v: (v["created_at"], v["id"]))
+            yield _record(letter, history)
+    if archived is not None:
+        for letter in archived.iterator(chunk_size=chunk_size):
+            yield _record(letter, _archived_versions(letter))
+
+
+def _record(letter, history):
+    return {
+        "id": letter.id,
+        "sender": letter.sender.username,
+        "receiver": letter.receiver.username,
+        "created_at": letter.created_at,
+        "versions": history,
+    }
+
+
+def ndjson_lines(letters, chunk_size=500, archived=None):
+    for record in records(letters, chunk_size, archived):
+        yield (json.dumps(record, cls=DjangoJSONEncoder, ensure_ascii=False) + "\n").encode()
+
+
+def json_lines(letters, chunk_size=500, archived=None):
+    yield b"["
+    first = True
+    for line in ndjson_lines(letters, chunk_size, archived):
+        yield (b"\n" if first else b",\n") + line.rstrip(b"\n")
+        first = False
+    yield b"\n]\n"
+
+
+class _Sink(io.RawIOBase):
+    """A write-only stream whose contents are taken out as they arrive."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        return len(data)
+
+    def take(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+def zip_chunks(letters, chunk_size=500, name="letters.ndjson", archived=None):
+    # ZipFile writes to unseekable streams by putting sizes in data
+    # descriptors after each entry, so the archive never has to be held.
+    sink = _Sink()
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED) as archive:
+        with archive.open(name, "w", force_zip64=True) as entry:
+            for line in ndjson_lines(letters, chunk_size, archived):
+                entry.write(line)
+                if len(sink.buffer) >= CHUNK_BYTES:
+                    yield sink.take()
+    yield sink.take()
+
+
+def export(letters, fmt="ndjson", chunk_size=500, archived=None):
+    """
+    Yield the export of ``letters`` and then the ``archived`` letters
+    (:func:`archived_of`) in ``fmt`` as byte chunks of about ``CHUNK_BYTES``.
+    """
+    if fmt == "zip":
+        yield from zip_chunks(letters, chunk_size, archived=archived)
+        return
+    if fmt == "json":
+        lines = json_lines(letters, chunk_size, archived)
+    else:
+        lines = ndjson_lines(letters, chunk_size, archived)
+    buffer = bytearray()
+    for line in lines:
+        buffer += line
+        if len(buffer) >= CHUNK_BYTES:
+            yield bytes(buffer)
+            buffer.clear()
+    if buffer:
+        yield bytes(buffer)
+
+
+async def aiter_chunks(chunks):
+    """
+    Serve a sync chunk generator to an ASGI server one chunk at a time.
+    Handed a sync iterator, Django's ASGI handler would read it to the end
+    into memory before sending anything.
+    """
+    done = object()
+    pull = sync_to_async(next)
+    try:
+        while (chunk := await pull(chunks, done)) is not done:
+            yield chunk
+    finally:
+        # Release the database cursors if the client went away mid-stream.
+        await sync_to_async(chunks.close)()
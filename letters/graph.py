@@ -0,0 +1,60 @@
+"""
+Who each user is connected to, for constant-time "are we connected" checks.
+
+A user's adjacency (accepted contacts and pending requests either way) is
+read with one query on ``Connection`` (``user_low``/``user_high`` find the
+user's rows from either side) and kept as frozensets in the ``pages`` cache
+under the ``graph:<id>`` scope of ``letters.caching``; ``letters.signals``
+bumps it whenever one of the user's connections is saved or deleted. After
+that a check is a cache read and a set lookup, however many contacts the
+user has. Like the page cache, an adjacency read from a replica is kept no
+longer than the sticky window (``letters.replicas``).
+
+These checks authorize reads and writes, so the cache is only used with
+``LETTERS_GRAPH_CACHE`` on, which settings tie to a ``pages`` cache shared
+by every worker: a private one would only see the bumps made by its own
+worker. Otherwise every check reads ``Connection``.
+"""
+from django.conf import settings
+from django.db.models import Q
+
+from . import replicas
+from .caching import TIMEOUT, generations, get_cache, graph_scope
+from .models import Connection
+
+
+def adjacency(user_id):
+    """``(contacts, pending)``: ids of accepted contacts and of users with a request open either way."""
+    if not getattr(settings, "LETTERS_GRAPH_CACHE", False):
+        return _read(user_id)
+    cache = get_cache()
+    (generation,) = generations([graph_scope(user_id)])
+    key = f"graph:{user_id}:{generation}"
+    value = cache.get(key)
+    if value is None:
+        value = _read(user_id)
+        cache.set(key, value, replicas.cache_timeout(TIMEOUT))
+    return value
+
+
+def _read(user_id):
+    contacts, pending = set(), set()
+    for low, high, accepted in Connection.objects.filter(
+        Q(user_low_id=user_id) | Q(user_high_id=user_id)
+    ).values_list("user_low_id", "user_high_id", "accepted"):
+        (contacts if accepted else pending).add(high if low == user_id else low)
+    return frozenset(contacts), frozenset(pending)
+
+
+def contacts(user_id):
+    return adjacency(user_id)[0]
+
+
+def are_connected(a_id, b_id):
+    return b_id in contacts(a_id)
+
+
+def related(user_id):
+    """Everyone the user is connected to or has a pending request with."""
+    accepted, pending = adjacency(user_id)
+    return accepted | pending
@@ -0,0 +1,314 @@
+"""
+Bulk import of letters from other systems, for ``manage.py import_letters``.
+
+Input records have the shape ``letters.export`` writes: one letter with
+its sender and receiver usernames and its versions oldest first. Records
+are read as a stream and written in batches, each batch in one
+transaction with ``bulk_create`` for users, connections, letters and
+versions, together with the source's ``ImportCheckpoint``; a rerun after a
+crash skips the records that were already committed.
+"""
+import csv
+import json
+import time
+from collections import Counter
+from itertools import groupby
+
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.db.models import F, OuterRef, Subquery
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import delta, stats
+from .caching import graph_scope, invalidate, pair_scope, user_scope
+from .models import (
+    ChangeLogEntry,
+    Connection,
+    ContactSummary,
+    ImportCheckpoint,
+    Letter,
+    LetterVersion,
+)
+from .services import log_changes, save_current_many
+from .tasks import index_versions
+
+
+class ImportFormatError(ValueError):
+    pass
+
+
+def read_ndjson(lines):
+    for number, line in enumerate(lines, 1):
+        if line.strip():
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as exc:
+                raise ImportFormatError(f"line {number}: {exc}")
+
+
+def read_csv(lines):
+    """
+    One row per version with the columns ``letter, sender, receiver,
+    created_at, content`` and optionally ``approved``; rows of one letter
+    (same ``letter`` key) are consecutive and oldest first.
+    """
+    rows = csv.DictReader(lines)
+    missing = {"letter", "sender", "receiver", "content"} - set(rows.fieldnames or ())
+    if missing:
+        raise ImportFormatError(f"missing CSV columns: {', '.join(sorted(missing))}")
+    for _, group in groupby(rows, lambda row: row["letter"]):
+        group = list(group)
+        yield {
+            "sender": group[0]["sender"],
+            "receiver": group[0]["receiver"],
+            "created_at": group[0].get("created_at"),
+            "versions": [
+                {
+                    "content": row["content"],
+                    "created_at": row.get("created_at"),
+                    "approved": row.get("approved", "true").lower() in ("1", "true", "yes"),
+                }
+                for row in group
+            ],
+        }
+
+
+def parse_time(value, default):
+    if not value:
+        return default
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise ImportFormatError(f"bad timestamp {value!r}")
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+class Importer:
+    def __init__(self, source, batch_size=1000, create_users=False):
+        self.source = source
+        self.batch_size = batch_size
+        self.create_users = create_users
+        self.user_ids = {}
+        self.pairs = set()
+        self.created = Counter()
+
+    def run(self, records, restart=False):
+        checkpoint, _ = ImportCheckpoint.objects.get_or_create(source=self.source)
+        if restart:
+            ImportCheckpoint.objects.filter(pk=checkpoint.pk).update(
+                records=0, letters=0, versions=0, skipped=0, finished=False
+            )
+            checkpoint.refresh_from_db()
+        resumed_at = checkpoint.records
+
+        start = time.perf_counter()
+        batch = []
+        for position, record in enumerate(records, 1):
+            if position <= resumed_at:
+                continue
+            batch.append(record)
+            if len(batch) == self.batch_size:
+                self.write(checkpoint, batch)
+                batch = []
+        if batch:
+            self.write(checkpoint, batch)
+        ImportCheckpoint.objects.filter(pk=checkpoint.pk).update(finished=True)
+        elapsed = time.perf_counter() - start
+
+        rows = self.created["letters"] + self.created["versions"]
+        return {
+            "source": self.source,
+            "resumed_at": resumed_at,
+            **{key: self.created[key] for key in ("letters", "versions", "connections", "users", "skipped")},
+            "seconds": round(elapsed, 2),
+            "rows_per_sec": round(rows / elapsed) if elapsed else None,
+        }
+
+    @transaction.atomic
+    def write(self, checkpoint, batch):
+        self.resolve_users({name for record in batch for name in (record["sender"], record["receiver"])})
+        records = [
+            record for record in batch
+            if record["sender"] in self.user_ids and record["receiver"] in self.user_ids
+            and record["sender"] != record["receiver"] and record.get("versions")
+        ]
+        skipped = len(batch) - len(records)
+        letters, versions = [], []
+        if records:
+            self.connect({
+                (self.user_ids[record["sender"]], self.user_ids[record["receiver"]]) for record in records
+            })
+            letters, versions = self.create_letters(records)
+
+        ImportCheckpoint.objects.filter(pk=checkpoint.pk).update(
+            records=F("records") + len(batch),
+            letters=F("letters") + len(letters),
+            versions=F("versions") + len(versions),
+            skipped=F("skipped") + skipped,
+        )
+        self.created.update(letters=len(letters), versions=len(versions), skipped=skipped)
+
+    def resolve_users(self, usernames):
+        missing = usernames - self.user_ids.keys()
+        if not missing:
+            return
+        self.user_ids.update(User.objects.filter(username__in=missing).values_list("username", "id"))
+        missing -= self.user_ids.keys()
+        if missing and self.create_users:
+            users = User.objects.bulk_create(User(username=name, password="!") for name in sorted(missing))
+            self.user_ids.update((user.username, user.id) for user in users)
+            self.created["users"] += len(users)
+
+    def connect(self, pairs):
+        """Make sure every (sender, receiver) pair is connected, creating accepted connections."""
+        wanted = {(min(pair), max(pair)): pair for pair in pairs}
+        for key in self.pairs.intersection(wanted):
+            del wanted[key]
+        if not wanted:
+            return
+        ids = {user_id for pair in wanted for user_id in pair}
+        for key in Connection.objects.filter(
+            user_low_id__in=ids, user_high_id__in=ids
+        ).values_list("user_low_id", "user_high_id"):
+            if key in wanted:
+                self.pairs.add(key)
+                del wanted[key]
+
+        connections = Connection.objects.bulk_create(
+            Connection(requester_id=sender_id, receiver_id=receiver_id, accepted=True)
+            for sender_id, receiver_id in wanted.values()
+        )
+        ContactSummary.objects.bulk_create(
+            [
+                ContactSummary(owner_id=owner, contact_id=contact, connection=conn, accepted=True)
+                for conn in connections
+                for owner, contact in ((conn.requester_id, conn.receiver_id), (conn.receiver_id, conn.requester_id))
+            ],
+            ignore_conflicts=True,
+        )
+        counts = stats.changes()
+        for conn in connections:
+            counts[conn.requester_id]["contacts"] += 1
+            counts[conn.receiver_id]["contacts"] += 1
+        stats.bump(counts)
+        invalidate(*{graph_scope(user_id) for pair in wanted for user_id in pair})
+        self.pairs.update(wanted)
+        self.created["connections"] += len(connections)
+
+    def create_letters(self, records):
+        now = timezone.now()
+        letters = Letter.objects.bulk_create(
+            Letter(
+                sender_id=self.user_ids[record["sender"]],
+                receiver_id=self.user_ids[record["receiver"]],
+                created_at=parse_time(record.get("created_at"), now),
+            )
+            for record in records
+        )
+
+        # Versions go in one bulk_create per position in the history, so
+        # every delta's parent already has an id. Each version is diffed
+        # against the latest approved one before it, as services does.
+        texts = [None] * len(records)
+        parents = [None] * len(records)
+        # The version flagged current, else the last approved one.
+        current = [
+            next(
+                (k for k, data in enumerate(record["versions"]) if data.get("current")),
+                max((k for k, data in enumerate(record["versions"]) if data.get("approved", True)), default=None),
+            )
+            for record in records
+        ]
+        versions = []
+        for position in range(max(len(record["versions"]) for record in records)):
+            layer = []
+            for i, record in enumerate(records):
+                if position >= len(record["versions"]):
+                    continue
+                data = record["versions"][position]
+                version = LetterVersion(
+                    letter=letters[i],
+                    content=data["content"],
+                    approved=bool(data.get("approved", True)),
+                    created_at=parse_time(data.get("created_at"), letters[i].created_at),
+                )
+                if not version.approved:
+                    version.approver_id = letters[i].sender_id
+                parent = parents[i]
+                if parent is not None:
+                    stored = delta.compress(texts[i], parent.delta_depth, data["content"])
+                    if stored is not None:
+                        version.stored_content = stored
+                        version.delta_parent = parent
+                        version.delta_base_id = parent.delta_base_id or parent.id
+                        version.delta_depth = parent.delta_depth + 1
+                layer.append((i, version))
+            LetterVersion.objects.bulk_create(version for _, version in layer)
+            for i, version in layer:
+                # Never a proposal: rejecting it would delete its deltas.
+                if version.approved:
+                    parents[i], texts[i] = version, version.content
+                if position == current[i]:
+                    letters[i].set_current(version)
+                versions.append(version)
+
+        save_current_many(letters)
+        # Imported proposals were made against the text imported as current.
+        proposals = [version.id for version in versions if not version.approved]
+        if proposals:
+            LetterVersion.objects.filter(id__in=proposals).update(base_version_id=Subquery(
+                Letter.objects.filter(pk=OuterRef("letter_id")).values("current_version_id")[:1]
+            ))
+        self.update_summaries(letters, versions)
+        index_versions.enqueue(ids=[version.id for version in versions if version.approved])
+        log_changes(
+            (ChangeLogEntry.LETTER, ChangeLogEntry.CREATED, letter.id, letter.sender_id, [letter.receiver_id], letter.id)
+            for letter in letters
+        )
+        # Bulk writes send no save signals.
+        invalidate(*{
+            scope for letter in letters for scope in (
+                user_scope(letter.sender_id), user_scope(letter.receiver_id),
+                pair_scope(letter.sender_id, letter.receiver_id),
+            )
+        })
+        return letters, versions
+
+    def update_summaries(self, letters, versions):
+        latest = {}
+        written = Counter()
+        counts = stats.changes()
+        for letter in letters:
+            for key in ((letter.sender_id, letter.receiver_id), (letter.receiver_id, letter.sender_id)):
+                latest[key] = max(latest.get(key, letter.created_at), letter.created_at)
+                written[key] += 1
+            counts[letter.sender_id]["letters_sent"] += 1
+            counts[letter.receiver_id]["letters_received"] += 1
+        pending = Counter(
+            (version.letter.sender_id, version.letter.receiver_id)
+            for version in versions if not version.approved
+        )
+        for (sender_id, receiver_id), count in pending.items():
+            counts[sender_id]["pending_approvals"] += count
+            counts[receiver_id]["pending_proposals"] += count
+        stats.bump(counts)
+        # One prepared statement for every pair; an ORM update() per pair
+        # spends more time building queries than running them.
+        quote = connection.ops.quote_name
+        table = quote(ContactSummary._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f"UPDATE {table} SET "
+                f"last_letter_at = CASE WHEN last_letter_at IS NULL OR last_letter_at < %s "
+                f"THEN %s ELSE last_letter_at END, "
+                f"pending_approval_count = pending_approval_count + %s, "
+                f"letter_count = letter_count + %s "
+                f"WHERE owner_id = %s AND contact_id = %s",
+                [
+                    (at, at, pending[owner_id, contact_id], written[owner_id, contact_id], owner_id, contact_id)
+                    for (owner_id, contact_id), last_letter_at in latest.items()
+                    for at in [connection.ops.adapt_datetimefield_value(last_letter_at)]
+                ],
+            )
@@ -0,0 +1,58 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from letters.archive import archivable_letters, archive_letters, archive_versions, superseded_versions, table_rows
+
+
+class Command(BaseCommand):
+    help = (
+        "Move letters untouched for --days, and superseded versions older than that, "
+        "from the hot tables to the compressed archive. Safe to rerun or interrupt."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days", type=int, default=getattr(settings, "LETTERS_ARCHIVE_AFTER_DAYS", 365),
+            help="Age cutoff in days (default: LETTERS_ARCHIVE_AFTER_DAYS).",
+        )
+        parser.add_argument("--only", choices=("letters", "versions"), help="Run a single pass.")
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument("--dry-run", action="store_true", help="Count what would move and stop.")
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options["days"])
+        only = options["only"]
+        if options["dry_run"]:
+            if only != "versions":
+                self.stdout.write(f"{archivable_letters(cutoff).count()} letters to archive")
+            if only != "letters":
+                self.stdout.write(f"{superseded_versions(cutoff).count()} superseded versions to archive")
+            return
+
+        before = table_rows(refresh=True)
+        moved = {}
+        if only != "versions":
+            moved["letters"] = archive_letters(cutoff, options["batch_size"])
+        if only != "letters":
+            moved["versions"] = archive_versions(cutoff, options["batch_size"])
+        after = table_rows(refresh=True)
+
+        if "letters" in moved:
+            self.report(f"{moved['letters']['letters']} letters", moved["letters"])
+        if "versions" in moved:
+            self.report(
+                f"superseded versions of {moved['versions']['live_letters']} live letters", moved["versions"]
+            )
+        for table, rows in after.items():
+            self.stdout.write(f"{table}: {before[table]} -> {rows} rows")
+
+    def report(self, what, totals):
+        text, packed = totals["text_bytes"], totals["packed_bytes"]
+        ratio = f", {text / packed:.1f}x smaller" if packed else ""
+        self.stdout.write(self.style.SUCCESS(
+            f"Archived {what} ({totals['versions']} versions): "
+            f"{text / 1024:.0f} KiB of text in {packed / 1024:.0f} KiB{ratio}."
+        ))
@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import OuterRef, Q, Subquery
+
+from letters.caching import invalidate, pair_scope
+from letters.models import Letter, LetterVersion
+
+
+class Command(BaseCommand):
+    help = "Point letters at their latest approved version and refresh their previews."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--all", action="store_true",
+            help="Recompute every letter, not only those missing a pointer or preview.",
+        )
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        latest_approved = LetterVersion.objects.filter(
+            letter=OuterRef("pk"), approved=True
+        ).order_by("-created_at", "-id").values("id")[:1]
+
+        letters = Letter.objects.annotate(latest_approved_id=Subquery(latest_approved))
+        if not options["all"]:
+            letters = letters.filter(Q(current_version__isnull=True) | Q(preview=""))
+
+        batch_size = options["batch_size"]
+        updated = 0
+        last_id = 0
+        while True:
+            # Walk by primary key so rows fixed by one batch never shift the next.
+            batch = list(letters.filter(id__gt=last_id).order_by("id")[:batch_size])
+            if not batch:
+                break
+            last_id = batch[-1].id
+
+            versions = LetterVersion.objects.in_bulk(
+                [letter.latest_approved_id for letter in batch if letter.latest_approved_id]
+            )
+            LetterVersion.objects.fill_content(list(versions.values()))
+            changed = []
+            for letter in batch:
+                version = versions.get(letter.latest_approved_id)
+                if version is not None:
+                    letter.set_current(version)
+                    changed.append(letter)
+
+            with transaction.atomic():
+                Letter.objects.bulk_update(changed, ["current_version", "preview"])
+                # bulk_update sends no save signals.
+                invalidate(*{pair_scope(letter.sender_id, letter.receiver_id) for letter in changed})
+            updated += len(changed)
+
+        self.stdout.write(self.style.SUCCESS(f"Updated {updated} letters."))
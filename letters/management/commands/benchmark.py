@@ -0,0 +1,37 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from letters.bench import SUITES, scratch_database
+
+
+class Command(BaseCommand):
+    help = "Run a benchmark suite against a throwaway database and print a JSON report."
+
+    def add_arguments(self, parser):
+        parser.add_argument("suite", choices=sorted(SUITES))
+        parser.add_argument(
+            "-p", "--param", action="append", default=[], metavar="NAME=VALUE",
+            help="Suite parameter, e.g. -p users=1000000. May be repeated.",
+        )
+        parser.add_argument("-o", "--output", help="Write the report to this file.")
+
+    def handle(self, *args, **options):
+        params = {}
+        for item in options["param"]:
+            name, sep, value = item.partition("=")
+            if not sep:
+                raise CommandError(f"Expected NAME=VALUE, got {item!r}")
+            params[name] = int(value) if value.lstrip("-").isdigit() else value
+
+        # Suites render pages without running collectstatic first.
+        with scratch_database(), override_settings(WHITENOISE_MANIFEST_STRICT=False):
+            report = SUITES[options["suite"]](**params)
+
+        text = json.dumps({"suite": options["suite"], "params": params, **report}, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as fh:
+                fh.write(text + "\n")
+        else:
+            self.stdout.write(text)
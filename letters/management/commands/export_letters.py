@@ -0,0 +1,39 @@
+import sys
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from letters.export import FORMATS, archived_of, export, letters_of
+
+
+class Command(BaseCommand):
+    help = "Stream a user's letters with their version history as NDJSON, JSON or ZIP."
+
+    def add_arguments(self, parser):
+        parser.add_argument("username")
+        parser.add_argument("--with", dest="contact", metavar="USERNAME", help="Only this conversation.")
+        parser.add_argument("--format", choices=sorted(FORMATS), default="ndjson")
+        parser.add_argument("-o", "--output", help="Write here instead of standard output.")
+        parser.add_argument("--chunk-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options["username"])
+            contact = User.objects.get(username=options["contact"]) if options["contact"] else None
+        except User.DoesNotExist as exc:
+            raise CommandError(exc)
+        if options["format"] == "zip" and not options["output"] and sys.stdout.isatty():
+            raise CommandError("Refusing to write a ZIP archive to a terminal; use -o.")
+
+        chunks = export(
+            letters_of(user, contact), options["format"], options["chunk_size"], archived=archived_of(user, contact)
+        )
+        out = open(options["output"], "wb") if options["output"] else sys.stdout.buffer
+        try:
+            for chunk in chunks:
+                out.write(chunk)
+        finally:
+            if options["output"]:
+                out.close()
+            else:
+                out.flush()
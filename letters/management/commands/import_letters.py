@@ -0,0 +1,52 @@
+import io
+import json
+import os
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from letters.importer import Importer, ImportFormatError, read_csv, read_ndjson
+
+
+class Command(BaseCommand):
+    help = (
+        "Import letters with their version history from NDJSON (the export_letters "
+        "format) or CSV. Rerunning with the same source resumes after the last "
+        "committed batch."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="Input file, or - for standard input.")
+        parser.add_argument("--format", choices=("ndjson", "csv"), help="Defaults to the file extension.")
+        parser.add_argument(
+            "--source",
+            help="Name the resume checkpoint is kept under; defaults to the file's absolute path.",
+        )
+        parser.add_argument("--batch-size", type=int, default=1000, help="Letters per transaction.")
+        parser.add_argument(
+            "--create-users", action="store_true",
+            help="Create unknown usernames (without a usable password) instead of skipping their letters.",
+        )
+        parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint and start over.")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        fmt = options["format"] or ("csv" if path.endswith(".csv") else "ndjson")
+        if path == "-":
+            source = options["source"] or "stdin"
+            stream = io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8", newline="")
+        else:
+            source = options["source"] or os.path.abspath(path)
+            try:
+                stream = open(path, encoding="utf-8", newline="")
+            except OSError as exc:
+                raise CommandError(exc)
+
+        importer = Importer(source, options["batch_size"], options["create_users"])
+        with stream:
+            records = read_csv(stream) if fmt == "csv" else read_ndjson(stream)
+            try:
+                report = importer.run(records, restart=options["restart"])
+            except (ImportFormatError, KeyError) as exc:
+                raise CommandError(f"Bad input: {exc}")
+        self.stdout.write(json.dumps(report, indent=2))
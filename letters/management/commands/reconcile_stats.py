@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from letters.stats import reconcile
+
+
+class Command(BaseCommand):
+    help = (
+        "Recount every user's letter, edit and connection counters from the rows themselves "
+        "and fix any that drifted. Meant to run periodically, e.g. nightly from cron."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000, help="Users per transaction.")
+
+    def handle(self, *args, **options):
+        totals = reconcile(options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(
+            f"Created {totals['created']} and fixed {totals['fixed']} user counters, "
+            f"fixed {totals['summaries']} contact summaries."
+        ))
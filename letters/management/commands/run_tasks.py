@@ -0,0 +1,65 @@
+import os
+import signal
+import socket
+import threading
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection
+
+from letters import queue
+
+
+class Command(BaseCommand):
+    help = "Run queued background tasks until stopped (SIGTERM/SIGINT finishes the current batch)."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--concurrency", type=int, default=int(os.environ.get("TASK_CONCURRENCY", 1)),
+            help="Worker threads, each claiming its own batches.",
+        )
+        parser.add_argument("--batch-size", type=int, default=10)
+        parser.add_argument("--poll-interval", type=float, default=1.0, help="Seconds to sleep when idle.")
+        parser.add_argument(
+            "--lease", type=int, default=600,
+            help="Seconds after which a running task is assumed abandoned and requeued.",
+        )
+        parser.add_argument("--min-priority", type=int, help="Only run tasks at or above this priority.")
+        parser.add_argument("--once", action="store_true", help="Exit once the queue is empty.")
+
+    def handle(self, *args, **options):
+        stop = threading.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda *_: stop.set())
+
+        worker = f"{socket.gethostname()}:{os.getpid()}"
+        queue.requeue_stale(options["lease"])
+        threads = [
+            threading.Thread(target=self.work, args=(f"{worker}:{n}", stop, options), daemon=True)
+            for n in range(options["concurrency"])
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(0.5)
+
+    def work(self, worker, stop, options):
+        done = failed = 0
+        try:
+            while not stop.is_set():
+                close_old_connections()
+                tasks = queue.claim(worker, options["batch_size"], options["min_priority"])
+                if not tasks:
+                    if options["once"]:
+                        break
+                    queue.requeue_stale(options["lease"])
+                    stop.wait(options["poll_interval"])
+                    continue
+                for task in tasks:
+                    if queue.execute(task):
+                        done += 1
+                    else:
+                        failed += 1
+        finally:
+            connection.close()
+        self.stdout.write(f"{worker}: {done} done, {failed} failed")
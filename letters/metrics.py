@@ -0,0 +1,200 @@
+"""
+Per-view request metrics, collected by ``letters.middleware.MetricsMiddleware``
+and served in the Prometheus text format at ``/metrics``.
+
+For each view (by URL name) the middleware records wall time, number and
+time of database queries, template render time and response size. Queries
+are timed by an execute wrapper every connection gets when it opens, and
+templates by the ``TimedDjangoTemplates`` backend; both only add to the
+current request's ``RequestStats`` through a context variable, so they
+follow a request into ``sync_to_async`` threads and cost a lookup and two
+clock reads when nothing is recording.
+
+Counters live in process memory: each worker serves its own, and
+Prometheus sums them across the scrape targets. Row counts of the letter
+tables and the archive (``letters.archive``) are gauges, recounted at
+most every few minutes.
+"""
+import threading
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.template.backends.django import DjangoTemplates, Template
+
+from . import archive, caching
+
+# Upper bounds of the request duration histogram, in seconds.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Queries a request may run before it is logged and counted as over budget.
+DEFAULT_QUERY_BUDGET = 25
+
+_current = ContextVar("letters_request_stats", default=None)
+
+
+def query_budget():
+    return getattr(settings, "LETTERS_QUERY_BUDGET", DEFAULT_QUERY_BUDGET)
+
+
+class RequestStats:
+    __slots__ = ("queries", "db_seconds", "template_seconds")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.template_seconds = 0.0
+
+
+def start():
+    """Start recording for the current request; pass the result to :func:`stop`."""
+    stats = RequestStats()
+    return stats, _current.set(stats)
+
+
+def stop(token):
+    _current.reset(token)
+
+
+def record_query(execute, sql, params, many, context):
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    begin = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.db_seconds += time.perf_counter() - begin
+        stats.queries += 1
+
+
+@receiver(connection_created)
+def instrument_connection(sender, connection, **kwargs):
+    # Sent again whenever a persistent connection reconnects.
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+class TimedTemplate(Template):
+    def render(self, context=None, request=None):
+        stats = _current.get()
+        if stats is None:
+            return super().render(context, request)
+        begin = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            stats.template_seconds += time.perf_counter() - begin
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """The Django template engine, timing each top-level render; includes count towards their parent."""
+
+    def from_string(self, template_code):
+        return TimedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        template = super().get_template(template_name)
+        return TimedTemplate(template.template, self)
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.views = {}
+
+    def observe(self, view, status, seconds, stats, size, over_budget):
+        with self.lock:
+            entry = self.views.get(view)
+            if entry is None:
+                entry = self.views[view] = {
+                    "statuses": {}, "buckets": [0] * len(BUCKETS), "seconds": 0.0, "count": 0,
+                    "queries": 0, "db_seconds": 0.0, "template_seconds": 0.0,
+                    "response_bytes": 0, "over_budget": 0,
+                }
+            status_class = f"{status // 100}xx"
+            entry["statuses"][status_class] = entry["statuses"].get(status_class, 0) + 1
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    entry["buckets"][i] += 1
+                    break
+            entry["seconds"] += seconds
+            entry["count"] += 1
+            entry["queries"] += stats.queries
+            entry["db_seconds"] += stats.db_seconds
+            entry["template_seconds"] += stats.template_seconds
+            entry["response_bytes"] += size
+            entry["over_budget"] += over_budget
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                view: {**entry, "statuses": dict(entry["statuses"]), "buckets": list(entry["buckets"])}
+                for view, entry in self.views.items()
+            }
+
+    def clear(self):
+        with self.lock:
+            self.views.clear()
+
+
+registry = Registry()
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render():
+    """The collected metrics in the Prometheus text exposition format."""
+    views = sorted(registry.snapshot().items())
+    lines = []
+
+    def family(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for suffix, labels, value in samples:
+            label_text = ",".join(f'{key}="{_label(val)}"' for key, val in labels)
+            lines.append(f"{name}{suffix}{{{label_text}}} {value}")
+
+    family(
+        "letters_http_requests_total", "counter", "Requests by view and status class.",
+        [("", (("view", view), ("status", status)), count)
+         for view, entry in views for status, count in sorted(entry["statuses"].items())],
+    )
+    histogram = []
+    for view, entry in views:
+        cumulative = 0
+        for bound, count in zip(BUCKETS, entry["buckets"]):
+            cumulative += count
+            histogram.append(("_bucket", (("view", view), ("le", bound)), cumulative))
+        histogram.append(("_bucket", (("view", view), ("le", "+Inf")), entry["count"]))
+        histogram.append(("_sum", (("view", view),), round(entry["seconds"], 6)))
+        histogram.append(("_count", (("view", view),), entry["count"]))
+    family("letters_http_request_duration_seconds", "histogram", "Wall time per request.", histogram)
+
+    for name, key, help_text in (
+        ("letters_http_db_queries_total", "queries", "Database queries run."),
+        ("letters_http_db_seconds_total", "db_seconds", "Time spent in database queries."),
+        ("letters_http_template_seconds_total", "template_seconds", "Time spent rendering templates."),
+        ("letters_http_response_bytes_total", "response_bytes", "Bytes of non-streaming response bodies."),
+        ("letters_http_query_budget_exceeded_total", "over_budget", "Requests over the query budget."),
+    ):
+        family(name, "counter", help_text, [
+            ("", (("view", view),), round(entry[key], 6) if isinstance(entry[key], float) else entry[key])
+            for view, entry in views
+        ])
+
+    pages = caching.stats()
+    for outcome in ("hits", "misses"):
+        family(
+            f"letters_page_cache_{outcome}_total", "counter", f"Page cache {outcome}.",
+            [("", (("page", page),), counts[outcome]) for page, counts in pages.items()],
+        )
+    family(
+        "letters_table_rows", "gauge", "Rows in the letter tables and the archive.",
+        [("", (("table", table),), rows) for table, rows in sorted(archive.table_rows().items())],
+    )
+    return "\n".join(lines) + "\n"
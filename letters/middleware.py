@@ -0,0 +1,155 @@
+import logging
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from whitenoise.middleware import WhiteNoiseMiddleware
+
+from . import metrics, replicas
+
+logger = logging.getLogger(__name__)
+
+
+class MetricsMiddleware:
+    """
+    Record wall time, queries, template time and response size per view
+    (see ``letters.metrics``), log requests over ``LETTERS_QUERY_BUDGET``
+    queries, and with ``LETTERS_SERVER_TIMING`` set add a ``Server-Timing``
+    header so the numbers show up in the browser's network panel.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.server_timing = getattr(settings, "LETTERS_SERVER_TIMING", False)
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        stats, token = metrics.start()
+        begin = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            metrics.stop(token)
+        return self.finish(request, response, stats, time.perf_counter() - begin)
+
+    async def __acall__(self, request):
+        stats, token = metrics.start()
+        begin = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            metrics.stop(token)
+        return self.finish(request, response, stats, time.perf_counter() - begin)
+
+    def finish(self, request, response, stats, seconds):
+        match = getattr(request, "resolver_match", None)
+        view = (match.view_name or match._func_path) if match else "unresolved"
+        budget = metrics.query_budget()
+        over_budget = budget is not None and stats.queries > budget
+        if over_budget:
+            logger.warning(
+                "%s %s ran %d queries (budget %d) in %.1f ms",
+                request.method, request.path, stats.queries, budget, stats.db_seconds * 1000,
+            )
+        size = 0 if response.streaming else len(response.content)
+        metrics.registry.observe(view, response.status_code, seconds, stats, size, over_budget)
+
+        if self.server_timing:
+            response["Server-Timing"] = (
+                f'db;dur={stats.db_seconds * 1000:.1f};desc="{stats.queries} queries", '
+                f"tpl;dur={stats.template_seconds * 1000:.1f}, "
+                f"total;dur={seconds * 1000:.1f}"
+            )
+        return response
+
+
+class ReplicaRoutingMiddleware:
+    """
+    Send the reads of GET and HEAD requests to a read replica, unless the
+    user wrote recently; see ``letters.replicas``. Not used when no
+    replicas are configured.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not replicas.replica_aliases():
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        routing, token = replicas.start(self.replica_for(request))
+        try:
+            response = self.get_response(request)
+        finally:
+            replicas.stop(token)
+        return self.finish(request, response, routing)
+
+    async def __acall__(self, request):
+        routing, token = replicas.start(self.replica_for(request))
+        try:
+            response = await self.get_response(request)
+        finally:
+            replicas.stop(token)
+        return self.finish(request, response, routing)
+
+    def replica_for(self, request):
+        if request.method not in ("GET", "HEAD"):
+            return None
+        try:
+            if float(request.COOKIES.get(replicas.COOKIE_NAME, 0)) > time.time():
+                return None
+        except ValueError:
+            pass
+        return replicas.choose()
+
+    def finish(self, request, response, routing):
+        if routing.wrote or request.method not in ("GET", "HEAD"):
+            seconds = replicas.sticky_seconds()
+            response.set_cookie(
+                replicas.COOKIE_NAME, f"{time.time() + seconds:.0f}", max_age=seconds,
+                httponly=True, samesite="Lax",
+            )
+        return response
+
+
+class StaticFilesMiddleware(WhiteNoiseMiddleware):
+    """
+    WhiteNoise, able to run in an async middleware chain. WhiteNoise's own
+    middleware is sync-only, and one sync middleware makes Django hand
+    every request under ASGI across to a thread and back, async views or not.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response=None, *args, **kwargs):
+        super().__init__(get_response, *args, **kwargs)
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        if self.autorefresh:
+            static_file = self.find_file(request.path_info)
+        else:
+            static_file = self.files.get(request.path_info)
+        if static_file is not None:
+            return self.serve(static_file, request)
+        return await self.get_response(request)
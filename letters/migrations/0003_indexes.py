@@ -0,0 +1,48 @@
+# Generated by Django 5.2.8 on 2026-10-18 12:24
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('letters', '0002_alter_userconnection_unique_together_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='letterversion',
+            name='approved',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddIndex(
+            model_name='connection',
+            index=models.Index(fields=['requester', 'accepted'], name='conn_requester_accepted_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='connection',
+            index=models.Index(fields=['receiver', 'accepted'], name='conn_receiver_accepted_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='connection',
+            index=models.Index(condition=models.Q(('accepted', False)), fields=['receiver'], name='conn_pending_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='letter',
+            index=models.Index(fields=['sender', 'receiver', 'created_at', 'id'], name='letter_pair_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='letterversion',
+            index=models.Index(fields=['letter', 'approved', 'created_at'], name='version_letter_approved_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='letterversion',
+            index=models.Index(fields=['letter', 'created_at', 'id'], name='version_letter_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='letterversion',
+            index=models.Index(condition=models.Q(('approved', False)), fields=['letter'], name='version_pending_idx'),
+        ),
+    ]
@@ -0,0 +1,68 @@
+# Generated by Django 5.2.8 on 2026-10-18 12:26
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Q
+
+
+def backfill_summaries(apps, schema_editor):
+    Connection = apps.get_model('letters', 'Connection')
+    ContactSummary = apps.get_model('letters', 'ContactSummary')
+    Letter = apps.get_model('letters', 'Letter')
+    LetterVersion = apps.get_model('letters', 'LetterVersion')
+
+    for conn in Connection.objects.order_by('accepted', 'id').iterator():
+        pairs = [(conn.receiver_id, conn.requester_id)]
+        if conn.accepted:
+            pairs.append((conn.requester_id, conn.receiver_id))
+
+        for owner_id, contact_id in pairs:
+            last_letter_at = Letter.objects.filter(
+                Q(sender_id=owner_id, receiver_id=contact_id) |
+                Q(sender_id=contact_id, receiver_id=owner_id)
+            ).order_by('-created_at').values_list('created_at', flat=True).first()
+            pending = LetterVersion.objects.filter(
+                letter__sender_id=owner_id,
+                letter__receiver_id=contact_id,
+                approved=False,
+            ).count()
+            ContactSummary.objects.update_or_create(
+                owner_id=owner_id,
+                contact_id=contact_id,
+                defaults={
+                    'connection_id': conn.id,
+                    'accepted': conn.accepted,
+                    'last_letter_at': last_letter_at,
+                    'pending_approval_count': pending,
+                },
+            )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('letters', '0003_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContactSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('accepted', models.BooleanField(default=False)),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('pending_approval_count', models.PositiveIntegerField(default=0)),
+                ('last_letter_at', models.DateTimeField(blank=True, null=True)),
+                ('connection', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='summaries', to='letters.connection')),
+                ('contact', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='contact_summaries', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['owner', '-last_letter_at'], name='summary_owner_recent_idx')],
+                'constraints': [models.UniqueConstraint(fields=('owner', 'contact'), name='summary_owner_contact_uniq')],
+            },
+        ),
+        migrations.RunPython(backfill_summaries, migrations.RunPython.noop),
+    ]
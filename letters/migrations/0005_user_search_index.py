@@ -0,0 +1,71 @@
+from django.db import migrations
+
+
+SQLITE_FORWARD = [
+    # External-content FTS5 table over auth_user.username; the trigram
+    # tokenizer lets MATCH serve substring as well as prefix queries.
+    """
+    CREATE VIRTUAL TABLE letters_user_fts USING fts5(
+        username, content='auth_user', content_rowid='id', tokenize='trigram'
+    )
+    """,
+    """
+    CREATE TRIGGER letters_user_fts_ai AFTER INSERT ON auth_user BEGIN
+        INSERT INTO letters_user_fts(rowid, username) VALUES (new.id, new.username);
+    END
+    """,
+    """
+    CREATE TRIGGER letters_user_fts_ad AFTER DELETE ON auth_user BEGIN
+        INSERT INTO letters_user_fts(letters_user_fts, rowid, username)
+        VALUES ('delete', old.id, old.username);
+    END
+    """,
+    """
+    CREATE TRIGGER letters_user_fts_au AFTER UPDATE OF username ON auth_user BEGIN
+        INSERT INTO letters_user_fts(letters_user_fts, rowid, username)
+        VALUES ('delete', old.id, old.username);
+        INSERT INTO letters_user_fts(rowid, username) VALUES (new.id, new.username);
+    END
+    """,
+    "INSERT INTO letters_user_fts(letters_user_fts) VALUES ('rebuild')",
+]
+
+SQLITE_REVERSE = [
+    "DROP TRIGGER IF EXISTS letters_user_fts_ai",
+    "DROP TRIGGER IF EXISTS letters_user_fts_ad",
+    "DROP TRIGGER IF EXISTS letters_user_fts_au",
+    "DROP TABLE IF EXISTS letters_user_fts",
+]
+
+POSTGRES_FORWARD = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS letters_user_username_trgm "
+    "ON auth_user USING gin (username gin_trgm_ops)",
+]
+
+POSTGRES_REVERSE = [
+    "DROP INDEX IF EXISTS letters_user_username_trgm",
+]
+
+
+def run(statements):
+    def apply(apps, schema_editor):
+        vendor = schema_editor.connection.vendor
+        for sql in statements.get(vendor, ()):
+            schema_editor.execute(sql)
+    return apply
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('letters', '0004_contactsummary'),
+        ('auth', '0012_alter_user_first_name_max_length'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run({'sqlite': SQLITE_FORWARD, 'postgresql': POSTGRES_FORWARD}),
+            run({'sqlite': SQLITE_REVERSE, 'postgresql': POSTGRES_REVERSE}),
+        ),
+    ]
@@ -0,0 +1,69 @@
+from django.db import migrations
+
+
+SQLITE_FORWARD = [
+    # Contentless: the text lives in letters_letterversion, the index only
+    # needs the tokens. "participants" holds "u<sender_id> u<receiver_id>".
+    """
+    CREATE VIRTUAL TABLE letters_version_fts USING fts5(
+        body, participants, content='', tokenize='porter unicode61'
+    )
+    """,
+    """
+    INSERT INTO letters_version_fts (rowid, body, participants)
+    SELECT v.id, v.content, 'u' || l.sender_id || ' u' || l.receiver_id
+    FROM letters_letterversion v JOIN letters_letter l ON l.id = v.letter_id
+    WHERE v.approved
+    """,
+]
+
+SQLITE_REVERSE = [
+    "DROP TABLE IF EXISTS letters_version_fts",
+]
+
+POSTGRES_FORWARD = [
+    """
+    CREATE TABLE letters_version_search (
+        version_id bigint PRIMARY KEY
+            REFERENCES letters_letterversion (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED,
+        sender_id integer NOT NULL,
+        receiver_id integer NOT NULL,
+        document tsvector NOT NULL
+    )
+    """,
+    "CREATE INDEX letters_version_search_doc ON letters_version_search USING gin (document)",
+    "CREATE INDEX letters_version_search_sender ON letters_version_search (sender_id)",
+    "CREATE INDEX letters_version_search_receiver ON letters_version_search (receiver_id)",
+    """
+    INSERT INTO letters_version_search (version_id, sender_id, receiver_id, document)
+    SELECT v.id, l.sender_id, l.receiver_id, to_tsvector('english', v.content)
+    FROM letters_letterversion v JOIN letters_letter l ON l.id = v.letter_id
+    WHERE v.approved
+    """,
+]
+
+POSTGRES_REVERSE = [
+    "DROP TABLE IF EXISTS letters_version_search",
+]
+
+
+def run(statements):
+    def apply(apps, schema_editor):
+        vendor = schema_editor.connection.vendor
+        for sql in statements.get(vendor, ()):
+            schema_editor.execute(sql)
+    return apply
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('letters', '0005_user_search_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run({'sqlite': SQLITE_FORWARD, 'postgresql': POSTGRES_FORWARD}),
+            run({'sqlite': SQLITE_REVERSE, 'postgresql': POSTGRES_REVERSE}),
+        ),
+    ]
@@ -0,0 +1,93 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+from letters.delta import apply_delta, compress
+
+
+def compress_history(apps, schema_editor):
+    LetterVersion = apps.get_model('letters', 'LetterVersion')
+
+    versions = LetterVersion.objects.order_by('letter_id', 'created_at', 'id').only(
+        'letter_id', 'stored_content', 'approved'
+    )
+    letter_id = None
+    for version in versions.iterator(chunk_size=2000):
+        if version.letter_id != letter_id:
+            letter_id = version.letter_id
+            # (id, text, depth, base_id) of the latest and latest approved versions.
+            latest = latest_approved = None
+
+        text = version.stored_content
+        parent = latest_approved or latest
+        depth, base_id = 0, None
+        if parent is not None:
+            delta = compress(parent[1], parent[2], text)
+            if delta is not None:
+                depth, base_id = parent[2] + 1, parent[3] or parent[0]
+                LetterVersion.objects.filter(pk=version.pk).update(
+                    stored_content=delta,
+                    delta_parent_id=parent[0],
+                    delta_base_id=base_id,
+                    delta_depth=depth,
+                )
+
+        latest = (version.pk, text, depth, base_id)
+        if version.approved:
+            latest_approved = latest
+
+
+def expand_history(apps, schema_editor):
+    LetterVersion = apps.get_model('letters', 'LetterVersion')
+
+    texts = {}
+    versions = LetterVersion.objects.order_by('letter_id', 'created_at', 'id')
+    for version in versions.iterator(chunk_size=2000):
+        text = version.stored_content
+        if version.delta_parent_id is not None:
+            text = apply_delta(texts[version.delta_parent_id], text)
+            LetterVersion.objects.filter(pk=version.pk).update(
+                stored_content=text, delta_parent_id=None, delta_base_id=None, delta_depth=0
+            )
+        texts[version.pk] = text
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('letters', '0006_letter_search_index'),
+    ]
+
+    operations = [
+        # Same column, new attribute name: ``content`` is now a property
+        # that rebuilds the text from the delta chain.
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.RenameField(
+                    model_name='letterversion',
+                    old_name='content',
+                    new_name='stored_content',
+                ),
+                migrations.AlterField(
+                    model_name='letterversion',
+                    name='stored_content',
+                    field=models.TextField(db_column='content'),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name='letterversion',
+            name='delta_base',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='letters.letterversion'),
+        ),
+        migrations.AddField(
+            model_name='letterversion',
+            name='delta_parent',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='letters.letterversion'),
+        ),
+        migrations.AddField(
+            model_name='letterversion',
+            name='delta_depth',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.RunPython(compress_history, expand_history),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.8 on 2026-10-18 12:45
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('letters', '0007_delta_version_storage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='letter',
+            name='current_version',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='letters.letterversion'),
+        ),
+        migrations.AddField(
+            model_name='letter',
+            name='preview',
+            field=models.CharField(blank=True, max_length=200),
+        ),
+        # Point every letter at its latest approved version. Previews need
+        # the rebuilt text, so `manage.py backfill_current_versions` fills
+        # them in afterwards.
+        migrations.RunSQL(
+            """
+            UPDATE letters_letter SET current_version_id = (
+                SELECT v.id FROM letters_letterversion v
+                WHERE v.letter_id = letters_letter.id AND v.approved
+                ORDER BY v.created_at DESC, v.id DESC
+                LIMIT 1
+            )
+            """,
+            migrations.RunSQL.noop,
+        ),
+    ]
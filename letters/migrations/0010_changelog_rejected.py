@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-18 12:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('letters', '0009_changelog'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='changelogentry',
+            name='action',
+            field=models.CharField(choices=[('created', 'Created'), ('approved', 'Approved'), ('accepted', 'Accepted'), ('rejected', 'Rejected')], max_length=16),
+        ),
+    ]
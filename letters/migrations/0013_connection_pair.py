@@ -0,0 +1,74 @@
+# Generated by Django 5.2.8 on 2026-10-18 14:10
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F
+
+
+def merge_duplicates(apps, schema_editor):
+    """
+    Keep one connection per pair of users: an accepted one if there is
+    any, else the oldest. Requests sent both ways are taken as accepted.
+    Summaries of dropped rows are moved to the kept one; rows connecting a
+    user to themself are removed.
+    """
+    Connection = apps.get_model('letters', 'Connection')
+    ContactSummary = apps.get_model('letters', 'ContactSummary')
+
+    Connection.objects.filter(requester_id=F('receiver_id')).delete()
+
+    kept, dropped, accepted = {}, {}, set()
+    for conn in Connection.objects.order_by('-accepted', 'id').only('requester_id', 'receiver_id', 'accepted'):
+        pair = (min(conn.requester_id, conn.receiver_id), max(conn.requester_id, conn.receiver_id))
+        first = kept.setdefault(pair, conn)
+        if first is conn:
+            continue
+        dropped.setdefault(first.id, []).append(conn.id)
+        if first.accepted or conn.requester_id != first.requester_id:
+            accepted.add(pair)
+
+    for kept_id, ids in dropped.items():
+        ContactSummary.objects.filter(connection_id__in=ids).update(connection_id=kept_id)
+        Connection.objects.filter(id__in=ids).delete()
+
+    # Merged pairs that end up accepted need both summaries, accepted.
+    for pair in accepted:
+        conn = kept[pair]
+        Connection.objects.filter(pk=conn.pk).update(accepted=True)
+        for owner_id, contact_id in (pair, pair[::-1]):
+            ContactSummary.objects.update_or_create(
+                owner_id=owner_id, contact_id=contact_id,
+                defaults={'connection_id': conn.pk, 'accepted': True},
+            )
+
+    Connection.objects.filter(requester_id__lt=F('receiver_id')).update(
+        user_low_id=F('requester_id'), user_high_id=F('receiver_id')
+    )
+    Connection.objects.filter(requester_id__gt=F('receiver_id')).update(
+        user_low_id=F('receiver_id'), user_high_id=F('requester_id')
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('letters', '0012_import_checkpoint'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    # The columns become required and unique in 0014: Postgres will not
+    # alter a table with row updates still pending in the same transaction.
+    operations = [
+        migrations.AddField(
+            model_name='connection',
+            name='user_low',
+            field=models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='connection',
+            name='user_high',
+            field=models.ForeignKey(editable=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunPython(merge_duplicates, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('letters', '0014_connection_pair_constraints'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedLetter',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('created_at', models.DateTimeField()),
+                ('preview', models.CharField(blank=True, max_length=200)),
+                ('whole', models.BooleanField(default=False)),
+                ('versions', models.BinaryField()),
+                ('version_count', models.PositiveIntegerField(default=0)),
+                ('text_bytes', models.PositiveBigIntegerField(default=0)),
+                ('archived_at', models.DateTimeField(auto_now=True)),
+                ('receiver', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('sender', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(condition=models.Q(('whole', True)), fields=['sender', 'receiver', 'created_at', 'id'], name='archived_pair_created_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,74 @@
+from collections import Counter, defaultdict
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def backfill(apps, schema_editor):
+    """The counts ``letters.stats`` keeps from now on, for the letters already there."""
+    User = apps.get_model("auth", "User")
+    Letter = apps.get_model("letters", "Letter")
+    ArchivedLetter = apps.get_model("letters", "ArchivedLetter")
+    LetterVersion = apps.get_model("letters", "LetterVersion")
+    Connection = apps.get_model("letters", "Connection")
+    ContactSummary = apps.get_model("letters", "ContactSummary")
+    UserStats = apps.get_model("letters", "UserStats")
+
+    totals = defaultdict(Counter)
+    pairs = Counter()
+    for letters in (Letter.objects.all(), ArchivedLetter.objects.filter(whole=True)):
+        for row in letters.values("sender_id", "receiver_id").annotate(n=Count("pk")).order_by():
+            sender_id, receiver_id, n = row["sender_id"], row["receiver_id"], row["n"]
+            totals[sender_id]["letters_sent"] += n
+            totals[receiver_id]["letters_received"] += n
+            pairs[sender_id, receiver_id] += n
+            pairs[receiver_id, sender_id] += n
+    for row in LetterVersion.objects.filter(approved=False).values(
+        "letter__sender_id", "letter__receiver_id"
+    ).annotate(n=Count("pk")).order_by():
+        totals[row["letter__sender_id"]]["pending_approvals"] += row["n"]
+        totals[row["letter__receiver_id"]]["pending_proposals"] += row["n"]
+    for side in ("user_low_id", "user_high_id"):
+        for row in Connection.objects.filter(accepted=True).values(side).annotate(n=Count("pk")).order_by():
+            totals[row[side]]["contacts"] += row["n"]
+
+    UserStats.objects.bulk_create(
+        (UserStats(user_id=user_id, **totals[user_id]) for user_id in User.objects.values_list("id", flat=True).iterator()),
+        batch_size=1000,
+    )
+    summaries = []
+    for summary in ContactSummary.objects.only("owner_id", "contact_id").iterator():
+        summary.letter_count = pairs[summary.owner_id, summary.contact_id]
+        if summary.letter_count:
+            summaries.append(summary)
+    ContactSummary.objects.bulk_update(summaries, ["letter_count"], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('letters', '0015_archived_letter'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='contactsummary',
+            name='letter_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='UserStats',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('letters_sent', models.PositiveIntegerField(default=0)),
+                ('letters_received', models.PositiveIntegerField(default=0)),
+                ('pending_approvals', models.PositiveIntegerField(default=0)),
+                ('pending_proposals', models.PositiveIntegerField(default=0)),
+                ('contacts', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
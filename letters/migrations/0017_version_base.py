@@ -0,0 +1,28 @@
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def backfill(apps, schema_editor):
+    """Open proposals were made against the text that is current now, as far as anyone can tell."""
+    Letter = apps.get_model("letters", "Letter")
+    LetterVersion = apps.get_model("letters", "LetterVersion")
+    LetterVersion.objects.filter(approved=False).update(
+        base_version_id=Subquery(Letter.objects.filter(pk=OuterRef("letter_id")).values("current_version_id")[:1])
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('letters', '0016_user_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='letterversion',
+            name='base_version',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='letters.letterversion'),
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+from django.db import migrations
+
+
+# Serves SQLiteFTSUserSearch's case-insensitive prefix pass, a range scan
+# over lower(username).
+SQLITE_FORWARD = [
+    "CREATE INDEX IF NOT EXISTS letters_user_username_lower ON auth_user (lower(username))",
+]
+
+SQLITE_REVERSE = [
+    "DROP INDEX IF EXISTS letters_user_username_lower",
+]
+
+
+def run(statements):
+    def apply(apps, schema_editor):
+        vendor = schema_editor.connection.vendor
+        for sql in statements.get(vendor, ()):
+            schema_editor.execute(sql)
+    return apply
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('letters', '0017_version_base'),
+        ('auth', '0012_alter_user_first_name_max_length'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run({'sqlite': SQLITE_FORWARD}),
+            run({'sqlite': SQLITE_REVERSE}),
+        ),
+    ]
@@ -0,0 +1,49 @@
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def backfill(apps, schema_editor):
+    Letter = apps.get_model("letters", "Letter")
+    LetterVersion = apps.get_model("letters", "LetterVersion")
+    LetterVersion.objects.filter(approved=False).update(
+        approver_id=Subquery(Letter.objects.filter(pk=OuterRef("letter_id")).values("sender_id")[:1])
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('letters', '0018_user_search_lower_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='letterversion',
+            name='approver',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='letterversion',
+            index=models.Index(condition=models.Q(('approved', False)), fields=['approver', 'created_at', 'id'], name='version_approver_pending_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='letter',
+            index=models.Index(fields=['sender', 'created_at', 'id'], name='letter_sender_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='letter',
+            index=models.Index(fields=['receiver', 'created_at', 'id'], name='letter_receiver_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedletter',
+            index=models.Index(condition=models.Q(('whole', True)), fields=['sender', 'created_at', 'id'], name='archived_sender_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedletter',
+            index=models.Index(condition=models.Q(('whole', True)), fields=['receiver', 'created_at', 'id'], name='archived_receiver_created_idx'),
+        ),
+    ]
@@ -1,33 +1,460 @@
+import json
+import zlib
+
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.functional import cached_property
+
+from .delta import apply_delta, compress
+
+PREVIEW_LENGTH = 200
+
+class ConnectionManager(models.Manager):
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        for conn in objs:
+            conn.set_pair()
+        return super().bulk_create(objs, *args, **kwargs)
+
+    def between(self, a_id, b_id):
+        """The connection of two users, whichever of them asked."""
+        return self.filter(user_low_id=min(a_id, b_id), user_high_id=max(a_id, b_id))
+
 
 class Connection(models.Model):
     requester = models.ForeignKey(User, related_name="sent_requests", on_delete=models.CASCADE)
     receiver = models.ForeignKey(User, related_name="received_requests", on_delete=models.CASCADE)
+    # The same two users in id order, so a pair has one row whoever asked.
+    user_low = models.ForeignKey(User, related_name="+", on_delete=models.CASCADE, editable=False)
+    user_high = models.ForeignKey(User, related_name="+", on_delete=models.CASCADE, editable=False)
     accepted = models.BooleanField(default=False)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    objects = ConnectionManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user_low", "user_high"], name="conn_pair_uniq"),
+            models.CheckConstraint(condition=models.Q(user_low__lt=models.F("user_high")), name="conn_pair_ordered"),
+        ]
+        indexes = [
+            models.Index(fields=["requester", "accepted"], name="conn_requester_accepted_idx"),
+            models.Index(fields=["receiver", "accepted"], name="conn_receiver_accepted_idx"),
+            # Only unanswered requests are looked up by receiver on every dashboard hit.
+            models.Index(fields=["receiver"], condition=models.Q(accepted=False), name="conn_pending_idx"),
+            # With conn_pair_uniq, finds a user's connections from either side.
+            models.Index(fields=["user_high"], name="conn_user_high_idx"),
+        ]
+
     def __str__(self):
         return f"{self.requester} -> {self.receiver}"
 
+    def set_pair(self):
+        self.user_low_id, self.user_high_id = sorted((self.requester_id, self.receiver_id))
+
+    def save(self, *args, **kwargs):
+        self.set_pair()
+        super().save(*args, **kwargs)
+
 
 class Letter(models.Model):
     sender = models.ForeignKey(User, related_name="sent_letters", on_delete=models.CASCADE)
     receiver = models.ForeignKey(User, related_name="received_letters", on_delete=models.CASCADE)
-    created_at = models.DateTimeField(auto_now_add=True)
+    # A default rather than auto_now_add so imports can keep original dates.
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
+    # The most recently approved version and the start of its text, kept in
+    # step by letters.services so lists never walk the versions relation.
+    current_version = models.ForeignKey(
+        "LetterVersion", null=True, blank=True, on_delete=models.SET_NULL, related_name="+"
+    )
+    preview = models.CharField(max_length=PREVIEW_LENGTH, blank=True)
+
+    # ArchivedLetter stands in for letters moved out of this table.
+    archived = False
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["sender", "receiver", "created_at", "id"], name="letter_pair_created_idx"),
+            models.Index(fields=["sender", "created_at", "id"], name="letter_sender_created_idx"),
+            models.Index(fields=["receiver", "created_at", "id"], name="letter_receiver_created_idx"),
+        ]
 
     def __str__(self):
         return f"Letter {self.id}"
 
+    def set_current(self, version):
+        self.current_version = version
+        self.preview = make_preview(version.content)
+
+
+def make_preview(text):
+    text = " ".join(text.split())
+    if len(text) <= PREVIEW_LENGTH:
+        return text
+    return text[:PREVIEW_LENGTH - 1].rstrip() + "…"
+
+
+class LetterVersionManager(models.Manager):
+    def fill_content(self, versions):
+        """
+        Rebuild ``content`` for many versions with one query for all the
+        delta chains involved, instead of one query per version.
+        """
+        pending = [v for v in versions if "_content" not in v.__dict__ and v.delta_base_id]
+        for v in versions:
+            if "_content" not in v.__dict__ and not v.delta_base_id:
+                v._content = v.stored_content
+        if not pending:
+            return versions
+
+        bases = {v.delta_base_id for v in pending}
+        rows = self.filter(
+            models.Q(id__in=bases) | models.Q(delta_base_id__in=bases)
+        ).only("stored_content", "delta_parent")
+        by_id = {row.id: row for row in rows}
+        texts = {}
+
+        def text_of(pk):
+            if pk not in texts:
+                row = by_id[pk]
+                if row.delta_parent_id is None:
+                    texts[pk] = row.stored_content
+                else:
+                    texts[pk] = apply_delta(text_of(row.delta_parent_id), row.stored_content)
+            return texts[pk]
+
+        for v in pending:
+            v._content = text_of(v.id)
+        return versions
+
 
 class LetterVersion(models.Model):
     letter = models.ForeignKey(Letter, on_delete=models.CASCADE, related_name="versions")
-    content = models.TextField()
-    created_at = models.DateTimeField(auto_now_add=True)
+    # Either the full text (a snapshot) or a delta against delta_parent;
+    # read it through ``content``.
+    stored_content = models.TextField(db_column="content")
+    # The snapshot this version's delta chain starts from, and the version
+    # the delta applies to. Both are null for snapshots.
+    delta_base = models.ForeignKey("self", null=True, blank=True, on_delete=models.CASCADE, related_name="+")
+    delta_parent = models.ForeignKey("self", null=True, blank=True, on_delete=models.CASCADE, related_name="+")
+    delta_depth = models.PositiveSmallIntegerField(default=0)
+    # For a proposal, the letter's current version when it was made. It is
+    # only compared with ``Letter.current_version`` on approval, so a
+    # deleted or archived base needs no cleanup and no constraint.
+    base_version = models.ForeignKey(
+        "self", null=True, blank=True, on_delete=models.DO_NOTHING, db_constraint=False, related_name="+"
+    )
+    # For a proposal, the letter's sender, who approves or rejects it. A
+    # copy, so the approvals page reads a user's open proposals off one
+    # index instead of walking every letter they sent.
+    approver = models.ForeignKey(
+        User, null=True, blank=True, on_delete=models.CASCADE, related_name="+"
+    )
+    created_at = models.DateTimeField(default=timezone.now, editable=False)
     approved = models.BooleanField(default=False)
-    
+
+    archived = False
+
+    objects = LetterVersionManager()
+
     class Meta:
         ordering = ["created_at"]
+        indexes = [
+            models.Index(fields=["letter", "approved", "created_at"], name="version_letter_approved_idx"),
+            models.Index(fields=["letter", "created_at", "id"], name="version_letter_created_idx"),
+            models.Index(fields=["letter"], condition=models.Q(approved=False), name="version_pending_idx"),
+            models.Index(
+                fields=["approver", "created_at", "id"],
+                condition=models.Q(approved=False), name="version_approver_pending_idx",
+            ),
+        ]
+
+    def __str__(self):
+        return f"Version {self.id} (Letter {self.letter_id})"
+
+    @property
+    def content(self):
+        if "_content" not in self.__dict__:
+            LetterVersion.objects.fill_content([self])
+        return self._content
+
+    @content.setter
+    def content(self, value):
+        self._content = value
+        self.stored_content = value
+        self.delta_base = self.delta_parent = None
+        self.delta_depth = 0
+
+    def save(self, *args, **kwargs):
+        if self._state.adding and self.delta_parent_id is None and "_content" in self.__dict__:
+            self.store_as_delta()
+        super().save(*args, **kwargs)
+
+    def store_as_delta(self):
+        """
+        Store this new version as a delta against the letter's current text
+        if that is smaller. Only approved versions are diffed against: a
+        proposal may be rejected and deleted, and its deltas with it.
+        """
+        parent = None
+        if self.letter.current_version_id:
+            parent = LetterVersion.objects.filter(pk=self.letter.current_version_id, approved=True).first()
+        if parent is None:
+            parent = LetterVersion.objects.filter(letter_id=self.letter_id, approved=True).order_by(
+                "-created_at", "-id"
+            ).first()
+        if parent is None:
+            return
+        delta = compress(parent.content, parent.delta_depth, self._content)
+        if delta is not None:
+            self.stored_content = delta
+            self.delta_parent = parent
+            self.delta_base_id = parent.delta_base_id or parent.id
+            self.delta_depth = parent.delta_depth + 1
+
+
+class ArchivedVersion:
+    """A version read back from ``ArchivedLetter``, shaped like ``LetterVersion``."""
+
+    __slots__ = ("id", "created_at", "approved", "current", "content")
+    archived = True
+
+    def __init__(self, id, created_at, approved, current, content):
+        self.id = id
+        self.created_at = created_at
+        self.approved = approved
+        self.current = current
+        self.content = content
+
+    @property
+    def pk(self):
+        return self.id
+
+
+def pack_versions(versions):
+    """``ArchivedVersion``s as zlib-compressed JSON, compressed together so shared text costs little."""
+    rows = [[v.id, v.created_at.isoformat(), v.approved, v.current, v.content] for v in versions]
+    return zlib.compress(json.dumps(rows, ensure_ascii=False).encode(), 9)
+
+
+def unpack_versions(data):
+    return [
+        ArchivedVersion(pk, parse_datetime(created_at), approved, current, content)
+        for pk, created_at, approved, current, content in json.loads(zlib.decompress(data))
+    ]
+
+
+class ArchivedLetter(models.Model):
+    # Written by ``manage.py archive_letters`` (letters.archive). With
+    # ``whole`` set the letter has left Letter/LetterVersion and this row,
+    # under the same id, stands in for it; otherwise the letter is still
+    # live and only its superseded versions are kept here.
+    id = models.BigIntegerField(primary_key=True)
+    sender = models.ForeignKey(User, related_name="+", on_delete=models.CASCADE)
+    receiver = models.ForeignKey(User, related_name="+", on_delete=models.CASCADE)
+    created_at = models.DateTimeField()
+    preview = models.CharField(max_length=PREVIEW_LENGTH, blank=True)
+    whole = models.BooleanField(default=False)
+    # pack_versions() of the archived versions, oldest first.
+    versions = models.BinaryField()
+    version_count = models.PositiveIntegerField(default=0)
+    # Size of the version texts before compression.
+    text_bytes = models.PositiveBigIntegerField(default=0)
+    archived_at = models.DateTimeField(auto_now=True)
+
+    archived = True
+    # Only letters with no proposal open are archived, and they stay read-only.
+    has_pending = False
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["sender", "receiver", "created_at", "id"],
+                condition=models.Q(whole=True), name="archived_pair_created_idx",
+            ),
+            models.Index(
+                fields=["sender", "created_at", "id"],
+                condition=models.Q(whole=True), name="archived_sender_created_idx",
+            ),
+            models.Index(
+                fields=["receiver", "created_at", "id"],
+                condition=models.Q(whole=True), name="archived_receiver_created_idx",
+            ),
+        ]
+
+    def __str__(self):
+        return f"Archived letter {self.id}"
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        # PostgreSQL hands BinaryField values back as memoryviews, which the
+        # page cache cannot pickle.
+        if isinstance(state.get("versions"), memoryview):
+            state["versions"] = bytes(state["versions"])
+        return state
+
+    @cached_property
+    def history(self):
+        return unpack_versions(self.versions)
+
+    @property
+    def current_version(self):
+        return next((v for v in reversed(self.history) if v.current), None)
+
+    @property
+    def current_version_id(self):
+        version = self.current_version
+        return version.id if version else None
+
+
+class ContactSummary(models.Model):
+    # One row per (owner, contact) pair, kept up to date by letters.services
+    # so the dashboard renders from a single indexed read.
+    owner = models.ForeignKey(User, related_name="contact_summaries", on_delete=models.CASCADE)
+    contact = models.ForeignKey(User, related_name="+", on_delete=models.CASCADE)
+    connection = models.ForeignKey(Connection, related_name="summaries", on_delete=models.CASCADE)
+    accepted = models.BooleanField(default=False)
+    unread_count = models.PositiveIntegerField(default=0)
+    pending_approval_count = models.PositiveIntegerField(default=0)
+    # Letters either way between the two, archived ones included.
+    letter_count = models.PositiveIntegerField(default=0)
+    last_letter_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["owner", "contact"], name="summary_owner_contact_uniq"),
+        ]
+        indexes = [
+            models.Index(fields=["owner", "-last_letter_at"], name="summary_owner_recent_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.owner} / {self.contact}"
+
+
+class UserStats(models.Model):
+    # Running totals for the dashboard, added to by letters.stats in the
+    # same transaction as each write; ``manage.py reconcile_stats``
+    # recounts them from the letters if they ever drift.
+    user = models.OneToOneField(User, primary_key=True, related_name="stats", on_delete=models.CASCADE)
+    letters_sent = models.PositiveIntegerField(default=0)
+    letters_received = models.PositiveIntegerField(default=0)
+    # Proposals on the user's letters waiting for them to answer.
+    pending_approvals = models.PositiveIntegerField(default=0)
+    # The user's own proposals waiting for the sender.
+    pending_proposals = models.PositiveIntegerField(default=0)
+    contacts = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"Stats for {self.user_id}"
+
+
+class ChangeLogEntry(models.Model):
+    # Written by letters.services in the same transaction as the change, one
+    # row per user who can see it, so a client's feed is a range scan on
+    # (user, id) and the id doubles as the sync cursor.
+    LETTER = "letter"
+    VERSION = "version"
+    CONNECTION = "connection"
+    KIND_CHOICES = [
+        (LETTER, "Letter"),
+        (VERSION, "Letter version"),
+        (CONNECTION, "Connection"),
+    ]
+
+    CREATED = "created"
+    APPROVED = "approved"
+    ACCEPTED = "accepted"
+    REJECTED = "rejected"
+    ACTION_CHOICES = [
+        (CREATED, "Created"),
+        (APPROVED, "Approved"),
+        (ACCEPTED, "Accepted"),
+        (REJECTED, "Rejected"),
+    ]
+
+    user = models.ForeignKey(User, related_name="+", on_delete=models.CASCADE)
+    actor = models.ForeignKey(User, null=True, related_name="+", on_delete=models.SET_NULL)
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES)
+    action = models.CharField(max_length=16, choices=ACTION_CHOICES)
+    object_id = models.BigIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "id"], name="changelog_user_id_idx"),
+        ]
+
+    # What the actor did, as shown in the dashboard's activity feed.
+    SUMMARIES = {
+        (LETTER, CREATED): "sent a letter",
+        (VERSION, CREATED): "proposed an edit",
+        (VERSION, APPROVED): "approved an edit",
+        (VERSION, REJECTED): "declined an edit",
+        (CONNECTION, CREATED): "asked to connect",
+        (CONNECTION, ACCEPTED): "accepted a connection",
+    }
+
+    def __str__(self):
+        return f"{self.kind} {self.object_id} {self.action} (for {self.user_id})"
+
+    @property
+    def summary(self):
+        return self.SUMMARIES.get((self.kind, self.action), f"{self.action} a {self.get_kind_display().lower()}")
+
+
+class Task(models.Model):
+    # A unit of deferred work for ``manage.py run_tasks``; see letters.queue.
+    QUEUED = "queued"
+    RUNNING = "running"
+    FAILED = "failed"
+    STATUS_CHOICES = [
+        (QUEUED, "Queued"),
+        (RUNNING, "Running"),
+        (FAILED, "Failed"),
+    ]
+
+    name = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict)
+    # Higher runs first.
+    priority = models.SmallIntegerField(default=0)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=QUEUED)
+    run_at = models.DateTimeField()
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=5)
+    locked_by = models.CharField(max_length=64, blank=True)
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # Workers only ever look for queued work, best first.
+            models.Index(
+                models.F("priority").desc(), "run_at", "id",
+                condition=models.Q(status="queued"), name="task_queued_idx",
+            ),
+            models.Index(
+                fields=["locked_at"], condition=models.Q(status="running"), name="task_running_idx",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.name} #{self.id} ({self.status})"
+
+
+class ImportCheckpoint(models.Model):
+    # How far ``manage.py import_letters`` got through a source; advanced
+    # in the same transaction as each batch, so a rerun resumes exactly.
+    source = models.CharField(max_length=255, unique=True)
+    records = models.PositiveBigIntegerField(default=0)
+    letters = models.PositiveBigIntegerField(default=0)
+    versions = models.PositiveBigIntegerField(default=0)
+    skipped = models.PositiveBigIntegerField(default=0)
+    finished = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
-        return f"Version {self.id} (Letter {self.letter.id})"
+        return f"{self.source}: {self.records} records"
@@ -0,0 +1,162 @@
+import base64
+import json
+
+from django.core.exceptions import BadRequest
+from django.db.models import Q, QuerySet
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+def encode_cursor(created_at, pk):
+    raw = json.dumps([created_at.isoformat(), pk]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(token):
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        created_at, pk = json.loads(raw)
+        created_at = parse_datetime(created_at)
+    except (ValueError, TypeError):
+        raise BadRequest("Invalid cursor")
+    if created_at is None or not isinstance(pk, int):
+        raise BadRequest("Invalid cursor")
+    return created_at, pk
+
+
+def encode_id_cursor(pk):
+    return base64.urlsafe_b64encode(f"id:{pk}".encode()).decode().rstrip("=")
+
+
+def decode_id_cursor(token):
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode()
+        prefix, pk = raw.split(":")
+        pk = int(pk)
+    except ValueError:
+        raise BadRequest("Invalid cursor")
+    if prefix != "id" or pk < 0:
+        raise BadRequest("Invalid cursor")
+    return pk
+
+
+def keyset_page(queryset, cursor=None, page_size=20):
+    """
+    Walk ``queryset`` newest-first on ``(created_at, id)``.
+
+    Returns ``(items, next_cursor)`` where ``next_cursor`` points at the
+    rows older than the last item, or is ``None`` on the final page. The
+    cursor is a position, not an OFFSET, so every page costs the same
+    index range scan however deep into the history it is.
+    """
+    return _cut_page(list(_after(queryset, cursor)[:page_size + 1]), page_size)
+
+
+async def akeyset_page(queryset, cursor=None, page_size=20):
+    """:func:`keyset_page` through the async ORM."""
+    return _cut_page([item async for item in _after(queryset, cursor)[:page_size + 1]], page_size)
+
+
+def merged_keyset_page(sources, cursor=None, page_size=20):
+    """
+    :func:`keyset_page` across several sources in the same order, such as
+    the live and archived letters: querysets, or lists of objects with
+    ``created_at`` and ``pk``. Each is read for at most one page, so a page
+    still costs one bounded range scan per source.
+    """
+    items = []
+    for source in sources:
+        if isinstance(source, QuerySet):
+            items.extend(_after(source, cursor)[:page_size + 1])
+        else:
+            items.extend(_after_items(source, cursor))
+    return _cut_page(_newest(items, page_size + 1), page_size)
+
+
+async def amerged_keyset_page(sources, cursor=None, page_size=20):
+    """:func:`merged_keyset_page` through the async ORM."""
+    items = []
+    for source in sources:
+        if isinstance(source, QuerySet):
+            items.extend([item async for item in _after(source, cursor)[:page_size + 1]])
+        else:
+            items.extend(_after_items(source, cursor))
+    return _cut_page(_newest(items, page_size + 1), page_size)
+
+
+def _position(item):
+    return item.created_at, item.pk
+
+
+def _newest(items, limit):
+    return sorted(items, key=_position, reverse=True)[:limit]
+
+
+def _after_items(items, cursor):
+    if not cursor:
+        return items
+    position = decode_cursor(cursor)
+    return [item for item in items if _position(item) < position]
+
+
+def _after(queryset, cursor):
+    queryset = queryset.order_by("-created_at", "-id")
+    if cursor:
+        created_at, pk = decode_cursor(cursor)
+        # The plain bound lets the index seek to the cursor; the OR alone
+        # is only a filter over every newer row.
+        queryset = queryset.filter(created_at__lte=created_at).filter(
+            Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=pk)
+        )
+    return queryset
+
+
+def _cut_page(items, page_size):
+    next_cursor = None
+    if len(items) > page_size:
+        items = items[:page_size]
+        next_cursor = encode_cursor(items[-1].created_at, items[-1].pk)
+    return items, next_cursor
+
+
+class KeysetPagination(BasePagination):
+    """
+    DRF pagination over :func:`keyset_page`, newest first, or over
+    :func:`merged_keyset_page` with :meth:`paginate_sources`.
+    """
+
+    page_size = 50
+    max_page_size = 200
+    cursor_query_param = "cursor"
+    page_size_query_param = "page_size"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        return self.paginate_sources([queryset], request, view)
+
+    def paginate_sources(self, sources, request, view=None):
+        try:
+            page_size = int(request.query_params.get(self.page_size_query_param, self.page_size))
+        except ValueError:
+            page_size = self.page_size
+        page_size = max(1, min(page_size, self.max_page_size))
+
+        self.request = request
+        try:
+            page, self.next_cursor = merged_keyset_page(
+                sources, request.query_params.get(self.cursor_query_param), page_size
+            )
+        except BadRequest:
+            raise NotFound("Invalid cursor")
+        return page
+
+    def get_next_link(self):
+        if self.next_cursor is None:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.next_cursor)
+
+    def get_paginated_response(self, data):
+        return Response({"next": self.get_next_link(), "results": data})
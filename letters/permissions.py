@@ -1,5 +1,12 @@
 from rest_framework.permissions import BasePermission
 
-class IsSenderOrReceiver(BasePermission): # cite: uploaded:permissions.py
-    def has_object_permission(self, request, view, obj): # cite: uploaded:permissions.py
-        return obj.sender == request.user or obj.receiver == request.user # cite: uploaded:permissions.py
\ No newline at end of file
+class IsSenderOrReceiver(BasePermission):
+    def has_object_permission(self, request, view, obj):
+        # Versions are governed by the letter they belong to.
+        letter = getattr(obj, "letter", obj)
+        return letter.sender_id == request.user.id or letter.receiver_id == request.user.id
+
+
+class IsConnectionParticipant(BasePermission):
+    def has_object_permission(self, request, view, obj):
+        return obj.requester_id == request.user.id or obj.receiver_id == request.user.id
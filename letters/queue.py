@@ -0,0 +1,135 @@
+"""
+A small database-backed task queue.
+
+Functions registered with ``@task`` are queued with ``.enqueue(**payload)``
+(JSON-serialisable keyword arguments) and run by ``manage.py run_tasks``.
+Enqueueing inside a transaction makes the task visible only when the
+transaction commits, so a worker never sees work for rows that were rolled
+back.
+
+Workers claim tasks with ``SELECT ... FOR UPDATE SKIP LOCKED`` where the
+database supports it (Postgres), so concurrent workers never wait on each
+other. Elsewhere (SQLite) a worker marks candidates as running with a
+conditional UPDATE carrying its own token and keeps only the rows it won.
+A handler runs in one transaction with the deletion of its task, so a
+completed task is never run again; a failed one is retried with
+exponential backoff until ``max_attempts``, then kept as ``failed``.
+"""
+import logging
+import traceback
+import uuid
+from datetime import timedelta
+
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Task
+
+logger = logging.getLogger(__name__)
+
+REGISTRY = {}
+
+# Seconds before the first retry; doubled on each further attempt.
+RETRY_DELAY = 5
+MAX_RETRY_DELAY = 60 * 60
+
+
+class TaskFunction:
+    def __init__(self, func, name, priority, max_attempts):
+        self.func = func
+        self.name = name
+        self.priority = priority
+        self.max_attempts = max_attempts
+
+    def __call__(self, **payload):
+        return self.func(**payload)
+
+    def enqueue(self, priority=None, delay=None, **payload):
+        return enqueue(
+            self.name, payload,
+            priority=self.priority if priority is None else priority,
+            max_attempts=self.max_attempts,
+            delay=delay,
+        )
+
+
+def task(name, priority=0, max_attempts=5):
+    def register(func):
+        REGISTRY[name] = TaskFunction(func, name, priority, max_attempts)
+        return REGISTRY[name]
+    return register
+
+
+def enqueue(name, payload, priority=0, max_attempts=5, delay=None):
+    run_at = timezone.now()
+    if delay:
+        run_at += timedelta(seconds=delay)
+    return Task.objects.create(
+        name=name, payload=payload, priority=priority, max_attempts=max_attempts, run_at=run_at
+    )
+
+
+def claim(worker, limit=10, min_priority=None):
+    """Mark up to ``limit`` due tasks as running for ``worker`` and return them, best first."""
+    now = timezone.now()
+    due = Task.objects.filter(status=Task.QUEUED, run_at__lte=now)
+    if min_priority is not None:
+        due = due.filter(priority__gte=min_priority)
+    due = due.order_by("-priority", "run_at", "id")
+    token = f"{worker}:{uuid.uuid4().hex[:12]}"
+
+    with transaction.atomic():
+        if connection.features.has_select_for_update_skip_locked:
+            ids = list(due.select_for_update(skip_locked=True).values_list("id", flat=True)[:limit])
+        else:
+            ids = list(due.values_list("id", flat=True)[:limit])
+        Task.objects.filter(id__in=ids, status=Task.QUEUED).update(
+            status=Task.RUNNING, locked_by=token, locked_at=now, attempts=F("attempts") + 1
+        )
+    claimed = Task.objects.filter(id__in=ids, locked_by=token)
+    return sorted(claimed, key=lambda t: (-t.priority, t.run_at, t.id))
+
+
+def execute(task):
+    """Run a claimed task; return True if it succeeded."""
+    try:
+        func = REGISTRY[task.name]
+        with transaction.atomic():
+            func(**task.payload)
+            Task.objects.filter(id=task.id).delete()
+        return True
+    except Exception:
+        error = traceback.format_exc()
+        logger.exception("Task %s #%s failed (attempt %s)", task.name, task.id, task.attempts)
+
+    if task.attempts >= task.max_attempts:
+        Task.objects.filter(id=task.id).update(status=Task.FAILED, last_error=error)
+    else:
+        delay = min(RETRY_DELAY * 2 ** (task.attempts - 1), MAX_RETRY_DELAY)
+        Task.objects.filter(id=task.id).update(
+            status=Task.QUEUED, run_at=timezone.now() + timedelta(seconds=delay),
+            locked_by="", locked_at=None, last_error=error,
+        )
+    return False
+
+
+def requeue_stale(lease):
+    """Put back tasks whose worker has held them for over ``lease`` seconds, e.g. after a crash."""
+    return Task.objects.filter(
+        status=Task.RUNNING, locked_at__lt=timezone.now() - timedelta(seconds=lease)
+    ).update(status=Task.QUEUED, locked_by="", locked_at=None)
+
+
+def run_pending(worker="inline", batch_size=100):
+    """Run due tasks until none are left; returns how many succeeded and failed."""
+    done = failed = 0
+    while True:
+        tasks = claim(worker, batch_size)
+        if not tasks:
+            return done, failed
+        for claimed in tasks:
+            if execute(claimed):
+                done += 1
+            else:
+                failed += 1
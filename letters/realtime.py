@@ -0,0 +1,100 @@
+"""
+Push notifications for open pages and clients.
+
+``letters.services`` publishes every change-log entry to the broker once its
+transaction commits; the ``events/`` view streams them to the browser as
+Server-Sent Events. An event only says what changed (kind, action, id); the
+client fetches the new state through the page or ``/api/changes/``, so a
+dropped event costs a refresh, never data.
+
+The broker is picked by ``LETTERS_PUSH_BROKER`` (a dotted path).
+``LocalBroker`` fans out within one process, which is enough for a single
+ASGI worker; running several needs a broker that relays between them
+(Redis pub/sub, Postgres ``LISTEN``/``NOTIFY``) behind the same two methods.
+"""
+import asyncio
+import threading
+from functools import lru_cache
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+class Broker:
+    def publish(self, user_id, event):
+        """Deliver ``event`` to every subscription of ``user_id``. Callable from any thread."""
+        raise NotImplementedError
+
+    def subscribe(self, user_id):
+        """Return a :class:`Subscription` for ``user_id`` bound to the running event loop."""
+        raise NotImplementedError
+
+
+class Subscription:
+    # Events a slow client may fall behind by before newer ones are dropped.
+    max_backlog = 100
+
+    def __init__(self, broker, user_id):
+        self.broker = broker
+        self.user_id = user_id
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(self.max_backlog)
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            pass
+
+    async def get(self, timeout=None):
+        """Return the next event, or ``None`` after ``timeout`` seconds."""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class LocalBroker(Broker):
+    """In-process fan-out; publishers and subscribers must share a process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscriptions = {}
+
+    def publish(self, user_id, event):
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(user_id, ()))
+        for subscription in subscriptions:
+            # Sync views run in a worker thread; hand the event to the loop
+            # that owns the queue.
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.put, event)
+            except RuntimeError:
+                # The loop is closed; the subscription is on its way out.
+                pass
+
+    def subscribe(self, user_id):
+        subscription = Subscription(self, user_id)
+        with self.lock:
+            self.subscriptions.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.user_id, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self.subscriptions.pop(subscription.user_id, None)
+
+    def connection_count(self):
+        with self.lock:
+            return sum(map(len, self.subscriptions.values()))
+
+
+@lru_cache(maxsize=None)
+def get_broker():
+    path = getattr(settings, "LETTERS_PUSH_BROKER", None)
+    return import_string(path)() if path else LocalBroker()
@@ -0,0 +1,110 @@
+"""
+Read replicas: GET and HEAD requests read from a replica, everything else
+from the primary (``default``).
+
+``DATABASE_REPLICA_URLS`` in settings adds the replicas as ``replica1``,
+``replica2``, ... and lists them in ``LETTERS_READ_REPLICAS``; with none
+configured nothing here does anything. ``ReplicaRoutingMiddleware``
+(``letters.middleware``) picks a replica for each safe request and keeps
+it on the primary when:
+
+- the user wrote in the last ``LETTERS_REPLICA_STICKY_SECONDS``, so they
+  read their own writes while the replicas catch up; a cookie carries this
+  to the next requests;
+- the request itself has written (a GET that marks letters read, say);
+- the read runs inside a transaction on the primary.
+
+The choice lives in a context variable, like ``letters.metrics``, so it
+follows a request into ``sync_to_async`` threads. Outside a request,
+in management commands, tasks and tests, everything uses the primary.
+
+Page cache entries built from a replica (``letters.caching``) are kept no
+longer than the sticky window, so a lagging replica cannot keep serving a
+page older than a write everyone else has already seen.
+"""
+import random
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+# Sent back after a write, holding the time until which reads stay on the primary.
+COOKIE_NAME = "primary_until"
+
+DEFAULT_STICKY_SECONDS = 10
+
+_current = ContextVar("letters_replica_routing", default=None)
+
+
+def replica_aliases():
+    return getattr(settings, "LETTERS_READ_REPLICAS", [])
+
+
+def sticky_seconds():
+    return getattr(settings, "LETTERS_REPLICA_STICKY_SECONDS", DEFAULT_STICKY_SECONDS)
+
+
+class Routing:
+    __slots__ = ("replica", "wrote")
+
+    def __init__(self, replica):
+        # None reads from the primary.
+        self.replica = replica
+        self.wrote = False
+
+
+def start(replica):
+    """Route the current request's reads to ``replica``; pass the result to :func:`stop`."""
+    routing = Routing(replica)
+    return routing, _current.set(routing)
+
+
+def stop(token):
+    _current.reset(token)
+
+
+def reading_replica():
+    """The replica the current request reads from now, or None for the primary."""
+    routing = _current.get()
+    if routing is None or routing.replica is None or routing.wrote:
+        return None
+    if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+        return None
+    return routing.replica
+
+
+def choose():
+    return random.choice(replica_aliases())
+
+
+def cache_timeout(timeout):
+    """``timeout`` for a page cache entry, capped while reading from a replica."""
+    if reading_replica() is None:
+        return timeout
+    return sticky_seconds() if timeout is None else min(timeout, sticky_seconds())
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        # The database cache backend: its entries are invalidated on write.
+        if model._meta.app_label == "django_cache":
+            return DEFAULT_DB_ALIAS
+        return reading_replica() or DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        routing = _current.get()
+        if routing is not None and model._meta.app_label != "django_cache":
+            routing.wrote = True
+        # Explicitly, or saving an instance read from a replica would write there.
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *replica_aliases()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in replica_aliases():
+            return False
+        return None
@@ -0,0 +1,316 @@
+"""
+Pluggable search backends.
+
+Each backend is picked from a setting (a dotted path) or, by default, from
+the database vendor.
+
+User search (``LETTERS_USER_SEARCH_BACKEND``): Postgres uses a ``pg_trgm``
+GIN index on ``auth_user.username``, SQLite a trigram FTS5 shadow table
+kept in sync by triggers (migration ``0005_user_search_index``).
+
+Letter search (``LETTERS_LETTER_SEARCH_BACKEND``): approved versions are
+written to a ``tsvector`` table on Postgres or an FTS5 table on SQLite
+(migration ``0006_letter_search_index``) as they are approved, alongside
+the two participants so a query only walks the searcher's own letters.
+"""
+import re
+from difflib import SequenceMatcher
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.db.models import BooleanField, Case, IntegerField, Q, Value, When
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Length, Lower
+from django.utils.module_loading import import_string
+
+from .models import LetterVersion
+
+# Hard cap on how many matches a single search may page through.
+MAX_RESULTS = 100
+
+
+class UserSearchBackend:
+    def search(self, query, exclude_ids=(), limit=20, offset=0):
+        """Return up to ``limit`` users ranked best match first."""
+        raise NotImplementedError
+
+    def ranked(self, queryset, query):
+        return queryset.annotate(
+            match_rank=Case(
+                When(username__iexact=query, then=Value(0)),
+                When(username__istartswith=query, then=Value(1)),
+                When(username__icontains=query, then=Value(2)),
+                default=Value(3),
+                output_field=IntegerField(),
+            )
+        )
+
+
+class BasicUserSearch(UserSearchBackend):
+    """Plain ``LIKE`` matching; correct anywhere but scans the table."""
+
+    def search(self, query, exclude_ids=(), limit=20, offset=0):
+        users = User.objects.filter(username__icontains=query).exclude(id__in=exclude_ids)
+        users = self.ranked(users, query).order_by("match_rank", Length("username"), "username")
+        return list(users[offset:offset + limit])
+
+
+class PostgresTrigramUserSearch(UserSearchBackend):
+    def search(self, query, exclude_ids=(), limit=20, offset=0):
+        from django.contrib.postgres.search import TrigramSimilarity
+
+        # ILIKE and the % similarity operator (pg_trgm.similarity_threshold)
+        # are both served by the gin_trgm_ops index.
+        similar = RawSQL(
+            '"auth_user"."username" %% %s', (query,), output_field=BooleanField()
+        )
+        users = User.objects.filter(
+            Q(username__icontains=query) | Q(similar)
+        ).exclude(id__in=exclude_ids).annotate(
+            similarity=TrigramSimilarity("username", query)
+        )
+        users = self.ranked(users, query).order_by("match_rank", "-similarity", "username")
+        return list(users[offset:offset + limit])
+
+
+class SQLiteFTSUserSearch(UserSearchBackend):
+    """
+    Ranked in three bounded passes, each stopping once enough rows are found:
+    case-insensitive prefix matches off the ``lower(username)`` index
+    (migration ``0018_user_search_lower_index``), substring matches off the
+    trigram FTS table, then fuzzy matches for typos.
+
+    Trigrams cannot match a query shorter than three characters, so those
+    fall back to :class:`BasicUserSearch` for the substring pass.
+    """
+
+    # Fuzzy candidates fetched before re-ranking by similarity.
+    FUZZY_CANDIDATES = 200
+
+    def search(self, query, exclude_ids=(), limit=20, offset=0):
+        wanted = offset + limit
+        seen = set(exclude_ids)
+        found = []
+
+        def collect(users):
+            for user in users:
+                if user.id not in seen and len(found) < wanted:
+                    seen.add(user.id)
+                    found.append(user)
+
+        folded = query.lower()
+        collect(User.objects.alias(folded=Lower("username")).filter(
+            folded__gte=folded, folded__lt=folded + "\U0010ffff"
+        ).exclude(id__in=seen).order_by("folded", "id")[:wanted])
+
+        if len(found) < wanted and len(query) >= 3:
+            collect(self.fts(self.phrase(query), wanted - len(found), seen))
+        elif len(found) < wanted:
+            collect(BasicUserSearch().search(query, seen, limit=wanted - len(found)))
+
+        # A single typo leaves at least one half of the query intact.
+        if len(found) < wanted and len(query) >= 6:
+            half = len(query) // 2
+            match = f"{self.phrase(query[:half])} OR {self.phrase(query[half:])}"
+            candidates = self.fts(match, self.FUZZY_CANDIDATES, seen)
+            candidates.sort(key=lambda u: (-SequenceMatcher(None, query, u.username).ratio(), u.username))
+            collect(candidates)
+
+        return found[offset:]
+
+    def phrase(self, text):
+        return '"%s"' % text.replace('"', '""')
+
+    def fts(self, match, limit, exclude_ids):
+        ids = RawSQL(
+            "SELECT rowid FROM letters_user_fts WHERE letters_user_fts MATCH %s LIMIT %s",
+            (match, limit + len(exclude_ids)),
+        )
+        return list(User.objects.filter(id__in=ids).exclude(id__in=exclude_ids)[:limit])
+
+
+def get_user_search_backend():
+    path = getattr(settings, "LETTERS_USER_SEARCH_BACKEND", None)
+    if path:
+        return import_string(path)()
+    if connection.vendor == "postgresql":
+        return PostgresTrigramUserSearch()
+    if connection.vendor == "sqlite":
+        return SQLiteFTSUserSearch()
+    return BasicUserSearch()
+
+
+class LetterSearchBackend:
+    def index(self, version):
+        """Add an approved version to the index."""
+        raise NotImplementedError
+
+    def index_many(self, versions):
+        for version in versions:
+            self.index(version)
+
+    def remove_many(self, versions):
+        """
+        Drop versions about to be deleted, with their content filled, from
+        the index. Postgres rows go by ``ON DELETE CASCADE`` on their own.
+        """
+        pass
+
+    def rebuild(self, batch_size=2000):
+        """Re-index every approved version, e.g. after a bulk load."""
+        versions = LetterVersion.objects.filter(approved=True).select_related("letter")
+        with transaction.atomic():
+            for chunk in chunked(versions.iterator(chunk_size=batch_size), batch_size):
+                self.index_many(LetterVersion.objects.fill_content(chunk))
+
+    def search(self, user, query, limit=20, offset=0):
+        """
+        Return approved versions of ``user``'s letters matching ``query``,
+        newest first. Newest-first rather than by relevance lets the index
+        stop after ``limit`` hits instead of scoring every match of a
+        common word.
+        """
+        raise NotImplementedError
+
+    def versions(self, ids):
+        by_id = LetterVersion.objects.select_related(
+            "letter__sender", "letter__receiver"
+        ).order_by().in_bulk(ids)
+        return [by_id[pk] for pk in ids if pk in by_id]
+
+
+class BasicLetterSearch(LetterSearchBackend):
+    """Substring matching with no index; scans the user's versions newest first."""
+
+    def index(self, version):
+        pass
+
+    def index_many(self, versions):
+        pass
+
+    def search(self, user, query, limit=20, offset=0):
+        # Versions may be stored as deltas, so match on the rebuilt text.
+        versions = LetterVersion.objects.filter(
+            Q(letter__sender=user) | Q(letter__receiver=user),
+            approved=True,
+        ).select_related("letter__sender", "letter__receiver").order_by("-id")
+        needle = query.casefold()
+        found = []
+        for chunk in chunked(versions.iterator(chunk_size=500), 500):
+            for version in LetterVersion.objects.fill_content(chunk):
+                if needle in version.content.casefold():
+                    found.append(version)
+            if len(found) >= offset + limit:
+                break
+        return found[offset:offset + limit]
+
+
+class PostgresLetterSearch(LetterSearchBackend):
+    def index(self, version):
+        self.index_many([version])
+
+    def index_many(self, versions):
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                "INSERT INTO letters_version_search "
+                "(version_id, sender_id, receiver_id, document) "
+                "VALUES (%s, %s, %s, to_tsvector('english', %s)) "
+                "ON CONFLICT (version_id) DO UPDATE SET document = EXCLUDED.document",
+                [
+                    [version.id, version.letter.sender_id, version.letter.receiver_id, version.content]
+                    for version in versions
+                ],
+            )
+
+    def search(self, user, query, limit=20, offset=0):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT version_id FROM letters_version_search "
+                "WHERE document @@ websearch_to_tsquery('english', %s) "
+                "AND (sender_id = %s OR receiver_id = %s) "
+                "ORDER BY version_id DESC LIMIT %s OFFSET %s",
+                [query, user.id, user.id, limit, offset],
+            )
+            return self.versions([row[0] for row in cursor.fetchall()])
+
+
+class SQLiteFTSLetterSearch(LetterSearchBackend):
+    def index(self, version):
+        self.index_many([version])
+
+    def remove_many(self, versions):
+        # A contentless table deletes by the exact values indexed, and a
+        # "delete" for a row that was never indexed corrupts it, so only
+        # rows known to be there (the index task may not have run) go.
+        with connection.cursor() as cursor:
+            for chunk in chunked(versions, 500):
+                ids = [version.id for version in chunk]
+                cursor.execute(
+                    "SELECT rowid FROM letters_version_fts WHERE rowid IN (%s)" % ", ".join(["%s"] * len(ids)),
+                    ids,
+                )
+                indexed = {row[0] for row in cursor.fetchall()}
+                cursor.executemany(
+                    "INSERT INTO letters_version_fts (letters_version_fts, rowid, body, participants) "
+                    "VALUES ('delete', %s, %s, %s)",
+                    [
+                        [version.id, version.content,
+                         participants(version.letter.sender_id, version.letter.receiver_id)]
+                        for version in chunk if version.id in indexed
+                    ],
+                )
+
+    def index_many(self, versions):
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                "INSERT OR REPLACE INTO letters_version_fts (rowid, body, participants) "
+                "VALUES (%s, %s, %s)",
+                [
+                    [version.id, version.content,
+                     participants(version.letter.sender_id, version.letter.receiver_id)]
+                    for version in versions
+                ],
+            )
+
+    def search(self, user, query, limit=20, offset=0):
+        words = re.findall(r"\w+", query)
+        if not words:
+            return []
+        terms = " ".join('"%s"' % word for word in words[:-1])
+        # The last word is usually still being typed, so match it as a prefix.
+        terms += ' "%s"*' % words[-1]
+        match = f"body:({terms}) AND participants:{participants(user.id)}"
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT rowid FROM letters_version_fts WHERE letters_version_fts MATCH %s "
+                "ORDER BY rowid DESC LIMIT %s OFFSET %s",
+                [match, limit, offset],
+            )
+            return self.versions([row[0] for row in cursor.fetchall()])
+
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def participants(*user_ids):
+    return " ".join(f"u{user_id}" for user_id in user_ids)
+
+
+def get_letter_search_backend():
+    path = getattr(settings, "LETTERS_LETTER_SEARCH_BACKEND", None)
+    if path:
+        return import_string(path)()
+    if connection.vendor == "postgresql":
+        return PostgresLetterSearch()
+    if connection.vendor == "sqlite":
+        return SQLiteFTSLetterSearch()
+    return BasicLetterSearch()
@@ -1,20 +1,121 @@
+from django.contrib.auth.models import User
 from rest_framework import serializers
-from .models import Letter, ModificationRequest
+from .models import Connection, Letter, LetterVersion
 
-class LetterSerializer(serializers.ModelSerializer): # cite: uploaded:serializers.py
+# Most items a single bulk request may carry.
+BULK_MAX = 500
+
+
+class SparseFieldsetMixin:
+    """
+    Trim the top-level representation to ``?fields=a,b,c`` when given, so
+    sync clients only pay for the columns they actually read.
+    """
+
+    def get_fields(self):
+        fields = super().get_fields()
+        request = self.context.get("request")
+        top_level = self.parent is None or (
+            isinstance(self.parent, serializers.ListSerializer) and self.parent.parent is None
+        )
+        if request is not None and top_level and request.query_params.get("fields"):
+            wanted = set(request.query_params["fields"].split(","))
+            fields = {name: field for name, field in fields.items() if name in wanted}
+        return fields
+
+
+class UserSerializer(serializers.ModelSerializer):
     class Meta:
-        model = Letter # cite: uploaded:serializers.py
-        fields = '__all__' # cite: uploaded:serializers.py
-        read_only_fields = ('sender',) # cite: uploaded:serializers.py
+        model = User
+        fields = ("id", "username")
+
 
+class LetterVersionSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    content = serializers.CharField()
+    # The version a proposal was made against; sending it makes the
+    # proposal fail with 409 if the letter has changed since.
+    base_version = serializers.IntegerField(source="base_version_id", required=False, allow_null=True)
+    archived = serializers.BooleanField(read_only=True)
 
-class ModificationRequestSerializer(serializers.ModelSerializer): # cite: uploaded:serializers.py
     class Meta:
-        model = ModificationRequest # cite: uploaded:serializers.py
-        fields = '__all__' # cite: uploaded:serializers.py
-        read_only_fields = ( # cite: uploaded:serializers.py
-            'requested_by',
-            'sender_approval',
-            'receiver_approval',
-            'status',
-        )
\ No newline at end of file
+        model = LetterVersion
+        fields = ("id", "letter", "content", "base_version", "created_at", "approved", "archived")
+        read_only_fields = ("letter", "created_at", "approved")
+
+
+class ArchivedVersionSerializer(SparseFieldsetMixin, serializers.Serializer):
+    """
+    An ``ArchivedVersion`` in ``LetterVersionSerializer``'s shape. It does
+    not know its letter, so ``letter`` comes from the context; the archive
+    keeps no ``base_version``.
+    """
+
+    id = serializers.IntegerField()
+    letter = serializers.SerializerMethodField()
+    content = serializers.CharField()
+    base_version = serializers.SerializerMethodField()
+    created_at = serializers.DateTimeField()
+    approved = serializers.BooleanField()
+    archived = serializers.BooleanField()
+
+    def get_letter(self, version):
+        return self.context["letter_id"]
+
+    def get_base_version(self, version):
+        return None
+
+
+class CurrentVersionSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = LetterVersion
+        fields = ("id", "content", "created_at")
+
+
+class LetterSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    sender = UserSerializer(read_only=True)
+    receiver = UserSerializer(read_only=True)
+    current_version = CurrentVersionSerializer(read_only=True)
+    has_pending = serializers.BooleanField(read_only=True)
+    # Moved out by ``manage.py archive_letters``: read back, but read-only.
+    archived = serializers.BooleanField(read_only=True)
+
+    class Meta:
+        model = Letter
+        fields = ("id", "sender", "receiver", "created_at", "preview", "current_version", "has_pending", "archived")
+
+
+class LetterCreateSerializer(serializers.Serializer):
+    receiver = serializers.PrimaryKeyRelatedField(queryset=User.objects.all())
+    content = serializers.CharField()
+
+
+class BulkLetterCreateSerializer(serializers.Serializer):
+    receivers = serializers.ListField(
+        child=serializers.IntegerField(), allow_empty=False, max_length=BULK_MAX
+    )
+    content = serializers.CharField()
+
+
+class VersionIdsSerializer(serializers.Serializer):
+    ids = serializers.ListField(
+        child=serializers.IntegerField(), allow_empty=False, max_length=BULK_MAX
+    )
+
+
+class ConnectionSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
+    requester = UserSerializer(read_only=True)
+    receiver = UserSerializer(read_only=True)
+    receiver_id = serializers.PrimaryKeyRelatedField(
+        queryset=User.objects.all(), source="receiver", write_only=True
+    )
+
+    class Meta:
+        model = Connection
+        fields = ("id", "requester", "receiver", "receiver_id", "accepted", "created_at")
+        read_only_fields = ("accepted", "created_at")
+
+    def validate_receiver_id(self, receiver):
+        request = self.context.get("request")
+        if request is not None and receiver.id == request.user.id:
+            raise serializers.ValidationError("You cannot connect to yourself.")
+        return receiver
@@ -0,0 +1,442 @@
+"""
+Write paths shared by the HTML views and the API.
+
+Every function here runs in one transaction and keeps the denormalized
+rows (``ContactSummary``, ``UserStats``, the sync change log) in step with the
+``Connection``/``Letter``/``LetterVersion`` rows it writes. Slower side
+work such as search indexing is queued (``letters.tasks``) in the same
+transaction and done by ``manage.py run_tasks``. Change-log entries are
+pushed to open pages once the transaction commits (see
+``letters.realtime``).
+
+Edits are optimistic: a proposal records the version it was made against
+(``base_version``) and approving it swaps the letter's current version
+only if that is still the base, in the same UPDATE. Nothing is locked
+while people write; whoever loses the race gets :class:`VersionConflict`
+and the proposal stays pending to be rejected or proposed again.
+"""
+from collections import Counter
+
+from django.db import connection, transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+
+from . import graph, stats
+from .caching import graph_scope, invalidate, pair_scope, user_scope
+from .models import ChangeLogEntry, Connection, ContactSummary, Letter, LetterVersion, make_preview
+from .realtime import get_broker
+from .tasks import index_versions
+
+
+class VersionConflict(Exception):
+    """The letter's current version is no longer the one an edit was based on."""
+
+    def __init__(self, version):
+        super().__init__(f"letter {version.letter_id} changed after version {version.id} was proposed")
+        self.version = version
+
+
+@transaction.atomic
+def request_connection(requester, receiver):
+    """
+    Ask ``receiver`` to connect. Two users share one connection whoever
+    asked: asking again returns it, and asking someone whose request is
+    still open accepts that request.
+    """
+    if requester.id == receiver.id:
+        raise ValueError("users cannot connect to themselves")
+    conn, created = Connection.objects.between(requester.id, receiver.id).get_or_create(
+        defaults={"requester": requester, "receiver": receiver}
+    )
+    if not created and not conn.accepted and conn.requester_id == receiver.id:
+        accept_connection(conn)
+    if created:
+        ContactSummary.objects.get_or_create(
+            owner=receiver,
+            contact=requester,
+            defaults={"connection": conn},
+        )
+        log_change(ChangeLogEntry.CONNECTION, ChangeLogEntry.CREATED, conn.id, requester.id, receiver.id)
+    return conn, created
+
+
+@transaction.atomic
+def accept_connection(conn):
+    # Conditional, so accepting twice (a double click) counts the contact once.
+    newly_accepted = Connection.objects.filter(pk=conn.pk, accepted=False).update(accepted=True)
+    conn.accepted = True
+    # update() sends no save signal.
+    invalidate(
+        user_scope(conn.requester_id), user_scope(conn.receiver_id),
+        graph_scope(conn.requester_id), graph_scope(conn.receiver_id),
+    )
+    if newly_accepted:
+        stats.bump({conn.requester_id: {"contacts": 1}, conn.receiver_id: {"contacts": 1}})
+
+    for owner_id, contact_id in (
+        (conn.receiver_id, conn.requester_id),
+        (conn.requester_id, conn.receiver_id),
+    ):
+        ContactSummary.objects.update_or_create(
+            owner_id=owner_id,
+            contact_id=contact_id,
+            defaults={"connection": conn, "accepted": True},
+        )
+    log_change(ChangeLogEntry.CONNECTION, ChangeLogEntry.ACCEPTED, conn.id, conn.receiver_id, conn.requester_id)
+    return conn
+
+
+@transaction.atomic
+def send_letter(sender, receiver, content):
+    letter = Letter.objects.create(
+        sender=sender,
+        receiver=receiver
+    )
+    version = LetterVersion.objects.create(
+        letter=letter,
+        content=content,
+        approved=True
+    )
+    letter.set_current(version)
+    letter.save(update_fields=["current_version", "preview"])
+    index_versions.enqueue(ids=[version.id])
+
+    ContactSummary.objects.filter(owner=sender, contact=receiver).update(
+        last_letter_at=letter.created_at,
+        letter_count=F("letter_count") + 1,
+    )
+    ContactSummary.objects.filter(owner=receiver, contact=sender).update(
+        last_letter_at=letter.created_at,
+        unread_count=F("unread_count") + 1,
+        letter_count=F("letter_count") + 1,
+    )
+    stats.bump({sender.id: {"letters_sent": 1}, receiver.id: {"letters_received": 1}})
+    log_change(ChangeLogEntry.LETTER, ChangeLogEntry.CREATED, letter.id, sender.id, receiver.id,
+               letter_id=letter.id)
+    log_change(ChangeLogEntry.VERSION, ChangeLogEntry.CREATED, version.id, sender.id, receiver.id,
+               letter_id=letter.id)
+    return letter
+
+
+@transaction.atomic
+def propose_modification(letter, content, base_version_id=None):
+    """
+    Propose ``content`` as the letter's new text. ``base_version_id`` is
+    the version the proposer was looking at, if the client sent it;
+    proposing against an outdated one raises :class:`VersionConflict`.
+    """
+    if base_version_id is not None and base_version_id != letter.current_version_id:
+        raise VersionConflict(LetterVersion(id=None, letter=letter, base_version_id=base_version_id))
+    version = LetterVersion.objects.create(
+        letter=letter,
+        content=content,
+        approved=False,
+        approver_id=letter.sender_id,
+        base_version_id=letter.current_version_id,
+    )
+    ContactSummary.objects.filter(owner_id=letter.sender_id, contact_id=letter.receiver_id).update(
+        pending_approval_count=F("pending_approval_count") + 1
+    )
+    stats.bump({letter.sender_id: {"pending_approvals": 1}, letter.receiver_id: {"pending_proposals": 1}})
+    log_change(ChangeLogEntry.VERSION, ChangeLogEntry.CREATED, version.id, letter.receiver_id, letter.sender_id,
+               letter_id=letter.id)
+    return version
+
+
+@transaction.atomic
+def approve_version(version):
+    """
+    Make ``version`` the letter's current text. Raises
+    :class:`VersionConflict`, changing nothing, if another version became
+    current after this one was proposed.
+    """
+    # Conditional update so a double click cannot decrement the count twice.
+    updated = LetterVersion.objects.filter(pk=version.pk, approved=False).update(approved=True)
+    if updated:
+        letter = version.letter
+        preview = make_preview(version.content)
+        # Compare-and-swap on the current version rather than a row lock;
+        # raising rolls back the approval above.
+        if not Letter.objects.filter(pk=letter.pk, current_version_id=version.base_version_id).update(
+            current_version=version, preview=preview
+        ):
+            raise VersionConflict(version)
+        letter.current_version, letter.preview = version, preview
+        # update() sends no save signal.
+        invalidate(
+            user_scope(letter.sender_id), user_scope(letter.receiver_id),
+            pair_scope(letter.sender_id, letter.receiver_id),
+        )
+        index_versions.enqueue(ids=[version.id])
+        ContactSummary.objects.filter(
+            owner_id=letter.sender_id,
+            contact_id=letter.receiver_id,
+            pending_approval_count__gt=0,
+        ).update(pending_approval_count=F("pending_approval_count") - 1)
+        stats.bump({letter.sender_id: {"pending_approvals": -1}, letter.receiver_id: {"pending_proposals": -1}})
+        log_change(ChangeLogEntry.VERSION, ChangeLogEntry.APPROVED, version.id, letter.sender_id, letter.receiver_id,
+                   letter_id=letter.id)
+    version.approved = True
+    return version
+
+
+def personalize(content, receiver):
+    """Fill the ``{username}`` placeholder of a bulk letter for one receiver."""
+    return content.replace("{username}", receiver.username)
+
+
+@transaction.atomic
+def send_letters(sender, receivers, content):
+    """
+    Send ``content`` to each of ``receivers`` the sender is connected to,
+    personalized per receiver, with a constant number of queries however
+    many there are. Returns the new letters; unconnected receivers are
+    skipped.
+    """
+    connected = graph.contacts(sender.id)
+    receivers = [receiver for receiver in receivers if receiver.id in connected]
+    if not receivers:
+        return []
+
+    letters = Letter.objects.bulk_create(
+        Letter(sender=sender, receiver=receiver) for receiver in receivers
+    )
+    # New letters have nothing to diff against, so every version is a
+    # snapshot and skipping LetterVersion.save() loses nothing.
+    versions = LetterVersion.objects.bulk_create(
+        LetterVersion(letter=letter, content=personalize(content, receiver), approved=True)
+        for letter, receiver in zip(letters, receivers)
+    )
+    for letter, version in zip(letters, versions):
+        letter.set_current(version)
+    save_current_many(letters)
+    index_versions.enqueue(ids=[version.id for version in versions])
+
+    sent_at = letters[-1].created_at
+    receiver_ids = [receiver.id for receiver in receivers]
+    ContactSummary.objects.filter(owner=sender, contact_id__in=receiver_ids).update(
+        last_letter_at=sent_at,
+        letter_count=F("letter_count") + 1,
+    )
+    ContactSummary.objects.filter(owner_id__in=receiver_ids, contact=sender).update(
+        last_letter_at=sent_at,
+        unread_count=F("unread_count") + 1,
+        letter_count=F("letter_count") + 1,
+    )
+    counts = stats.changes()
+    counts[sender.id]["letters_sent"] += len(receiver_ids)
+    for receiver_id in receiver_ids:
+        counts[receiver_id]["letters_received"] += 1
+    stats.bump(counts)
+    log_changes(
+        change
+        for letter, version in zip(letters, versions)
+        for change in (
+            (ChangeLogEntry.LETTER, ChangeLogEntry.CREATED, letter.id, sender.id, [letter.receiver_id], letter.id),
+            (ChangeLogEntry.VERSION, ChangeLogEntry.CREATED, version.id, sender.id, [letter.receiver_id], letter.id),
+        )
+    )
+    # Bulk writes send no save signals.
+    invalidate(user_scope(sender.id), *(
+        scope for receiver_id in receiver_ids
+        for scope in (user_scope(receiver_id), pair_scope(sender.id, receiver_id))
+    ))
+    return letters
+
+
+def save_current_many(letters, expected=None):
+    """
+    Write ``current_version`` and ``preview`` for many letters, after
+    ``Letter.set_current``. bulk_update() builds a CASE expression per row,
+    which costs more Python time than the UPDATEs it replaces; executemany
+    sends one prepared statement.
+
+    With ``expected``, ``{letter_id: current_version_id}`` as read before
+    the change, each letter is only written if its current version is
+    still that one. Returns the number of letters written.
+    """
+    meta = Letter._meta
+    current = connection.ops.quote_name(meta.get_field("current_version").column)
+    sql = "UPDATE %s SET %s = %%s, %s = %%s WHERE %s = %%s" % (
+        connection.ops.quote_name(meta.db_table),
+        current,
+        connection.ops.quote_name(meta.get_field("preview").column),
+        connection.ops.quote_name(meta.pk.column),
+    )
+    rows = [(letter.current_version_id, letter.preview, letter.id) for letter in letters]
+    if expected is not None:
+        sql += f" AND {current} = %s"
+        rows = [(*row, expected[row[2]]) for row in rows]
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, rows)
+        # Summed over the statements by sqlite3 and psycopg.
+        return cursor.rowcount
+
+
+def _pending_versions(sender, version_ids):
+    return list(
+        LetterVersion.objects.select_for_update(of=("self",)).filter(
+            id__in=version_ids, approved=False, letter__sender=sender
+        ).select_related("letter").order_by("created_at", "id")
+    )
+
+
+def _settle_pending(sender, versions, action):
+    """Bookkeeping shared by batch approval and rejection of ``versions``."""
+    per_contact = Counter(version.letter.receiver_id for version in versions)
+    # One UPDATE per distinct count rather than per contact; usually that is
+    # a single statement.
+    by_count = {}
+    for contact_id, count in per_contact.items():
+        by_count.setdefault(count, []).append(contact_id)
+    for count, contact_ids in by_count.items():
+        ContactSummary.objects.filter(owner=sender, contact_id__in=contact_ids).update(
+            pending_approval_count=Greatest(F("pending_approval_count") - count, 0)
+        )
+    counts = stats.changes()
+    counts[sender.id]["pending_approvals"] -= len(versions)
+    for contact_id, count in per_contact.items():
+        counts[contact_id]["pending_proposals"] -= count
+    stats.bump(counts)
+    log_changes(
+        (ChangeLogEntry.VERSION, action, version.id, sender.id, [version.letter.receiver_id], version.letter_id)
+        for version in versions
+    )
+    invalidate(user_scope(sender.id), *(
+        scope for contact_id in per_contact
+        for scope in (user_scope(contact_id), pair_scope(sender.id, contact_id))
+    ))
+
+
+@transaction.atomic
+def approve_versions(sender, version_ids):
+    """
+    Approve many of ``sender``'s pending versions in one transaction. Ids
+    that are not pending versions of the sender's letters are ignored.
+    Versions of one letter are taken in order, as if approved one by one:
+    each applies if it was based on the text current at that point, and
+    the rest are left pending. Returns ``(approved, stale)``.
+
+    Raises :class:`VersionConflict`, changing nothing, if one of the
+    letters changed while this ran.
+    """
+    versions = _pending_versions(sender, version_ids)
+    letters, expected, approved, stale = {}, {}, [], []
+    for version in versions:
+        letter = letters.setdefault(version.letter_id, version.letter)
+        expected.setdefault(letter.id, letter.current_version_id)
+        if version.base_version_id != letter.current_version_id:
+            stale.append(version)
+            continue
+        # Only the id is needed to check the next one; the preview is set below.
+        letter.current_version_id = version.id
+        approved.append(version)
+    if not approved:
+        return [], stale
+
+    LetterVersion.objects.filter(id__in=[version.id for version in approved]).update(approved=True)
+    LetterVersion.objects.fill_content(approved)
+    changed = {}
+    for version in approved:
+        version.approved = True
+        letter = changed.setdefault(version.letter_id, version.letter)
+        letter.set_current(version)
+    if save_current_many(changed.values(), expected) != len(changed):
+        # Name a letter that was not written; a deleted one counts too.
+        written = set(Letter.objects.filter(
+            current_version_id__in=[letter.current_version_id for letter in changed.values()]
+        ).values_list("pk", flat=True))
+        raise VersionConflict(next(version for version in approved if version.letter_id not in written))
+    index_versions.enqueue(ids=[version.id for version in approved])
+
+    _settle_pending(sender, approved, ChangeLogEntry.APPROVED)
+    return approved, stale
+
+
+@transaction.atomic
+def reject_versions(sender, version_ids):
+    """
+    Discard many of ``sender``'s pending versions in one transaction.
+    Proposals are only ever diffed against approved text, so nothing else
+    refers to them. Returns the number rejected.
+    """
+    versions = _pending_versions(sender, version_ids)
+    if not versions:
+        return 0
+    ids = [version.id for version in versions]
+    _detach_dependents(ids)
+    LetterVersion.objects.filter(id__in=ids).delete()
+    _settle_pending(sender, versions, ChangeLogEntry.REJECTED)
+    return len(versions)
+
+
+def _detach_dependents(ids):
+    """
+    Rewrite as snapshots the versions whose delta chain runs through
+    ``ids``, which are about to be deleted along with everything that
+    cascades from them. Rows written before deltas were limited to approved
+    parents may still be stored against a proposal.
+    """
+    if not LetterVersion.objects.filter(delta_parent_id__in=ids).exists():
+        return
+    letters = LetterVersion.objects.filter(id__in=ids).values("letter_id")
+    chained = list(LetterVersion.objects.filter(letter_id__in=letters).exclude(delta_parent=None))
+    parents = {version.id: version.delta_parent_id for version in chained}
+    doomed = set(ids)
+
+    def runs_through(pk):
+        while pk is not None:
+            if pk in doomed:
+                return True
+            pk = parents.get(pk)
+        return False
+
+    dependents = [v for v in chained if v.id not in doomed and runs_through(v.delta_parent_id)]
+    LetterVersion.objects.fill_content(dependents)
+    for version in dependents:
+        # Reassigning the text makes it a snapshot.
+        version.content = version.content
+    LetterVersion.objects.bulk_update(dependents, ["stored_content", "delta_base", "delta_parent", "delta_depth"])
+
+
+def mark_conversation_read(owner, contact):
+    if ContactSummary.objects.filter(
+        owner=owner, contact=contact, unread_count__gt=0
+    ).update(unread_count=0):
+        invalidate(user_scope(owner.id))
+
+
+def log_change(kind, action, object_id, actor_id, *other_user_ids, letter_id=None):
+    """
+    Record a change for the actor and every other user who can see it, and
+    push it to them once the surrounding transaction commits.
+    """
+    log_changes([(kind, action, object_id, actor_id, other_user_ids, letter_id)])
+
+
+def log_changes(changes):
+    """
+    :func:`log_change` for many changes at once, given as ``(kind, action,
+    object_id, actor_id, other_user_ids, letter_id)`` tuples, in one INSERT.
+    """
+    entries = []
+    events = []
+    for kind, action, object_id, actor_id, other_user_ids, letter_id in changes:
+        user_ids = list(dict.fromkeys((actor_id, *other_user_ids)))
+        entries.extend(
+            ChangeLogEntry(user_id=user_id, actor_id=actor_id, kind=kind, action=action, object_id=object_id)
+            for user_id in user_ids
+        )
+        event = {"kind": kind, "action": action, "id": object_id, "actor": actor_id}
+        if letter_id is not None:
+            event["letter"] = letter_id
+        events.append((user_ids, event))
+    ChangeLogEntry.objects.bulk_create(entries)
+
+    def publish():
+        broker = get_broker()
+        for user_ids, event in events:
+            for user_id in user_ids:
+                broker.publish(user_id, event)
+
+    transaction.on_commit(publish)
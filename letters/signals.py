@@ -0,0 +1,38 @@
+from django.contrib.auth.models import User
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .auth import forget_user
+from .caching import graph_scope, invalidate, pair_scope, user_scope
+from .models import Connection, Letter, LetterVersion
+
+
+@receiver([post_save, post_delete], sender=User)
+def user_changed(sender, instance, **kwargs):
+    forget_user(instance.id)
+
+
+@receiver([post_save, post_delete], sender=Connection)
+def connection_changed(sender, instance, **kwargs):
+    invalidate(
+        user_scope(instance.requester_id),
+        user_scope(instance.receiver_id),
+        graph_scope(instance.requester_id),
+        graph_scope(instance.receiver_id),
+    )
+
+
+@receiver([post_save, post_delete], sender=Letter)
+def letter_changed(sender, instance, **kwargs):
+    invalidate(
+        user_scope(instance.sender_id),
+        user_scope(instance.receiver_id),
+        pair_scope(instance.sender_id, instance.receiver_id),
+    )
+
+
+@receiver(post_save, sender=LetterVersion)
+def version_changed(sender, instance, **kwargs):
+    # A pending version shows on the sender's dashboard and as a marker on
+    # the conversation; deleting versions only happens with their letter.
+    letter_changed(Letter, instance.letter)
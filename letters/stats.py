@@ -0,0 +1,190 @@
+"""
+Per-user counters and the activity feed shown on the dashboard.
+
+``UserStats`` holds each user's totals and ``ContactSummary.letter_count``
+how much they write with each contact. ``letters.services`` and the
+importer add to both in the transaction that makes the change, so reading
+them is one row per user and the user's summaries, which the dashboard
+loads anyway. The feed is the user's ``ChangeLogEntry`` rows, newest
+first, read off the ``(user, id)`` index.
+
+Counters are only ever added to, so a missed code path or a hand edit in
+the database leaves them wrong until ``manage.py reconcile_stats``
+(:func:`reconcile`) recounts them; run it from cron, e.g. nightly.
+"""
+from collections import Counter, defaultdict
+
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.db.models import Count, Q
+
+from .caching import invalidate, user_scope
+from .models import ArchivedLetter, ChangeLogEntry, Connection, ContactSummary, Letter, LetterVersion, UserStats
+
+FIELDS = ("letters_sent", "letters_received", "pending_approvals", "pending_proposals", "contacts")
+
+FEED_SIZE = 10
+TOP_CORRESPONDENTS = 5
+
+
+def changes():
+    """An empty ``{user_id: Counter(field=delta)}`` for :func:`bump`."""
+    return defaultdict(Counter)
+
+
+def bump(deltas):
+    """
+    Add ``{user_id: {field: delta}}`` to users' counters in one prepared
+    statement, creating missing rows. Counters stop at zero rather than
+    going negative.
+    """
+    rows = []
+    for user_id, fields in deltas.items():
+        values = [fields.get(field, 0) for field in FIELDS]
+        if not any(values):
+            continue
+        # A new row starts from the deltas; an existing one has them added
+        # by the CASE, which names each delta twice.
+        updates = [delta for value in values for delta in (value, value)]
+        rows.append([user_id, *(max(value, 0) for value in values), *updates])
+    if not rows:
+        return
+    quote = connection.ops.quote_name
+    table = quote(UserStats._meta.db_table)
+    columns = [quote(field) for field in FIELDS]
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f"INSERT INTO {table} (user_id, {', '.join(columns)}) "
+            f"VALUES (%s, {', '.join(['%s'] * len(columns))}) "
+            f"ON CONFLICT (user_id) DO UPDATE SET " + ", ".join(
+                f"{column} = CASE WHEN {table}.{column} + %s < 0 THEN 0 ELSE {table}.{column} + %s END"
+                for column in columns
+            ),
+            rows,
+        )
+
+
+def for_user(user):
+    return UserStats.objects.filter(user=user).first() or UserStats(user=user)
+
+
+async def afor_user(user):
+    return await UserStats.objects.filter(user=user).afirst() or UserStats(user=user)
+
+
+def _feed_entries(user):
+    entries = ChangeLogEntry.objects.filter(user=user).exclude(actor=user)
+    # Sending a letter logs its first version too; one line per letter is
+    # enough, so read a little extra to make up for the ones dropped.
+    return entries.select_related("actor").order_by("-id")[:FEED_SIZE * 2]
+
+
+def _one_per_letter(entries):
+    # The first version is logged right after its letter, so in newest-first
+    # order it is the entry just before the letter's, by the same actor.
+    kept = [
+        entry for entry, older in zip(entries, entries[1:] + [None])
+        if not (
+            (entry.kind, entry.action) == (entry.VERSION, entry.CREATED)
+            and older is not None
+            and (older.kind, older.action, older.actor_id) == (older.LETTER, older.CREATED, entry.actor_id)
+        )
+    ]
+    return kept[:FEED_SIZE]
+
+
+def feed(user):
+    """What other people did that the user can see, newest first."""
+    return _one_per_letter(list(_feed_entries(user)))
+
+
+async def afeed(user):
+    return _one_per_letter([entry async for entry in _feed_entries(user)])
+
+
+def top_correspondents(summaries):
+    """The contacts among ``summaries`` the user has exchanged the most letters with."""
+    ranked = sorted((s for s in summaries if s.letter_count), key=lambda s: (-s.letter_count, s.contact_id))
+    return ranked[:TOP_CORRESPONDENTS]
+
+
+def _counts(queryset, *keys):
+    return {
+        tuple(row[key] for key in keys) if len(keys) > 1 else row[keys[0]]: row["n"]
+        for row in queryset.values(*keys).annotate(n=Count("pk")).order_by()
+    }
+
+
+def _recount(user_ids):
+    """Fresh totals for ``user_ids``, and fresh per-contact counts for their summaries."""
+    totals = {user_id: dict.fromkeys(FIELDS, 0) for user_id in user_ids}
+    pairs = Counter()
+    pending = {}
+    for letters in (Letter.objects.all(), ArchivedLetter.objects.filter(whole=True)):
+        for (sender_id, receiver_id), n in _counts(
+            letters.filter(Q(sender_id__in=user_ids) | Q(receiver_id__in=user_ids)), "sender_id", "receiver_id"
+        ).items():
+            if sender_id in totals:
+                totals[sender_id]["letters_sent"] += n
+                pairs[sender_id, receiver_id] += n
+            if receiver_id in totals:
+                totals[receiver_id]["letters_received"] += n
+                pairs[receiver_id, sender_id] += n
+
+    open_versions = LetterVersion.objects.filter(approved=False).filter(
+        Q(letter__sender_id__in=user_ids) | Q(letter__receiver_id__in=user_ids)
+    )
+    for (sender_id, receiver_id), n in _counts(open_versions, "letter__sender_id", "letter__receiver_id").items():
+        if sender_id in totals:
+            totals[sender_id]["pending_approvals"] += n
+            pending[sender_id, receiver_id] = n
+        if receiver_id in totals:
+            totals[receiver_id]["pending_proposals"] += n
+
+    accepted = Connection.objects.filter(accepted=True)
+    for side in ("user_low_id", "user_high_id"):
+        for user_id, n in _counts(accepted.filter(**{f"{side}__in": user_ids}), side).items():
+            totals[user_id]["contacts"] += n
+    return totals, pairs, pending
+
+
+@transaction.atomic
+def _reconcile_batch(user_ids):
+    totals, pairs, pending = _recount(user_ids)
+    stored = UserStats.objects.in_bulk(user_ids)
+    created, changed = [], []
+    for user_id, fields in totals.items():
+        row = stored.get(user_id)
+        if row is None:
+            created.append(UserStats(user_id=user_id, **fields))
+        elif any(getattr(row, field) != value for field, value in fields.items()):
+            for field, value in fields.items():
+                setattr(row, field, value)
+            changed.append(row)
+    UserStats.objects.bulk_create(created)
+    UserStats.objects.bulk_update(changed, FIELDS)
+
+    summaries = []
+    for summary in ContactSummary.objects.filter(owner_id__in=user_ids):
+        key = (summary.owner_id, summary.contact_id)
+        if (summary.letter_count, summary.pending_approval_count) != (pairs[key], pending.get(key, 0)):
+            summary.letter_count, summary.pending_approval_count = pairs[key], pending.get(key, 0)
+            summaries.append(summary)
+    ContactSummary.objects.bulk_update(summaries, ["letter_count", "pending_approval_count"])
+
+    fixed = {row.user_id for row in created + changed} | {summary.owner_id for summary in summaries}
+    invalidate(*(user_scope(user_id) for user_id in fixed))
+    return Counter(created=len(created), fixed=len(changed), summaries=len(summaries))
+
+
+def reconcile(batch_size=1000):
+    """Recount every user's counters from the rows themselves; returns how many were wrong."""
+    totals = Counter()
+    last_id = 0
+    while True:
+        user_ids = list(User.objects.filter(id__gt=last_id).order_by("id").values_list("id", flat=True)[:batch_size])
+        if not user_ids:
+            break
+        last_id = user_ids[-1]
+        totals.update(_reconcile_batch(user_ids))
+    return totals
@@ -0,0 +1,23 @@
+from whitenoise.storage import CompressedManifestStaticFilesStorage
+
+
+class StaticFilesStorage(CompressedManifestStaticFilesStorage):
+    """
+    WhiteNoise's storage: ``collectstatic`` writes each file under a name
+    with its content hash, plus compressed copies (brotli too when the
+    Brotli package is installed), and WhiteNoise serves hashed names as
+    immutable for a year.
+
+    A name missing from the manifest is an error, so a deploy that skipped
+    ``collectstatic`` fails loudly instead of serving uncacheable URLs.
+    With ``WHITENOISE_MANIFEST_STRICT`` off (the tests, ``manage.py
+    benchmark`` and ``letters.bench_settings`` turn it off; production
+    never does) and no manifest at all, ``{% static %}`` falls back to the
+    plain name. With DEBUG on, Django
+    serves plain names anyway.
+    """
+
+    def stored_name(self, name):
+        if not self.manifest_strict and not self.hashed_files:
+            return name
+        return super().stored_name(name)
@@ -0,0 +1,12 @@
+"""Background work queued by letters.services; run by ``manage.py run_tasks``."""
+from .models import LetterVersion
+from .queue import task
+from .search import get_letter_search_backend
+
+
+@task("letters.index_versions", priority=10)
+def index_versions(ids):
+    # Re-read the rows: a version may have been rejected or its letter
+    # deleted since the task was queued.
+    versions = list(LetterVersion.objects.filter(id__in=ids, approved=True).select_related("letter"))
+    get_letter_search_backend().index_many(LetterVersion.objects.fill_content(versions))
@@ -1,3 +1,1570 @@
-from django.test import TestCase
+import asyncio
+import io
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest import mock, skipUnless
+from urllib.parse import parse_qs, urljoin, urlsplit
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.management import call_command
+from django.db import IntegrityError, connection, connections, router, transaction
+from django.http import HttpResponse
+from django.templatetags.static import static
+from django.test import AsyncClient, Client, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import archive, bench, caching, delta, export, graph, importer, metrics, pagination, queue, replicas, services, stats, throttle
+from .middleware import ReplicaRoutingMiddleware
+from .realtime import get_broker
+from .search import get_letter_search_backend
+from .storage import StaticFilesStorage
+from .models import (
+    ArchivedLetter,
+    ChangeLogEntry,
+    Connection,
+    ContactSummary,
+    ImportCheckpoint,
+    Letter,
+    LetterVersion,
+    Task,
+    UserStats,
+)
+
+# Pages render without collectstatic having run.
+relaxed_manifest = override_settings(WHITENOISE_MANIFEST_STRICT=False)
+
+
+def setUpModule():
+    relaxed_manifest.enable()
+
+
+def tearDownModule():
+    relaxed_manifest.disable()
+
+
+class ConversationTimelineTests(TestCase):
+    def setUp(self):
+        caching.get_cache().clear()
+        self.alice = User.objects.create_user("alice", password="pw")
+        self.bob = User.objects.create_user("bob", password="pw")
+        services.accept_connection(services.request_connection(self.alice, self.bob)[0])
+        self.client.force_login(self.alice)
+
+    def write(self, sender, receiver, content, when):
+        letter = services.send_letter(sender, receiver, content)
+        Letter.objects.filter(pk=letter.pk).update(created_at=when)
+        return letter
+
+    def test_pages_walk_back_without_overlap(self):
+        start = timezone.now() - timedelta(days=30)
+        for i in range(45):
+            self.write(self.alice, self.bob, f"letter {i}", start + timedelta(hours=i))
+
+        url = reverse("conversation", args=[self.bob.id])
+        seen = []
+        cursor = None
+        while True:
+            response = self.client.get(url, {"before": cursor} if cursor else {})
+            seen = [l.id for l in response.context["letters"]] + seen
+            cursor = response.context["older_cursor"]
+            if not cursor:
+                break
+
+        self.assertEqual(seen, list(
+            Letter.objects.order_by("created_at", "id").values_list("id", flat=True)
+        ))
+
+    def test_shows_latest_approved_version_only(self):
+        letter = self.write(self.bob, self.alice, "first", timezone.now())
+        services.approve_version(services.propose_modification(letter, "second"))
+        services.propose_modification(letter, "proposal")
+
+        response = self.client.get(reverse("conversation", args=[self.bob.id]))
+
+        [shown] = response.context["letters"]
+        self.assertEqual(shown.current_version.content, "second")
+        self.assertTrue(shown.has_pending)
+        self.assertNotContains(response, "proposal")
+
+    def test_query_count_does_not_grow_with_edits(self):
+        def render():
+            with CaptureQueriesContext(connection) as ctx:
+                self.client.get(reverse("conversation", args=[self.bob.id]))
+            return len(ctx)
+
+        render()  # caches who alice is connected to
+        for i in range(5):
+            letter = self.write(self.bob, self.alice, f"letter {i} " * 30, timezone.now())
+        baseline = render()
+
+        for i in range(15):
+            letter = self.write(self.bob, self.alice, f"letter {i} " * 30, timezone.now())
+            for n in range(3):
+                services.approve_version(services.propose_modification(letter, f"edit {n} " + f"letter {i} " * 30))
+        self.assertEqual(render(), baseline + 1)  # one extra query rebuilds all delta chains
+
+    def test_approval_moves_current_pointer(self):
+        letter = self.write(self.bob, self.alice, "first", timezone.now())
+        version = services.propose_modification(letter, "second draft")
+        letter.refresh_from_db()
+        self.assertEqual(letter.preview, "first")
+
+        services.approve_version(version)
+        letter.refresh_from_db()
+        self.assertEqual(letter.current_version_id, version.id)
+        self.assertEqual(letter.preview, "second draft")
+
+    def test_invalid_cursor_is_rejected(self):
+        response = self.client.get(
+            reverse("conversation", args=[self.bob.id]), {"before": "garbage"}
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_history_is_limited_to_participants(self):
+        carol = User.objects.create_user("carol", password="pw")
+        letter = self.write(self.bob, carol, "private", timezone.now())
+
+        response = self.client.get(reverse("letter_history", args=[letter.id]))
+
+        self.assertEqual(response.status_code, 404)
+
+
+class DashboardSummaryTests(TestCase):
+    def setUp(self):
+        caching.get_cache().clear()
+        self.alice = User.objects.create_user("alice", password="pw")
+        self.bob = User.objects.create_user("bob", password="pw")
+
+    def summary(self, owner, contact):
+        return ContactSummary.objects.get(owner=owner, contact=contact)
+
+    def test_summary_follows_writes(self):
+        conn, _ = services.request_connection(self.alice, self.bob)
+        self.assertFalse(self.summary(self.bob, self.alice).accepted)
+        self.assertFalse(ContactSummary.objects.filter(owner=self.alice).exists())
+
+        services.accept_connection(conn)
+        self.assertTrue(self.summary(self.alice, self.bob).accepted)
+
+        letter = services.send_letter(self.alice, self.bob, "hello")
+        self.assertEqual(self.summary(self.bob, self.alice).unread_count, 1)
+        self.assertEqual(self.summary(self.alice, self.bob).last_letter_at, letter.created_at)
+
+        version = services.propose_modification(letter, "hello there")
+        self.assertEqual(self.summary(self.alice, self.bob).pending_approval_count, 1)
+        services.approve_version(version)
+        services.approve_version(version)
+        self.assertEqual(self.summary(self.alice, self.bob).pending_approval_count, 0)
+
+        services.mark_conversation_read(self.bob, self.alice)
+        self.assertEqual(self.summary(self.bob, self.alice).unread_count, 0)
+
+    def test_dashboard_query_count_is_flat(self):
+        self.client.force_login(self.alice)
+        for i in range(10):
+            other = User.objects.create(username=f"friend{i}")
+            conn, _ = services.request_connection(other, self.alice)
+            if i % 2:
+                services.accept_connection(conn)
+
+        # The session, the user, a single summary read, the stats row and
+        # the activity feed.
+        with self.assertNumQueries(5):
+            response = self.client.get(reverse("dashboard"))
+        self.assertEqual(len(response.context["connections"]), 5)
+        self.assertEqual(len(response.context["pending_requests"]), 5)
+
+
+class StatsTests(TestCase):
+    def setUp(self):
+        caching.get_cache().clear()
+        self.alice = User.objects.create_user("alice", password="pw")
+        self.bob = User.objects.create_user("bob", password="pw")
+        self.conn, _ = services.request_connection(self.bob, self.alice)
+
+    def counters(self, user):
+        row = stats.for_user(user)
+        return {field: getattr(row, field) for field in stats.FIELDS}
+
+    def test_counters_follow_writes(self):
+        services.accept_connection(self.conn)
+        services.accept_connection(self.conn)
+        letter = services.send_letter(self.alice, self.bob, "hello")
+        services.send_letter(self.bob, self.alice, "hi")
+        services.send_letters(self.bob, [self.alice], "again")
+        first = services.propose_modification(letter, "hello there")
+        second = services.propose_modification(letter, "hello again")
+        self.assertEqual(self.counters(self.alice), {
+            "letters_sent": 1, "letters_received": 2, "pending_approvals": 2, "pending_proposals": 0, "contacts": 1,
+        })
+        self.assertEqual(self.counters(self.bob)["pending_proposals"], 2)
+
+        services.approve_version(first)
+        services.reject_versions(self.alice, [second.id])
+        self.assertEqual(self.counters(self.alice)["pending_approvals"], 0)
+        self.assertEqual(self.counters(self.bob)["pending_proposals"], 0)
+        self.assertEqual(ContactSummary.objects.get(owner=self.bob, contact=self.alice).letter_count, 3)
+
+    def test_dashboard_shows_stats_and_activity(self):
+        services.accept_connection(self.conn)
+        services.send_letter(self.bob, self.alice, "hello")
+        self.client.force_login(self.alice)
+        response = self.client.get(reverse("dashboard"))
+        self.assertContains(response, "0 sent · 1 received · 1 connection")
+        self.assertEqual([s.contact for s in response.context["top_correspondents"]], [self.bob])
+        self.assertEqual(
+            [(e.actor, e.summary) for e in response.context["activity"]],
+            [(self.bob, "sent a letter"), (self.bob, "asked to connect")],
+        )
+        api = self.client.get(reverse("api-stats")).json()
+        self.assertEqual((api["letters_received"], api["top_correspondents"][0]["letters"]), (1, 1))
+
+    def test_reconcile_repairs_drift(self):
+        services.accept_connection(self.conn)
+        letter = services.send_letter(self.alice, self.bob, "hello")
+        services.propose_modification(letter, "hello there")
+        expected = self.counters(self.alice), self.counters(self.bob)
+        UserStats.objects.filter(user=self.alice).update(letters_sent=7, contacts=0)
+        UserStats.objects.filter(user=self.bob).delete()
+        ContactSummary.objects.filter(owner=self.alice).update(letter_count=0)
+
+        out = io.StringIO()
+        call_command("reconcile_stats", stdout=out)
+        self.assertIn("Created 1 and fixed 1 user counters, fixed 1 contact summaries", out.getvalue())
+        self.assertEqual((self.counters(self.alice), self.counters(self.bob)), expected)
+        self.assertEqual(ContactSummary.objects.get(owner=self.alice).letter_count, 1)
+
+
+class ConnectionGraphTests(TestCase):
+    def setUp(self):
+        caching.get_cache().clear()
+        self.alice = User.objects.create_user("alice", password="pw")
+        self.bob = User.objects.create_user("bob", password="pw")
+        self.carol = User.objects.create_user("carol", password="pw")
+
+    def test_one_connection_per_pair(self):
+        conn, created = services.request_connection(self.bob, self.alice)
+        self.assertTrue(created)
+        self.assertEqual((conn.user_low, conn.user_high), (self.alice, self.bob))
+        self.assertEqual(services.request_connection(self.bob, self.alice), (conn, False))
+
+        # Asking back accepts the open request rather than adding a mirrored row.
+        mirrored, created = services.request_connection(self.alice, self.bob)
+        self.assertEqual((mirrored.id, created, mirrored.accepted), (conn.id, False, True))
+        self.assertEqual(Connection.objects.count(), 1)
+
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Connection.objects.create(requester=self.alice, receiver=self.bob)
+
+    @override_settings(LETTERS_GRAPH_CACHE=True)
+    def test_adjacency_is_cached_until_a_connection_changes(self):
+        conn, _ = services.request_connection(self.alice, self.bob)
+        self.assertEqual(graph.related(self.alice.id), {self.bob.id})
+        self.assertFalse(graph.are_connected(self.alice.id, self.bob.id))
+
+        services.accept_connection(conn)
+        with self.assertNumQueries(2):
+            self.assertTrue(graph.are_connected(self.alice.id, self.bob.id))
+            self.assertTrue(graph.are_connected(self.bob.id, self.alice.id))
+        with self.assertNumQueries(0):
+            self.assertTrue(graph.are_connected(self.bob.id, self.alice.id))
+            self.assertFalse(graph.are_connected(self.alice.id, self.carol.id))
+
+    def test_adjacency_is_read_every_time_without_a_shared_cache(self):
+        conn, _ = services.request_connection(self.alice, self.bob)
+        with self.assertNumQueries(2):
+            self.assertFalse(graph.are_connected(self.alice.id, self.bob.id))
+            self.assertFalse(graph.are_connected(self.alice.id, self.bob.id))
+        # As another worker would see it: the accept bumps nothing here.
+        Connection.objects.filter(id=conn.id).update(accepted=True)
+        self.assertTrue(graph.are_connected(self.alice.id, self.bob.id))
+
+    def test_pages_need_a_connection(self):
+        self.client.force_login(self.alice)
+        for url in (reverse("conversation", args=[self.carol.id]), reverse("send_letter", args=[self.carol.id])):
+            self.assertRedirects(self.client.get(url), reverse("dashboard"), fetch_redirect_response=False)
+        response = self.client.post(reverse("send_letter", args=[self.carol.id]), {"content": "hi"})
+        self.assertRedirects(response, reverse("dashboard"), fetch_redirect_response=False)
+        self.assertFalse(Letter.objects.exists())
+
+        response = self.client.post("/api/letters/", {"receiver": self.carol.id, "content": "hi"})
+        self.assertEqual(response.status_code, 403)
+        response = self.client.post("/api/connections/", {"receiver_id": self.alice.id})
+        self.assertEqual(response.status_code, 400)
+
+
+class UserSearchTests(TestCase):
+    def setUp(self):
+        caching.get_cache().clear()
+        self.me = User.objects.create_user("searcher", password="pw")
+        for name in ["marianne", "anna", "annabel", "hannah", "joanna", "anneke"]:
+            User.objects.create(username=name)
+        self.client.force_login(self.me)
+
+    def search(self, query, page=1):
+        return self.client.get(reverse("search_user"), {"username": query, "page": page})
+
+    def names(self, response):
+        return [u.username for u in response.context["users"]]
+
+    def test_prefix_matches_rank_first(self):
+        names = self.names(self.search("anna"))
+        self.assertEqual(names[:2], ["anna", "annabel"])
+        self.assertCountEqual(names[2:], ["hannah", "joanna"])
+
+    def test_prefix_ignores_case(self):
+        User.objects.create(username="Alice")
+        self.assertEqual(self.names(self.search("al")), ["Alice"])
+        self.assertEqual(self.names(self.search("ANNA"))[:2], ["anna", "annabel"])
+
+    def test_short_queries_match_substrings(self):
+        # Too short for the trigram table.
+        self.assertEqual(self.names(self.search("ek")), ["anneke"])
+        self.assertEqual(self.names(self.search("b")), ["annabel"])
+
+    def test_typo_still_matches(self):
+        self.assertIn("marianne", self.names(self.search("maryanne")))
+
+    def test_connected_users_are_excluded(self):
+        services.request_connection(self.me, User.objects.get(username="annabel"))
+        names = self.names(self.search("anna"))
+        self.assertNotIn("annabel", names)
+        self.assertNotIn("searcher", names)
+
+    def test_results_are_paged_and_capped(self):
+        User.objects.bulk_create(User(username=f"zed{i:03}") for i in range(150))
+        seen = []
+        page = 1
+        while True:
+            response = self.search("zed", page)
+            seen += self.names(response)
+            if not response.context["has_next"]:
+                break
+            page += 1
+        self.assertEqual(seen, [f"zed{i:03}" for i in range(100)])
+
+
+class LetterSearchTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user("alice", password="pw")
+        self.bob = User.objects.create_user("bob", password="pw")
+        self.carol = User.objects.create_user("carol", password="pw")
+        self.client.force_login(self.alice)
+
+    def search(self, query):
+        queue.run_pending()
+        response = self.client.get(reverse("search_letters"), {"q": query})
+        return [v.content for v in response.context["versions"]]
+
+    def test_only_own_approved_versions_match(self):
+        letter = services.send_letter(self.bob, self.alice, "the lighthouse keeper")
+        services.send_letter(self.bob, self.carol, "another lighthouse story")
+        services.propose_modification(letter, "the lighthouse keeper waved")
+
+        self.assertEqual(self.search("lighthouse"), ["the lighthouse keeper"])
+
+    def test_approved_modification_becomes_searchable(self):
+        letter = services.send_letter(self.alice, self.bob, "dear bob")
+        version = services.propose_modification(letter, "dear bob, greetings from lisbon")
+        self.assertEqual(self.search("lisbon"), [])
+
+        services.approve_version(version)
+        self.assertEqual(self.search("lisbon"), ["dear bob, greetings from lisbon"])
+
+    def test_delta_stored_hits_cost_no_query_each(self):
+        letter = services.send_letter(self.alice, self.bob, "Dear Bob, the harbour was busy today. " * 10)
+        for n in range(6):
+            text = letter.versions.order_by("-id").first().content
+            services.approve_version(services.propose_modification(letter, text + f" postscript{n}"))
+        self.assertTrue(letter.versions.exclude(delta_parent=None).exists())
+        queue.run_pending()
+
+        def queries(query):
+            with CaptureQueriesContext(connection) as captured:
+                response = self.client.get(reverse("search_letters"), {"q": query})
+            return len(captured), len(response.context["versions"])
+
+        one, many = queries("postscript5"), queries("harbour")
+        self.assertEqual((one[1], many[1]), (1, 7))
+        self.assertEqual(one[0], many[0])
+
+    def test_last_word_matches_as_prefix(self):
+        services.send_letter(self.alice, self.bob, "walking through the orchard")
+        self.assertEqual(self.search("orch"), ["walking through the orchard"])
+
+
+class DeltaStorageTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create(username="alice")
+        self.bob = User.objects.create(username="bob")
+        self.letter = services.send_letter(self.alice, self.bob, "Dear Bob, the garden is lovely this year. " * 20)
+
+    def edit(self, n):
+        text = self.letter.versions.order_by("-id").first().content
+        version = services.propose_modification(self.letter, text.replace("lovely", f"lovely{n}", 1))
+        services.approve_version(version)
+        return version, version.content
+
+    def test_edits_are_stored_as_deltas_and_rebuilt(self):
+        expected = {}
+        for n in range(40):
+            version, text = self.edit(n)
+            expected[version.id] = text
+
+        stored = LetterVersion.objects.filter(id__in=expected)
+        self.assertTrue(all(v.delta_depth < delta.SNAPSHOT_INTERVAL for v in stored))
+        self.assertGreater(sum(v.delta_parent_id is not None for v in stored), 30)
+        self.assertLess(
+            sum(len(v.stored_content) for v in stored),
+            sum(map(len, expected.values())) / 5,
+        )
+
+        fresh = list(LetterVersion.objects.filter(id__in=expected))
+        with self.assertNumQueries(1):
+            LetterVersion.objects.fill_content(fresh)
+        self.assertEqual({v.id: v.content for v in fresh}, expected)
+
+    def test_rejecting_a_proposal_keeps_versions_stored_against_it(self):
+        text = self.letter.current_version.content
+        proposal = services.propose_modification(self.letter, text + " P.S. the roses")
+        # As an older release or import could leave them: a chain through the proposal.
+        chain, parent, expected = [], proposal, {}
+        for n in range(2):
+            content = parent.content + f" and the tulips{n}"
+            version = LetterVersion.objects.create(
+                letter=self.letter, approved=True,
+                stored_content=delta.compress(parent.content, parent.delta_depth, content),
+                delta_parent=parent, delta_base_id=parent.delta_base_id or parent.id,
+                delta_depth=parent.delta_depth + 1,
+            )
+            chain.append(version)
+            expected[version.id] = content
+            parent = version
+
+        self.assertEqual(services.reject_versions(self.alice, [proposal.id]), 1)
+        fresh = LetterVersion.objects.fill_content(list(LetterVersion.objects.filter(id__in=expected)))
+        self.assertEqual({v.id: v.content for v in fresh}, expected)
+        self.assertFalse(LetterVersion.objects.filter(delta_parent__approved=False).exists())
+
+    def test_letter_with_delta_history_can_be_deleted(self):
+        self.edit(1)
+        self.letter.delete()
+        self.assertFalse(LetterVersion.objects.exists())
+
+
+class ReplicaRoutingTests(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.alice = User.objects.create_user("alice")
+
+    def route(self, request, write=False):
+        seen = {}
+
+        def view(request):
+            seen["before"] = router.db_for_read(Letter)
+            if write:
+                router.db_for_write(Letter)
+            seen["after"] = router.db_for_read(Letter)
+            seen["timeout"] = replicas.cache_timeout(caching.TIMEOUT)
+            return HttpResponse()
+
+        with override_settings(LETTERS_READ_REPLICAS=["replica1"]):
+            response = ReplicaRoutingMiddleware(view)(request)
+        return seen, response.cookies.get(replicas.COOKIE_NAME)
+
+    def test_reads_follow_the_users_writes(self):
+        # The test case's transaction would keep every read on the primary.
+        with mock.patch.object(connection, "in_atomic_block", False):
+            seen, cookie = self.route(self.factory.get("/dashboard/"))
+            self.assertEqual((seen["before"], seen["after"], cookie), ("replica1", "replica1", None))
+            self.assertEqual(seen["timeout"], settings.LETTERS_REPLICA_STICKY_SECONDS)
+
+            seen, cookie = self.route(self.factory.get("/conversation/1/"), write=True)
+            self.assertEqual((seen["before"], seen["after"]), ("replica1", "default"))
+            seen, cookie = self.route(self.factory.post("/send/1/"))
+            self.assertEqual((seen["before"], seen["timeout"]), ("default", caching.TIMEOUT))
+
+            request = self.factory.get("/dashboard/")
+            request.COOKIES[replicas.COOKIE_NAME] = cookie.value
+            self.assertEqual(self.route(request)[0]["before"], "default")
+            request.COOKIES[replicas.COOKIE_NAME] = str(int(time.time()) - 1)
+            self.assertEqual(self.route(request)[0]["before"], "replica1")
+
+        self.assertEqual(self.route(self.factory.get("/dashboard/"))[0]["before"], "default")
+        self.assertEqual(router.db_for_read(Letter), "default")
+        with override_settings(LETTERS_READ_REPLICAS=[]):
+            self.assertRaises(MiddlewareNotUsed, ReplicaRoutingMiddleware, lambda request: None)
+
+    @override_settings(LETTERS_GRAPH_CACHE=True)
+    def test_graph_cache_is_capped_while_reading_a_replica(self):
+        # "Not connected" read from a lagging replica must not outlive the window.
+        with mock.patch.object(replicas, "cache_timeout", return_value=7) as capped:
+            with mock.patch.object(caching.get_cache(), "set") as cache_set:
+                graph.adjacency(self.alice.id)
+        capped.assert_called_once_with(caching.TIMEOUT)
+        self.assertEqual(cache_set.call_args.args[2], 7)
+
+
+@skipUnless(settings.LETTERS_READ_REPLICAS, "set DATABASE_REPLICA_URLS to route to a real replica")
+class ReplicaDatabaseTests(TransactionTestCase):
+    databases = {"default", *settings.LETTERS_READ_REPLICAS}
+
+    def test_pages_read_the_replica_until_the_user_writes(self):
+        alice = User.objects.create_user("alice", password="pw")
+        bob = User.objects.create_user("bob", password="pw")
+        services.accept_connection(services.request_connection(alice, bob)[0])
+        self.client.force_login(alice)
+        replica = connections[settings.LETTERS_READ_REPLICAS[0]]
+
+        def queries(method, path, **data):
+            with CaptureQueriesContext(connection) as primary, CaptureQueriesContext(replica) as read:
+                response = getattr(self.client, method)(path, data)
+            self.assertLess(response.status_code, 400)
+            return len(primary), len(read)
+
+        self.assertEqual(queries("get", reverse("search_user"), username="bo")[0], 0)
+        self.assertEqual(queries("post", reverse("send_letter", args=[bob.id]), content="hello")[1], 0)
+        self.assertEqual(queries("get", reverse("search_user"), username="bo")[1], 0)
+
+
+class EditConflictTests(TestCase):
+    def setUp(self):
+        caching.get_cache().clear()
+        self.alice = User.objects.create_user("alice", password="pw")
+        self.bob = User.objects.create_user("bob", password="pw")
+        services.accept_connection(services.request_connection(self.alice, self.bob)[0])
+        self.letter = services.send_letter(self.alice, self.bob, "first")
+
+    def test_approving_a_stale_proposal_changes_nothing(self):
+        first = services.propose_modification(self.letter, "edit 0")
+        second = services.propose_modification(self.letter, "edit 1")
+        self.assertEqual(second.base_version_id, self.letter.current_version_id)
+        services.approve_version(first)
+
+        with self.assertRaises(services.VersionConflict):
+            services.approve_version(LetterVersion.objects.select_related("letter").get(pk=second.pk))
+        self.letter.refresh_from_db()
+        self.assertEqual(self.letter.current_version_id, first.id)
+        self.assertFalse(LetterVersion.objects.get(pk=second.pk).approved)
+        self.assertEqual(stats.for_user(self.alice).pending_approvals, 1)
+
+        with self.assertRaises(services.VersionConflict):
+            services.propose_modification(self.letter, "edit 2", second.base_version_id)
+        services.approve_version(services.propose_modification(self.letter, "edit 2", first.id))
+
+    def test_views_answer_conflicts_with_409(self):
+        base = self.letter.current_version_id
+        stale = services.propose_modification(self.letter, "edit 0")
+        services.approve_version(services.propose_modification(self.letter, "edit 1"))
+
+        self.client.force_login(self.alice)
+        response = self.client.post(f"/api/versions/{stale.id}/approve/")
+        self.assertEqual(response.status_code, 409, response.content)
+        self.assertEqual(response.json()["current_version"], Letter.objects.get().current_version_id)
+
+        self.client.force_login(self.bob)
+        url = f"/api/letters/{self.letter.id}/versions/"
+        response = self.client.post(url, {"content": "edit 2", "base_version": base}, content_type="application/json")
+        self.assertEqual(response.status_code, 409, response.content)
+        current = response.json()["current_version"]
+        response = self.client.post(url, {"content": "edit 2", "base_version": current}, content_type="application/json")
+        self.assertEqual((response.status_code, response.json()["base_version"]), (201, current))
+
+        response = self.client.post(reverse("modify", args=[self.letter.id]), {
+            "proposed_content": "my draft", "base_version": str(base),
+        })
+        self.assertContains(response, "my draft", status_code=409)
+
+
+class EditContentionTests(TransactionTestCase):
+    proposers = 16
+
+    def test_simultaneous_proposers_lose_no_edits(self):
+        alice = User.objects.create_user("alice")
+        bob = User.objects.create_user("bob")
+        services.accept_connection(services.request_connection(alice, bob)[0])
+        first = services.send_letter(alice, bob, "draft")
+        # The in-memory test database takes one connection at a time, so
+        # queries queue on a lock; every worker still reads the letter
+        # before anyone writes, which is the race the version check catches.
+        db = threading.Lock()
+        start = threading.Barrier(self.proposers)
+
+        def edit(n):
+            conflicts = 0
+            try:
+                start.wait()
+                while True:
+                    with db:
+                        letter = Letter.objects.get(pk=first.pk)
+                    time.sleep(0)
+                    with db:
+                        version = services.propose_modification(letter, f"edit {n}", letter.current_version_id)
+                    try:
+                        with db:
+                            services.approve_version(version)
+                        return conflicts
+                    except services.VersionConflict:
+                        conflicts += 1
+                        with db:
+                            services.reject_versions(alice, [version.id])
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(self.proposers) as pool:
+            conflicts = sum(pool.map(edit, range(self.proposers)))
+
+        history = list(LetterVersion.objects.filter(letter=first).order_by("created_at", "id"))
+        self.assertEqual(sorted(v.content for v in history[1:]), sorted(f"edit {n}" for n in range(self.proposers)))
+        # Each edit was made against the one before it: a single line of history.
+        self.assertEqual([v.base_version_id for v in history[1:]], [v.id for v in history[:-1]])
+        self.assertEqual(Letter.objects.get(pk=first.pk).current_version_id, history[-1].id)
+        self.assertGreaterEqual(conflicts, self.proposers - 1)
+        self.assertEqual(stats.for_user(alice).pending_approvals, 0)
+
+
+class ApiTests(TestCase):
+    def setUp(self):
+        caching.get_cache().clear()
+        self.alice = User.objects.create(username="alice")
+        self.bob = User.objects.create(username="bob")
+        conn, _ = services.request_connection(self.alice, self.bob)
+        services.accept_connection(conn)
+        for i in range(12):
+            letter = services.send_letter(self.alice, self.bob, f"letter {i} " * 20)
+            for n in range(3):
+                services.approve_version(services.propose_modification(letter, f"edit {n} " + f"letter {i} " * 20))
+        self.letter = letter
+        self.client.force_login(self.alice)
+
+    def get(self, url, queries, **params):
+        with self.assertNumQueries(queries):
+            response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    # Every authenticated request costs a session and a user lookup; see
+    # LoginTests for the cached variant. Lists and histories also read the
+    # archive (ArchiveTests), and lists read sent and received letters apart.
+
+    def test_letter_list(self):
+        data = self.get("/api/letters/", 7, page_size=5)
+        self.assertEqual(len(data["results"]), 5)
+        self.assertTrue(data["results"][0]["current_version"]["content"].startswith("edit 2 letter 11"))
+
+        cursor = parse_qs(urlsplit(data["next"]).query)["cursor"][0]
+        data = self.get("/api/letters/", 7, page_size=5, cursor=cursor)
+        self.assertTrue(data["results"][0]["preview"].startswith("edit 2 letter 6"))
+
+    def test_sparse_fieldset_skips_joins(self):
+        data = self.get("/api/letters/", 6, fields="id,preview")
+        self.assertEqual(set(data["results"][0]), {"id", "preview"})
+
+    def test_letter_detail(self):
+        data = self.get(f"/api/letters/{self.letter.id}/", 4)
+        self.assertEqual(data["sender"]["username"], "alice")
+
+    def test_letter_versions(self):
+        data = self.get(f"/api/letters/{self.letter.id}/versions/", 6)
+        self.assertEqual(len(data["results"]), 4)
+
+    def test_connections(self):
+        data = self.get("/api/connections/", 3)
+        self.assertEqual(data["results"][0]["receiver"]["username"], "bob")
+
+    def test_conditional_get(self):
+        response = self.client.get("/api/letters/")
+        etag = response["ETag"]
+        response = self.client.get("/api/letters/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_propose_and_approve(self):
+        self.client.force_login(self.bob)
+        response = self.client.post(
+            f"/api/letters/{self.letter.id}/versions/", {"content": "bob's take"}
+        )
+        self.assertEqual(response.status_code, 201)
+        version_id = response.json()["id"]
+
+        response = self.client.post(f"/api/versions/{version_id}/approve/")
+        self.assertEqual(response.status_code, 403)
+
+        self.client.force_login(self.alice)
+        response = self.client.post(f"/api/versions/{version_id}/approve/")
+        self.assertEqual(response.status_code, 200)
+        self.letter.refresh_from_db()
+        self.assertEqual(self.letter.current_version_id, version_id)
+
+    def test_other_users_letters_are_hidden(self):
+        carol = User.objects.create(username="carol")
+        self.client.force_login(carol)
+        self.assertEqual(self.client.get("/api/letters/").json()["results"], [])
+        self.assertEqual(self.client.get(f"/api/letters/{self.letter.id}/").status_code, 404)
+
+
+class BulkTests(TestCase):
+    def setUp(self):
+        caching.get_cache().clear()
+        self.alice = User.objects.create(username="alice")
+        self.friends = [User.objects.create(username=f"friend{i}") for i in range(6)]
+        for friend in self.friends:
+            services.accept_connection(services.request_connection(self.alice, friend)[0])
+        self.stranger = User.objects.create(username="stranger")
+
+    def test_send_to_many_in_constant_queries(self):
+        def send(receivers):
+            caching.get_cache().clear()
+            with CaptureQueriesContext(connection) as ctx:
+                letters = services.send_letters(self.alice, receivers, "Dear {username}, hello")
+            return letters, len(ctx)
+
+        letters, few = send(self.friends[:2] + [self.stranger])
+        self.assertEqual([l.receiver for l in letters], self.friends[:2])
+        self.assertEqual(letters[1].current_version.content, "Dear friend1, hello")
+        self.assertEqual(ContactSummary.objects.get(owner=self.friends[0], contact=self.alice).unread_count, 1)
+        queue.run_pending()
+        self.assertEqual(len(get_letter_search_backend().search(self.friends[1], "hello")), 1)
+
+        _, many = send(self.friends)
+        self.assertEqual(few, many)
+
+    def test_batch_approve_and_reject(self):
+        bob = self.friends[0]
+        letter = services.send_letter(self.alice, bob, "first")
+        first, second, third = (services.propose_modification(letter, f"edit {n}") for n in range(3))
+        other = services.propose_modification(services.send_letter(bob, self.alice, "mine"), "edit")
+
+        # All three were proposed against "first", so only the oldest applies.
+        approved, stale = services.approve_versions(self.alice, [second.id, first.id, other.id])
+        self.assertEqual(([v.id for v in approved], [v.id for v in stale]), ([first.id], [second.id]))
+        letter.refresh_from_db()
+        self.assertEqual((letter.current_version_id, letter.preview), (first.id, "edit 0"))
+        summary = ContactSummary.objects.get(owner=self.alice, contact=bob)
+        self.assertEqual(summary.pending_approval_count, 2)
+
+        self.assertEqual(services.reject_versions(self.alice, [third.id, second.id]), 2)
+        self.assertFalse(LetterVersion.objects.filter(id=third.id).exists())
+        summary.refresh_from_db()
+        self.assertEqual(summary.pending_approval_count, 0)
+
+    def test_bulk_api(self):
+        self.client.force_login(self.alice)
+        response = self.client.post(
+            "/api/letters/bulk/",
+            {"receivers": [f.id for f in self.friends[:3]], "content": "hi"},
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual(len(response.json()), 3)
+
+        letter = Letter.objects.get(id=response.json()[0]["id"])
+        version = services.propose_modification(letter, "hi there")
+        response = self.client.post(
+            "/api/versions/bulk-approve/", {"ids": [version.id]}, content_type="application/json"
+        )
+        self.assertEqual(response.json(), {"approved": [version.id], "conflicts": []})
+
+
+calls = []
+
+
+@queue.task("tests.record", max_attempts=2)
+def record(value, fail=False):
+    calls.append(value)
+    if fail:
+        raise RuntimeError("boom")
+
+
+class QueueTests(TestCase):
+    def setUp(self):
+        calls.clear()
+
+    def test_runs_by_priority(self):
+        record.enqueue(value="low")
+        record.enqueue(value="high", priority=5)
+        record.enqueue(value="later", delay=60)
+        self.assertEqual(queue.run_pending(), (2, 0))
+        self.assertEqual(calls, ["high", "low"])
+        self.assertEqual(Task.objects.get().payload, {"value": "later"})
+
+    def test_failures_retry_with_backoff_then_stop(self):
+        task = record.enqueue(value="x", fail=True)
+        with self.assertLogs("letters.queue", "ERROR"):
+            self.assertEqual(queue.run_pending(), (0, 1))
+        task.refresh_from_db()
+        self.assertEqual((task.status, task.attempts), (Task.QUEUED, 1))
+        self.assertGreater(task.run_at, timezone.now())
+        self.assertIn("boom", task.last_error)
+
+        Task.objects.update(run_at=timezone.now())
+        with self.assertLogs("letters.queue", "ERROR"):
+            queue.run_pending()
+        task.refresh_from_db()
+        self.assertEqual((task.status, task.attempts), (Task.FAILED, 2))
+
+    def test_claimed_tasks_are_not_claimed_twice(self):
+        for i in range(3):
+            record.enqueue(value=i)
+        first = queue.claim("a", limit=2)
+        second = queue.claim("b", limit=5)
+        self.assertEqual(len(first), 2)
+        self.assertEqual([t.payload["value"] for t in second], [2])
+
+        Task.objects.filter(id=first[0].id).update(locked_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(queue.requeue_stale(600), 1)
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create(username="alice")
+        self.bob = User.objects.create(username="bob")
+        self.carol = User.objects.create(username="carol")
+        self.letter = services.send_letter(self.alice, self.bob, "word " * 50)
+        for n in range(5):
+            services.approve_version(services.propose_modification(self.letter, f"edit {n} " + "word " * 50))
+        services.propose_modification(self.letter, "pending " + "word " * 50)
+        services.send_letter(self.carol, self.alice, "hi alice")
+        services.send_letter(self.carol, self.bob, "not alice's")
+
+    def test_ndjson_rebuilds_every_version(self):
+        self.assertTrue(LetterVersion.objects.filter(delta_depth__gt=0).exists())
+        out = io.BytesIO()
+        with CaptureQueriesContext(connection) as ctx:
+            for chunk in export.export(export.letters_of(self.alice), chunk_size=1):
+                out.write(chunk)
+        # The letters, then for each chunk of one letter its archived and live versions.
+        self.assertEqual(len(ctx), 5)
+
+        first, second = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual((first["sender"], first["receiver"]), ("alice", "bob"))
+        self.assertEqual(
+            [v["content"] for v in first["versions"]],
+            [v.content for v in self.letter.versions.order_by("created_at", "id")],
+        )
+        self.assertEqual([v["current"] for v in first["versions"]], [False] * 5 + [True, False])
+        self.assertEqual(second["versions"][0]["content"], "hi alice")
+
+    def test_zip_download_of_one_conversation(self):
+        self.client.force_login(self.alice)
+        response = self.client.get(reverse("export"), {"with": self.bob.id, "format": "zip"})
+        self.assertEqual(response["Content-Type"], "application/zip")
+        archive = zipfile.ZipFile(io.BytesIO(b"".join(response.streaming_content)))
+        [line] = archive.read("letters.ndjson").splitlines()
+        self.assertEqual(len(json.loads(line)["versions"]), 7)
+
+    def test_bad_conversation_user(self):
+        self.client.force_login(self.alice)
+        self.assertEqual(self.client.get(reverse("export"), {"with": "abc"}).status_code, 400)
+        self.assertEqual(self.client.get(reverse("export"), {"with": "999999"}).status_code, 404)
+
+    async def test_streams_under_asgi(self):
+        await self.async_client.aforce_login(self.alice)
+        response = await self.async_client.get(reverse("export"), {"format": "json"})
+        body = b"".join([chunk async for chunk in response.streaming_content])
+        self.assertEqual(len(json.loads(body)), 2)
+
+
+class ArchiveTests(TestCase):
+    def setUp(self):
+        caching.get_cache().clear()
+        self.alice = User.objects.create_user("alice", password="pw")
+        self.bob = User.objects.create_user("bob", password="pw")
+        services.accept_connection(services.request_connection(self.alice, self.bob)[0])
+        self.client.force_login(self.alice)
+        self.long_ago = timezone.now() - timedelta(days=800)
+
+        # Old and untouched since: archived whole.
+        self.old = [self.write(f"old {i} " + "word " * 40, self.long_ago + timedelta(days=i)) for i in range(25)]
+        for n in range(3):
+            services.approve_version(services.propose_modification(self.old[0], f"edit {n} " + "word " * 40))
+        self.age(self.old[0], self.long_ago)
+        # Old, but with a proposal open: stays.
+        self.open = self.write("open " + "word " * 40, self.long_ago)
+        services.propose_modification(self.open, "proposal " + "word " * 40)
+        # Edited recently: stays, but sheds the versions it superseded long ago.
+        self.edited = self.write("edited " + "word " * 40, self.long_ago)
+        for n in range(3):
+            services.approve_version(services.propose_modification(self.edited, f"early {n} " + "word " * 40))
+        self.age(self.edited, self.long_ago)
+        services.approve_version(services.propose_modification(self.edited, "recent " + "word " * 40))
+        self.edited_history = [v.content for v in self.edited.versions.order_by("created_at", "id")]
+
+    def write(self, content, when):
+        letter = services.send_letter(self.bob, self.alice, content)
+        self.age(letter, when)
+        return letter
+
+    def age(self, letter, when):
+        Letter.objects.filter(pk=letter.pk).update(created_at=when)
+        for n, version in enumerate(letter.versions.order_by("created_at", "id")):
+            LetterVersion.objects.filter(pk=version.pk).update(created_at=when + timedelta(minutes=n))
+
+    def test_old_letters_and_superseded_versions_move(self):
+        search = get_letter_search_backend()
+        search.rebuild()
+        call_command("archive_letters", "--days", "365", stdout=io.StringIO())
+        self.assertEqual(search.search(self.alice, "old"), [])
+        self.assertEqual(search.search(self.alice, "early"), [])
+        self.assertEqual(len(search.search(self.alice, "recent")), 1)
+        if connection.vendor == "sqlite":
+            with connection.cursor() as cursor:
+                cursor.execute("INSERT INTO letters_version_fts (letters_version_fts) VALUES ('integrity-check')")
+
+        self.assertEqual(set(Letter.objects.values_list("id", flat=True)), {self.open.id, self.edited.id})
+        self.assertEqual(ArchivedLetter.objects.filter(whole=True).count(), 25)
+        # Of the edited letter only what it superseded moved; the rest
+        # reads back without the delta chains that ran through it.
+        self.assertEqual(self.edited.versions.count(), 1)
+        self.assertEqual(self.edited.versions.get().delta_depth, 0)
+        self.assertEqual(ArchivedLetter.objects.get(id=self.edited.id).version_count, 4)
+        self.assertFalse(archive.archivable_letters(timezone.now()).filter(id=self.open.id).exists())
+
+        # Reruns find nothing left to move.
+        out = io.StringIO()
+        call_command("archive_letters", "--days", "365", "--dry-run", stdout=out)
+        self.assertEqual([line.split()[0] for line in out.getvalue().splitlines()], ["0", "0"])
+
+    def test_pages_read_through_to_the_archive(self):
+        expected = list(Letter.objects.order_by("created_at", "id").values_list("id", flat=True))
+        call_command("archive_letters", "--days", "365", stdout=io.StringIO())
+
+        url = reverse("conversation", args=[self.bob.id])
+        seen = []
+        cursor = None
+        while True:
+            response = self.client.get(url, {"before": cursor} if cursor else {})
+            seen = [letter.id for letter in response.context["letters"]] + seen
+            cursor = response.context["older_cursor"]
+            if not cursor:
+                break
+        self.assertEqual(seen, expected)
+        self.assertContains(response, "edit 2 word")
+        self.assertContains(response, "Archived")
+
+        response = self.client.get(reverse("letter_history", args=[self.old[0].id]))
+        self.assertEqual(len(response.context["versions"]), 4)
+        response = self.client.get(reverse("letter_history", args=[self.edited.id]))
+        self.assertEqual([v.content for v in response.context["versions"]], self.edited_history[::-1])
+
+        self.client.force_login(User.objects.create_user("carol", password="pw"))
+        response = self.client.get(reverse("letter_history", args=[self.old[0].id]))
+        self.assertEqual(response.status_code, 404)
+
+    def test_api_reads_through_to_the_archive(self):
+        expected = list(Letter.objects.order_by("-created_at", "-id").values_list("id", flat=True))
+        call_command("archive_letters", "--days", "365", stdout=io.StringIO())
+
+        seen, params = [], {"page_size": 10, "with": self.bob.id}
+        while True:
+            data = self.client.get("/api/letters/", params).json()
+            seen += [letter["id"] for letter in data["results"]]
+            if not data["next"]:
+                break
+            params["cursor"] = parse_qs(urlsplit(data["next"]).query)["cursor"][0]
+        self.assertEqual(seen, expected)
+
+        old = self.client.get(f"/api/letters/{self.old[0].id}/").json()
+        self.assertEqual((old["archived"], old["current_version"]["content"]), (True, "edit 2 " + "word " * 40))
+        versions = self.client.get(f"/api/letters/{self.old[0].id}/versions/").json()["results"]
+        self.assertEqual([(v["letter"], v["archived"]) for v in versions], [(self.old[0].id, True)] * 4)
+        versions = self.client.get(f"/api/letters/{self.edited.id}/versions/").json()["results"]
+        self.assertEqual([v["content"] for v in versions], self.edited_history[::-1])
+        self.assertEqual([v["archived"] for v in versions], [False] + [True] * 4)
+
+        response = self.client.post(f"/api/letters/{self.old[0].id}/versions/", {"content": "too late"})
+        self.assertEqual(response.status_code, 403)
+
+        feed = self.client.get(reverse("api-changes"), {"limit": 1000}).json()
+        letters = {letter["id"]: letter["archived"] for letter in feed["letters"]}
+        self.assertEqual(set(letters), set(expected))
+        self.assertTrue(letters[self.old[0].id])
+
+        self.client.force_login(User.objects.create_user("carol"))
+        self.assertEqual(self.client.get(f"/api/letters/{self.old[0].id}/").status_code, 404)
+        self.assertEqual(self.client.get(f"/api/letters/{self.old[0].id}/versions/").status_code, 404)
+
+    def test_export_includes_the_archive(self):
+        def exported():
+            chunks = export.export(export.letters_of(self.alice), archived=export.archived_of(self.alice))
+            records = [json.loads(line) for line in b"".join(chunks).splitlines()]
+            return {r["id"]: [(v["content"], v["current"]) for v in r["versions"]] for r in records}
+
+        before = exported()
+        call_command("archive_letters", "--days", "365", stdout=io.StringIO())
+        self.assertEqual(exported(), before)
+
+
+class ImportTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create(username="alice")
+        self.bob = User.objects.create(username="bob")
+
+    def test_export_round_trip(self):
+        letter = services.send_letter(self.alice, self.bob, "word " * 40)
+        Letter.objects.filter(id=letter.id).update(created_at=timezone.now() - timedelta(days=400))
+        for n in range(3):
+            services.approve_version(services.propose_modification(letter, f"edit {n} " + "word " * 40))
+        services.propose_modification(letter, "pending " + "word " * 40)
+        exported = b"".join(export.export(export.letters_of(self.alice))).decode()
+        original = json.loads(exported)
+        Letter.objects.all().delete()
+
+        report = importer.Importer("test").run(importer.read_ndjson(exported.splitlines()))
+        self.assertEqual((report["letters"], report["versions"]), (1, 5))
+
+        letter = Letter.objects.select_related("current_version").get()
+        self.assertEqual(letter.created_at, parse_datetime(original["created_at"]))
+        self.assertEqual(letter.current_version.content, "edit 2 " + "word " * 40)
+        self.assertTrue(LetterVersion.objects.filter(delta_depth__gt=0).exists())
+        [again] = [json.loads(line) for line in b"".join(export.export(export.letters_of(self.alice))).splitlines()]
+        self.assertEqual(
+            [(v["content"], v["approved"], v["current"]) for v in again["versions"]],
+            [(v["content"], v["approved"], v["current"]) for v in original["versions"]],
+        )
+        self.assertEqual(ContactSummary.objects.get(owner=self.alice, contact=self.bob).pending_approval_count, 1)
+
+    def test_proposals_are_never_delta_parents(self):
+        text = "word " * 40
+        record = {"sender": "alice", "receiver": "bob", "versions": [
+            {"content": text + "proposed", "approved": False},
+            {"content": text + "approved", "approved": True},
+            {"content": text + "approved again", "approved": True},
+        ]}
+        importer.Importer("test").run([record])
+        proposal, first, second = LetterVersion.objects.order_by("id")
+        self.assertEqual((first.delta_parent_id, second.delta_parent_id), (None, first.id))
+        # Listed on the sender's approvals page.
+        self.assertEqual((proposal.approver_id, first.approver_id), (self.alice.id, None))
+
+        services.reject_versions(self.alice, [proposal.id])
+        self.assertEqual(
+            [v.content for v in LetterVersion.objects.order_by("id")], [text + "approved", text + "approved again"]
+        )
+
+    def test_csv_resumes_from_checkpoint(self):
+        rows = ["letter,sender,receiver,created_at,content"] + [
+            f"{n},alice,{'carol' if n == 2 else 'bob'},2020-01-0{n + 1}T10:00:00,letter {n}" for n in range(5)
+        ]
+        ImportCheckpoint.objects.create(source="diary.csv", records=1)
+        report = importer.Importer("diary.csv", batch_size=2).run(importer.read_csv(rows))
+
+        self.assertEqual((report["resumed_at"], report["letters"], report["skipped"]), (1, 3, 1))
+        self.assertEqual(
+            list(Letter.objects.order_by("created_at").values_list("preview", flat=True)),
+            ["letter 1", "letter 3", "letter 4"],
+        )
+        self.assertTrue(Connection.objects.get().accepted)
+        checkpoint = ImportCheckpoint.objects.get()
+        self.assertEqual((checkpoint.records, checkpoint.finished), (5, True))
+
+
+class ViewBenchmarkTests(TestCase):
+    def test_every_page_is_measured_without_errors(self):
+        report = bench.SUITES["views"](users=12, degree=3, letters=30, depth=3, repeat=3, memory_repeat=1)
+        self.assertEqual(report["letters"], 30)
+        self.assertEqual(
+            set(report["results"]),
+            {"dashboard", "search_user", "conversation", "send_letter", "modify_letter", "approve_modification"},
+        )
+        for name, result in report["results"].items():
+            self.assertEqual(result["errors"], 0, name)
+            self.assertGreater(result["queries_p50"], 0, name)
+            self.assertIsNotNone(result["peak_kb_max"], name)
+
+    def test_pages_link_only_immutable_static_assets(self):
+        report = bench.SUITES["payload"](users=12, degree=3, letters=30, depth=2)
+        for name, page in report["pages"].items():
+            self.assertEqual((page["status"], page["third_party"]), (200, []), name)
+        [(url, asset)] = report["assets"].items()
+        self.assertRegex(url, r"^/static/letters/css/base\.[0-9a-f]{12}\.css$")
+        self.assertTrue(asset["immutable"])
+        self.assertEqual(report["pages"]["dashboard"]["repeat_requests"], 1)
+
+    def test_stylesheet_fonts_are_self_hosted_and_immutable(self):
+        with tempfile.TemporaryDirectory() as root, override_settings(STATIC_ROOT=root):
+            call_command("collectstatic", interactive=False, verbosity=0)
+            client = Client()
+            stylesheet = static("letters/css/base.css")
+            css = b"".join(client.get(stylesheet).streaming_content).decode()
+            fonts = re.findall(r"""url\(["']?([^"')]+\.woff2)""", css)
+            self.assertEqual(len(fonts), 4)
+            for font in fonts:
+                self.assertRegex(font, r"^\.\./fonts/Inter-\w+\.[0-9a-f]{12}\.woff2$")
+                response = client.get(urljoin(stylesheet, font))
+                self.assertEqual(response.status_code, 200, font)
+                self.assertIn("immutable", response["Cache-Control"])
+
+    def test_missing_manifest_fails_unless_relaxed(self):
+        with tempfile.TemporaryDirectory() as root:
+            with override_settings(WHITENOISE_MANIFEST_STRICT=True):
+                with self.assertRaisesMessage(ValueError, "letters/css/base.css"):
+                    StaticFilesStorage(location=root).url("letters/css/base.css")
+            with override_settings(WHITENOISE_MANIFEST_STRICT=False):
+                self.assertEqual(StaticFilesStorage(location=root).url("letters/css/base.css"), "/static/letters/css/base.css")
+
+
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        caching.get_cache().clear()
+        self.alice = User.objects.create_user("alice", password="pw")
+        self.bob = User.objects.create_user("bob", password="pw")
+        services.accept_connection(services.request_connection(self.alice, self.bob)[0])
+        self.letters = [services.send_letter(self.bob, self.alice, f"letter {n}") for n in range(5)]
+
+    async def queries(self, name, *args):
+        # Counted by the metrics middleware, whose per-request stats follow
+        # the view into sync_to_async threads.
+        metrics.registry.clear()
+        response = await self.async_client.get(reverse(name, args=args))
+        self.assertEqual(response.status_code, 200)
+        return metrics.registry.snapshot()[name]["queries"]
+
+    async def test_pages_query_counts(self):
+        await self.async_client.aforce_login(self.alice)
+        # Warm, the page cache serves the rows. That leaves the session and
+        # the user, plus on the conversation the other user, the connection
+        # check and clearing its unread count.
+        for name, args, counts in (("dashboard", (), (5, 2)), ("conversation", (self.bob.id,), (9, 5))):
+            self.assertEqual((await self.queries(name, *args), await self.queries(name, *args)), counts, name)
+
+    @override_settings(CACHES={
+        **settings.CACHES,
+        "pages": {"BACKEND": "django.core.cache.backends.db.DatabaseCache", "LOCATION": "letters_test_pages"},
+    })
+    def test_conversation_renders_with_the_db_cache(self):
+        # The card fragments are cached from the template, which then talks
+        # to the database.
+        call_command("createcachetable", verbosity=0)
+        path = reverse("conversation", args=[self.bob.id])
+        self.client.force_login(self.alice)
+        for _ in range(2):
+            response = self.client.get(path)
+            self.assertEqual(response.status_code, 200)
+            self.assertContains(response, "letter 4")
+        async_to_sync(self.async_client.aforce_login)(self.alice)
+        self.assertEqual(async_to_sync(self.async_client.get)(path).status_code, 200)
+
+    async def test_acached_hit_and_miss(self):
+        builds = []
+
+        async def build():
+            builds.append(1)
+            return ["rows"]
+
+        before = await sync_to_async(caching.stats)()
+        for _ in range(2):
+            self.assertEqual(await caching.acached("dashboard", [self.alice.id], [caching.user_scope(self.alice.id)], build), ["rows"])
+        self.assertEqual(len(builds), 1)
+        after = await sync_to_async(caching.stats)()
+        self.assertEqual(
+            (after["dashboard"]["hits"] - before["dashboard"]["hits"], after["dashboard"]["misses"] - before["dashboard"]["misses"]),
+            (1, 1),
+        )
+
+        await sync_to_async(caching.invalidate)(caching.user_scope(self.alice.id))
+        await caching.acached("dashboard", [self.alice.id], [caching.user_scope(self.alice.id)], build)
+        self.assertEqual(len(builds), 2)
+
+    async def test_akeyset_page_walks_every_row_once(self):
+        seen, cursor = [], None
+        while True:
+            page, cursor = await pagination.akeyset_page(Letter.objects.all(), cursor, page_size=2)
+            seen.extend(letter.id for letter in page)
+            if cursor is None:
+                break
+        self.assertEqual(seen, [letter.id for letter in reversed(self.letters)])
+
+    async def test_static_files_are_served_by_the_async_chain(self):
+        with tempfile.TemporaryDirectory() as root:
+            os.makedirs(os.path.join(root, "letters"))
+            with open(os.path.join(root, "letters", "probe.css"), "w") as fh:
+                fh.write("body{}")
+            with override_settings(STATIC_ROOT=root):
+                client = AsyncClient()
+                response = await client.get("/static/letters/probe.css")
+                body = b"".join(response.streaming_content)
+                missing = await client.get("/static/letters/missing.css")
+        self.assertEqual((response.status_code, body), (200, b"body{}"))
+        self.assertEqual(missing.status_code, 404)
+        handler = client.handler
+        self.assertTrue(asyncio.iscoroutinefunction(handler._middleware_chain))
+
+
+class PageCacheTests(TestCase):
+    def setUp(self):
+        caching.get_cache().clear()
+        self.alice = User.objects.create_user("alice", password="pw")
+        self.bob = User.objects.create_user("bob", password="pw")
+        services.accept_connection(services.request_connection(self.alice, self.bob)[0])
+        self.letter = services.send_letter(self.bob, self.alice, "first")
+        self.client.force_login(self.alice)
+
+    def get(self, name, *args):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse(name, args=args))
+        return response, len(ctx)
+
+    def test_dashboard_is_served_from_cache_until_a_write(self):
+        _, cold = self.get("dashboard")
+        response, warm = self.get("dashboard")
+        # Only the session and the user once the rows come from the page cache.
+        self.assertEqual((cold, warm), (5, 2))
+        self.assertContains(response, "1 unread")
+
+        services.mark_conversation_read(self.alice, self.bob)
+        response, _ = self.get("dashboard")
+        self.assertNotContains(response, "unread")
+
+        services.propose_modification(services.send_letter(self.alice, self.bob, "hi"), "hi!")
+        response, _ = self.get("dashboard")
+        self.assertContains(response, "1 awaiting your approval")
+
+    def test_conversation_follows_approvals(self):
+        self.get("conversation", self.bob.id)
+        _, warm = self.get("conversation", self.bob.id)
+        version = services.propose_modification(self.letter, "second")
+        response, cold = self.get("conversation", self.bob.id)
+        self.assertGreater(cold, warm)
+        self.assertContains(response, "Pending Modification")
+
+        services.approve_version(version)
+        response, _ = self.get("conversation", self.bob.id)
+        self.assertContains(response, "second")
+        self.assertNotContains(response, "Pending Modification")
+
+        stats = caching.stats()["conversation"]
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 3))
+
+
+@override_settings(LETTERS_THROTTLE_RATES={"login-ip": (3, 1), "login-user": (2, 1)})
+class LoginTests(TestCase):
+    def setUp(self):
+        caches["auth"].clear()
+        self.alice = User.objects.create_user("alice", password="right")
+
+    def attempt(self, username, password="wrong", ip="10.0.0.1"):
+        return self.client.post(reverse("login"), {"username": username, "password": password}, REMOTE_ADDR=ip)
+
+    def test_attempts_per_username_are_throttled_before_hashing(self):
+        # The clock is held still: the bucket would otherwise refill a
+        # little while the two wrong passwords are hashed.
+        with mock.patch.object(throttle, "time") as clock:
+            clock.time.return_value = 1000.0
+            self.assertEqual(self.attempt("alice", ip="10.0.0.1").status_code, 200)
+            self.assertEqual(self.attempt("Alice", ip="10.0.0.2").status_code, 200)
+            with self.assertNumQueries(0):
+                response = self.attempt("alice", "right", ip="10.0.0.3")
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(response["Retry-After"], "60")
+            self.assertEqual(self.attempt("bob", ip="10.0.0.3").status_code, 200)
+
+    def test_attempts_per_address_are_throttled(self):
+        for name in ("a", "b", "c"):
+            self.assertEqual(self.attempt(name).status_code, 200)
+        self.assertEqual(self.attempt("alice", "right").status_code, 429)
+        self.assertRedirects(
+            self.attempt("alice", "right", ip="10.0.0.9"), reverse("dashboard"), fetch_redirect_response=False
+        )
+
+    def test_buckets_refill(self):
+        now = 1000.0
+        for _ in range(2):
+            self.assertEqual(throttle.take("login-user", "x", now), 0)
+        self.assertEqual(throttle.take("login-user", "x", now), 60)
+        self.assertEqual(throttle.take("login-user", "x", now + 60), 0)
+
+    @override_settings(LETTERS_PROXY_COUNT=1)
+    def test_client_address_behind_a_proxy(self):
+        request = RequestFactory().get("/", REMOTE_ADDR="10.1.1.1", HTTP_X_FORWARDED_FOR="1.2.3.4, 5.6.7.8")
+        self.assertEqual(throttle.client_ip(request), "5.6.7.8")
+
+    @override_settings(
+        SESSION_ENGINE="django.contrib.sessions.backends.cached_db",
+        AUTHENTICATION_BACKENDS=["letters.auth.CachedModelBackend"],
+    )
+    def test_users_are_cached_until_saved(self):
+        self.client.force_login(self.alice)
+        self.client.get(reverse("dashboard"))
+        with self.assertNumQueries(0):
+            self.client.get(reverse("dashboard"))
+
+        self.alice.is_active = False
+        self.alice.save()
+        response = self.client.get(reverse("dashboard"))
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response.url.startswith(settings.LOGIN_URL))
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        metrics.registry.clear()
+        caching.get_cache().clear()
+        self.alice = User.objects.create_user("alice", password="pw")
+        self.client.force_login(self.alice)
+
+    def test_views_are_measured(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(reverse("dashboard"))
+        entry = metrics.registry.snapshot()["dashboard"]
+        self.assertEqual(entry["count"], 1)
+        self.assertEqual(entry["statuses"], {"2xx": 1})
+        self.assertEqual(entry["queries"], len(ctx))
+        self.assertGreater(entry["template_seconds"], 0)
+        self.assertEqual(entry["response_bytes"], len(response.content))
+        self.assertNotIn("Server-Timing", response)
+
+    @override_settings(LETTERS_SERVER_TIMING=True, LETTERS_QUERY_BUDGET=1)
+    def test_server_timing_and_query_budget(self):
+        with self.assertLogs("letters.middleware", "WARNING") as logs:
+            response = self.client.get(reverse("dashboard"))
+        self.assertRegex(response["Server-Timing"], r'^db;dur=[\d.]+;desc="\d+ queries", tpl;dur=[\d.]+, total;dur=')
+        self.assertIn("/dashboard/ ran", logs.output[0])
+        self.assertEqual(metrics.registry.snapshot()["dashboard"]["over_budget"], 1)
+
+    @override_settings(LETTERS_METRICS_TOKEN="s3cret")
+    def test_endpoint_needs_staff_or_token(self):
+        self.client.get(reverse("dashboard"))
+        self.assertEqual(self.client.get(reverse("metrics")).status_code, 403)
+
+        self.client.logout()
+        response = self.client.get(reverse("metrics"), headers={"Authorization": "Bearer s3cret"})
+        self.assertEqual(response.status_code, 200)
+        text = response.content.decode()
+        self.assertIn('letters_http_requests_total{view="dashboard",status="2xx"} 1', text)
+        self.assertIn('letters_http_request_duration_seconds_count{view="dashboard"} 1', text)
+        self.assertIn('letters_page_cache_misses_total{page="dashboard"} 1', text)
+        self.assertRegex(text, r'letters_table_rows\{table="letters_archivedletter"\} \d+')
+
+
+class ChangeFeedTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create(username="alice")
+        self.bob = User.objects.create(username="bob")
+        self.carol = User.objects.create(username="carol")
+        conn, _ = services.request_connection(self.alice, self.bob)
+        services.accept_connection(conn)
+        self.letter = services.send_letter(self.alice, self.bob, "first draft")
+        services.send_letter(self.carol, self.alice, "not for bob")
+        # Age everything past the settle window.
+        ChangeLogEntry.objects.update(created_at=timezone.now() - timedelta(minutes=1))
+        self.client.force_login(self.bob)
+
+    def feed(self, **params):
+        response = self.client.get("/api/changes/", params)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def test_feed_resumes_from_cursor(self):
+        data = self.feed(limit=2)
+        self.assertEqual([c["kind"] for c in data["changes"]], ["connection", "connection"])
+        self.assertTrue(data["has_more"])
+
+        data = self.feed(cursor=data["cursor"])
+        self.assertEqual([c["kind"] for c in data["changes"]], ["letter", "version"])
+        self.assertEqual(data["letters"][0]["current_version"]["content"], "first draft")
+        self.assertFalse(data["has_more"])
+
+        version = services.propose_modification(self.letter, "second draft")
+        services.approve_version(version)
+        data = self.feed(cursor=data["cursor"])
+        self.assertEqual(
+            [(c["kind"], c["action"]) for c in data["changes"]],
+            [("version", "created"), ("version", "approved")],
+        )
+        self.assertEqual(data["versions"][0]["content"], "second draft")
+
+    def test_cursor_waits_for_recent_changes_to_settle(self):
+        settled = self.feed()["cursor"]
+        services.send_letter(self.alice, self.bob, "just now")
+        data = self.feed(cursor=settled)
+        self.assertEqual(len(data["changes"]), 2)
+        self.assertEqual(data["cursor"], settled)
+
+    def test_invalid_cursor(self):
+        response = self.client.get("/api/changes/", {"cursor": "nope"})
+        self.assertEqual(response.status_code, 400)
+
+
+class PushTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create(username="alice")
+        self.bob = User.objects.create(username="bob")
+
+    async def test_committed_changes_reach_open_streams(self):
+        await self.async_client.aforce_login(self.bob)
+        response = await self.async_client.get("/events/")
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        stream = aiter(response.streaming_content)
+        self.assertEqual(await anext(stream), b"retry: 5000\n\n")
+
+        def send():
+            with self.captureOnCommitCallbacks(execute=True):
+                return services.send_letter(self.alice, self.bob, "hello")
+
+        letter = await sync_to_async(send)()
+        events = [json.loads((await anext(stream))[len(b"data: "):]) for _ in range(2)]
+        self.assertEqual(
+            [(e["kind"], e["action"], e["letter"], e["actor"]) for e in events],
+            [("letter", "created", letter.id, self.alice.id),
+             ("version", "created", letter.id, self.alice.id)],
+        )
+
+        # A client disconnect cancels the task serving the stream.
+        pending = asyncio.ensure_future(anext(stream))
+        await asyncio.sleep(0)
+        pending.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await pending
+        self.assertEqual(get_broker().connection_count(), 0)
+
+
+class QueryPlanTests(TestCase):
+    """
+    Render each hot view against a seeded dataset and EXPLAIN every query
+    it issues against the letters tables and ``auth_user``. A full table or
+    index scan, or a temporary B-tree sort, in any plan means an index was
+    dropped or a query stopped using it: either makes the view's cost grow
+    with the table, or with a user's whole history, instead of the page.
+
+    The dataset is large enough that the planner prefers an index over a
+    sequential read wherever one applies, on PostgreSQL as well.
+    """
+
+    USERS = 2000
+    # Users 0..ACTIVE-1 are connected to their next neighbours and write.
+    ACTIVE = 200
+    LETTERS_PER_PAIR = 50
+    VERSIONS_PER_LETTER = 3
+
+    @classmethod
+    def setUpTestData(cls):
+        users = User.objects.bulk_create(
+            User(username=f"user{i}", password="!") for i in range(cls.USERS)
+        )
+        cls.me, cls.other = users[0], users[1]
+
+        connections = Connection.objects.bulk_create(
+            Connection(requester=users[i], receiver=users[j], accepted=(i + j) % 3 != 0)
+            for i in range(cls.ACTIVE) for j in range(i + 1, min(i + 6, cls.ACTIVE))
+        )
+        ContactSummary.objects.bulk_create(
+            ContactSummary(owner_id=owner, contact_id=contact, connection=c, accepted=c.accepted)
+            for c in connections
+            for owner, contact in ((c.receiver_id, c.requester_id), (c.requester_id, c.receiver_id))
+        )
+        start = timezone.now() - timedelta(days=30)
+        letters = Letter.objects.bulk_create(
+            Letter(
+                sender=users[i + k % 2], receiver=users[i + 1 - k % 2],
+                created_at=start + timedelta(minutes=i * cls.LETTERS_PER_PAIR + k),
+            )
+            for i in range(cls.ACTIVE - 1) for k in range(cls.LETTERS_PER_PAIR)
+        )
+        versions = LetterVersion.objects.bulk_create(
+            LetterVersion(
+                letter=letter, content=f"letter {letter.id} version {n}", approved=n != 2,
+                approver_id=letter.sender_id if n == 2 else None,
+                created_at=letter.created_at + timedelta(seconds=n),
+            )
+            for letter in letters for n in range(cls.VERSIONS_PER_LETTER)
+        )
+        for letter, current in zip(letters, versions[1::cls.VERSIONS_PER_LETTER]):
+            letter.current_version = current
+        Letter.objects.bulk_update(letters, ["current_version"], batch_size=1000)
+        get_letter_search_backend().rebuild()
+
+        cls.letter = Letter.objects.filter(sender=cls.me, receiver=cls.other).first()
+        cls.pending = cls.letter.versions.filter(approved=False).first()
+        cls.incoming = Connection.objects.filter(accepted=False).select_related("receiver").first()
+
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+    def setUp(self):
+        caching.get_cache().clear()
+
+    def plan(self, sql):
+        with connection.cursor() as cursor:
+            if connection.vendor == "postgresql":
+                cursor.execute("EXPLAIN " + sql)
+            else:
+                cursor.execute("EXPLAIN QUERY PLAN " + sql)
+            return [row[-1] for row in cursor.fetchall()]
+
+    def bad_steps(self, plan):
+        if connection.vendor == "postgresql":
+            return [line for line in plan if re.search(r"Seq Scan on (letters_|auth_user)|^\s*(->\s*)?Sort\b", line)]
+        # SQLite reports "SCAN <table>" for a walk of the whole table, or of
+        # a whole index with "USING [COVERING] INDEX", and "SEARCH <table>
+        # USING INDEX ..." for a range of one. FTS tables are scanned
+        # through their own index.
+        return [
+            line for line in plan
+            if re.match(r"SCAN (letters_\w+|auth_user|U\d+)\b(?! VIRTUAL TABLE)", line.strip())
+            or "USE TEMP B-TREE" in line
+        ]
+
+    def assertIndexedPlans(self, user, url, method="get", **data):
+        self.client.force_login(user)
+        with CaptureQueriesContext(connection) as ctx:
+            response = getattr(self.client, method)(url, data)
+        self.assertLess(response.status_code, 400)
+
+        for query in ctx.captured_queries:
+            sql = query["sql"]
+            if not sql.startswith("SELECT") or not re.search(r"letters_|auth_user", sql):
+                continue
+            plan = self.plan(sql)
+            self.assertEqual(self.bad_steps(plan), [], f"{url}\n{sql}\n" + "\n".join(plan))
+
+    def test_dashboard(self):
+        self.assertIndexedPlans(self.me, reverse("dashboard"))
+
+    def test_conversation(self):
+        self.assertIndexedPlans(self.me, reverse("conversation", args=[self.other.id]))
+
+    def test_letter_history(self):
+        self.assertIndexedPlans(self.me, reverse("letter_history", args=[self.letter.id]))
+
+    def test_modify_letter(self):
+        self.assertIndexedPlans(self.other, reverse("modify", args=[self.letter.id]))
+
+    def test_approve_modification(self):
+        self.assertIndexedPlans(self.me, reverse("approve_modification", args=[self.pending.id]))
+
+    def test_accept_request(self):
+        self.assertIndexedPlans(self.incoming.receiver, reverse("accept", args=[self.incoming.id]))
+
+    def test_search_user(self):
+        self.assertIndexedPlans(self.me, reverse("search_user"), username="user1")
+        self.assertIndexedPlans(self.me, reverse("search_user"), username="ser19")
+        self.assertIndexedPlans(self.me, reverse("search_user"), username="u")
+
+    def test_search_letters(self):
+        self.assertIndexedPlans(self.me, reverse("search_letters"), q="version")
+
+    def test_send_letter(self):
+        self.assertIndexedPlans(self.me, reverse("send_letter", args=[self.other.id]))
+        self.assertIndexedPlans(self.me, reverse("send_letter", args=[self.other.id]), "post", content="hello")
+
+    def test_approvals(self):
+        self.assertIndexedPlans(self.me, reverse("approvals"))
+
+    def test_api_letters(self):
+        self.assertIndexedPlans(self.me, "/api/letters/")
+        self.assertIndexedPlans(self.me, "/api/letters/", **{"with": self.other.id})
+        self.assertIndexedPlans(self.me, f"/api/letters/{self.letter.id}/versions/")
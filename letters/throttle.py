@@ -0,0 +1,73 @@
+"""
+Token-bucket throttling for the password-checking views.
+
+A bucket holds up to ``burst`` tokens and refills at ``per_minute``; every
+attempt takes one, and an empty bucket turns the attempt away before any
+password is hashed. Buckets are kept in the ``auth`` cache alias, per
+client IP and per username, so a burst from one address and a spread-out
+guess at one account are both cut short. Rates come from
+``LETTERS_THROTTLE_RATES``; a scope set to ``None`` is not throttled.
+When the ``auth`` cache is private to each worker, settings divide the
+rates between the workers.
+
+Reads and writes of a bucket are not atomic: concurrent attempts can each
+take the last token, so a limit may be overshot by the number of
+requests in flight, never by more.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+CACHE_ALIAS = "auth"
+
+# (burst, tokens per minute) by scope.
+DEFAULT_RATES = {
+    "login-ip": (20, 10),
+    "login-user": (5, 2),
+    "signup-ip": (5, 1),
+}
+
+
+def rates():
+    return {**DEFAULT_RATES, **getattr(settings, "LETTERS_THROTTLE_RATES", {})}
+
+
+def client_ip(request):
+    """
+    The client's address: ``REMOTE_ADDR``, or with ``LETTERS_PROXY_COUNT``
+    trusted proxies in front, the address the outermost one saw.
+    """
+    proxies = getattr(settings, "LETTERS_PROXY_COUNT", 0)
+    forwarded = [ip.strip() for ip in request.META.get("HTTP_X_FORWARDED_FOR", "").split(",") if ip.strip()]
+    if proxies and len(forwarded) >= proxies:
+        return forwarded[-proxies]
+    return request.META.get("REMOTE_ADDR", "")
+
+
+def take(scope, key, now=None):
+    """Take a token from ``scope``'s bucket for ``key``; return 0 if allowed, else seconds to wait."""
+    rate = rates().get(scope)
+    if rate is None:
+        return 0
+    burst, per_minute = rate
+    now = time.time() if now is None else now
+    cache = caches[CACHE_ALIAS]
+    cache_key = f"throttle:{scope}:{key}"
+    tokens, updated = cache.get(cache_key, (burst, now))
+    tokens = min(burst, tokens + (now - updated) * per_minute / 60)
+    if tokens < 1:
+        return (1 - tokens) * 60 / per_minute
+    # Kept until the bucket would be full again; a missing bucket is full.
+    cache.set(cache_key, (tokens - 1, now), int((burst - tokens + 1) * 60 / per_minute) + 1)
+    return 0
+
+
+def check(request, *buckets):
+    """
+    Take a token from each ``(scope, key)`` bucket; return the longest wait
+    in seconds if any is empty. Every bucket is charged, so probing
+    usernames from many addresses still drains each account's bucket.
+    """
+    waits = [take(scope, key) for scope, key in buckets]
+    return max(waits, default=0)
@@ -1,15 +1,32 @@
-from django.urls import path
-from . import views_ui
+from django.urls import include, path
+from rest_framework.routers import DefaultRouter
+from . import views, views_ui
+
+router = DefaultRouter()
+router.register("letters", views.LetterViewSet, basename="api-letter")
+router.register("versions", views.LetterVersionViewSet, basename="api-version")
+router.register("connections", views.ConnectionViewSet, basename="api-connection")
 
 urlpatterns = [
     path("dashboard/", views_ui.dashboard, name="dashboard"),
     path("search/", views_ui.search_user, name="search_user"),
+    path("search/letters/", views_ui.search_letters, name="search_letters"),
     path("connect/<int:user_id>/", views_ui.connect_user, name="connect"),
     path("accept/<int:conn_id>/", views_ui.accept_request, name="accept"),
     path("conversation/<int:user_id>/", views_ui.conversation, name="conversation"),
+    path("letter/<int:letter_id>/history/", views_ui.letter_history, name="letter_history"),
     path("send/<int:user_id>/", views_ui.send_letter, name="send_letter"),
+    path("send/bulk/", views_ui.send_bulk, name="send_bulk"),
     path("modify/<int:letter_id>/", views_ui.modify_letter, name="modify"),
     path("approve/<int:version_id>/", views_ui.approve_modification, name="approve_modification"),
+    path("export/", views_ui.export_letters, name="export"),
+    path("approvals/", views_ui.approvals, name="approvals"),
     path("signup/", views_ui.signup, name="signup"),
+    path("events/", views_ui.events, name="events"),
+    path("metrics", views_ui.metrics_view, name="metrics"),
+    path("api/cache-stats/", views.CacheStatsView.as_view(), name="api-cache-stats"),
+    path("api/changes/", views.ChangeFeedView.as_view(), name="api-changes"),
+    path("api/stats/", views.StatsView.as_view(), name="api-stats"),
+    path("api/", include(router.urls)),
 
 ]
@@ -1,79 +1,398 @@
-from rest_framework import viewsets, status
+import operator
+from datetime import timedelta
+from functools import reduce
+
+from django.contrib.auth.models import User
+from django.core.exceptions import BadRequest
+from django.db.models import Exists, OuterRef, Q
+from django.http import Http404
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from rest_framework import mixins, status, viewsets
 from rest_framework.decorators import action
+from rest_framework.exceptions import ParseError
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
-from .models import Letter, ModificationRequest
-from .serializers import LetterSerializer, ModificationRequestSerializer
-from .permissions import IsSenderOrReceiver
+from rest_framework.views import APIView
 
+from . import caching, graph, services, stats
+from .models import ArchivedLetter, ChangeLogEntry, Connection, ContactSummary, Letter, LetterVersion
+from .pagination import KeysetPagination, decode_id_cursor, encode_id_cursor
+from .permissions import IsConnectionParticipant, IsSenderOrReceiver
+from .serializers import (
+    ArchivedVersionSerializer,
+    BulkLetterCreateSerializer,
+    ConnectionSerializer,
+    LetterCreateSerializer,
+    LetterSerializer,
+    LetterVersionSerializer,
+    VersionIdsSerializer,
+)
 
-class LetterViewSet(viewsets.ModelViewSet): # cite: uploaded:views.py
-    serializer_class = LetterSerializer # cite: uploaded:views.py
-    permission_classes = [IsSenderOrReceiver] # cite: uploaded:views.py
 
-    def get_queryset(self): # cite: uploaded:views.py
-        user = self.request.user
-        if not user.is_authenticated:
-            return Letter.objects.none()
-        return Letter.objects.filter(sender=user) | Letter.objects.filter(receiver=user) # cite: uploaded:views.py
+def pending_annotation():
+    return Exists(LetterVersion.objects.filter(letter=OuterRef("pk"), approved=False))
+
+
+def requested_fields(request):
+    fields = request.query_params.get("fields")
+    return set(fields.split(",")) if fields else None
 
-    def perform_create(self, serializer): # cite: uploaded:views.py
-        serializer.save(sender=self.request.user) # cite: uploaded:views.py
 
+class LetterViewSet(mixins.ListModelMixin, mixins.RetrieveModelMixin, viewsets.GenericViewSet):
+    """
+    Letters the user sent or received, newest first. ``?with=<user_id>``
+    narrows the list to one conversation.
 
-class ModificationRequestViewSet(viewsets.ModelViewSet): # cite: uploaded:views.py
-    serializer_class = ModificationRequestSerializer # cite: uploaded:views.py
+    Letters moved out by ``manage.py archive_letters`` read back in place,
+    as on the conversation page, with ``archived`` set; they are read-only.
+    """
 
-    def get_queryset(self): # cite: uploaded:views.py
+    serializer_class = LetterSerializer
+    permission_classes = [IsAuthenticated, IsSenderOrReceiver]
+    pagination_class = KeysetPagination
+
+    def directions(self):
         user = self.request.user
-        if not user.is_authenticated:
-            return ModificationRequest.objects.none()
-        return ModificationRequest.objects.filter( # cite: uploaded:views.py
-            letter__sender=user
-        ) | ModificationRequest.objects.filter(
-            letter__receiver=user
+        other = self.request.query_params.get("with")
+        if other and other.isdigit():
+            return [Q(sender=user, receiver_id=other), Q(sender_id=other, receiver=user)]
+        return [Q(sender=user), Q(receiver=user)]
+
+    def visible(self):
+        return reduce(operator.or_, self.directions())
+
+    def get_queryset(self, visible=None):
+        letters = Letter.objects.filter(self.visible() if visible is None else visible)
+        fields = requested_fields(self.request)
+        related = [name for name in ("sender", "receiver", "current_version") if not fields or name in fields]
+        if related:
+            letters = letters.select_related(*related)
+        if not fields or "has_pending" in fields:
+            letters = letters.annotate(has_pending=pending_annotation())
+        return letters
+
+    def get_archived_queryset(self, visible=None):
+        archived = ArchivedLetter.objects.filter(self.visible() if visible is None else visible, whole=True)
+        fields = requested_fields(self.request)
+        related = [name for name in ("sender", "receiver") if not fields or name in fields]
+        if related:
+            archived = archived.select_related(*related)
+        if fields and "current_version" not in fields:
+            archived = archived.defer("versions")
+        return archived
+
+    def paginate_queryset(self, queryset):
+        # A page per direction, each read in order off its own index, merged:
+        # with the directions ORed together the database would sort the
+        # user's whole history to find the newest few letters.
+        directions = self.directions()
+        sources = [self.get_queryset(d) for d in directions] + [self.get_archived_queryset(d) for d in directions]
+        return self.fill_current(self.paginator.paginate_sources(sources, self.request, view=self))
+
+    def get_object(self):
+        try:
+            letter = super().get_object()
+        except Http404:
+            letter = get_object_or_404(self.get_archived_queryset(), pk=self.kwargs["pk"])
+            self.check_object_permissions(self.request, letter)
+        return self.fill_current([letter])[0]
+
+    def fill_current(self, letters):
+        fields = requested_fields(self.request)
+        if not fields or "current_version" in fields:
+            LetterVersion.objects.fill_content(
+                [letter.current_version for letter in letters if not letter.archived and letter.current_version]
+            )
+        return letters
+
+    def create(self, request):
+        serializer = LetterCreateSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        if not graph.are_connected(request.user.id, serializer.validated_data["receiver"].id):
+            return Response(
+                {"detail": "You can only write to users you are connected to."},
+                status=status.HTTP_403_FORBIDDEN
+            )
+        letter = services.send_letter(
+            request.user,
+            serializer.validated_data["receiver"],
+            serializer.validated_data["content"],
+        )
+        letter.has_pending = False
+        return Response(self.get_serializer(letter).data, status=status.HTTP_201_CREATED)
+
+    @action(detail=False, methods=["post"])
+    def bulk(self, request):
+        """Send one letter to many connected users; ``{username}`` is filled in per receiver."""
+        serializer = BulkLetterCreateSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        letters = services.send_letters(
+            request.user,
+            list(User.objects.filter(id__in=serializer.validated_data["receivers"])),
+            serializer.validated_data["content"],
         )
+        for letter in letters:
+            letter.has_pending = False
+        return Response(self.get_serializer(letters, many=True).data, status=status.HTTP_201_CREATED)
+
+    @action(detail=True, methods=["get", "post"])
+    def versions(self, request, pk=None):
+        mine = Q(sender=request.user) | Q(receiver=request.user)
+        # Either the whole letter or its superseded versions may be archived.
+        # The id is the key, so there is at most one row: first() would only add a sort.
+        archived = next(iter(ArchivedLetter.objects.filter(mine, id=pk)), None)
+        if archived and archived.whole:
+            letter, sources = archived, [archived.history]
+        else:
+            letter = get_object_or_404(Letter.objects.filter(mine), pk=pk)
+            sources = [letter.versions.all()] + ([archived.history] if archived else [])
+
+        if request.method == "POST":
+            if letter.archived:
+                return Response(
+                    {"detail": "Archived letters are read-only."},
+                    status=status.HTTP_403_FORBIDDEN
+                )
+            # Only the receiver can propose a modification, as in the UI.
+            if letter.receiver_id != request.user.id:
+                return Response(
+                    {"detail": "Only the letter receiver can propose a modification."},
+                    status=status.HTTP_403_FORBIDDEN
+                )
+            serializer = LetterVersionSerializer(data=request.data, context=self.get_serializer_context())
+            serializer.is_valid(raise_exception=True)
+            try:
+                version = services.propose_modification(
+                    letter, serializer.validated_data["content"], serializer.validated_data.get("base_version_id")
+                )
+            except services.VersionConflict:
+                return Response(
+                    {
+                        "detail": "The letter changed since base_version; propose against the current one.",
+                        "current_version": letter.current_version_id,
+                    },
+                    status=status.HTTP_409_CONFLICT
+                )
+            return Response(
+                LetterVersionSerializer(version, context=self.get_serializer_context()).data,
+                status=status.HTTP_201_CREATED
+            )
+
+        page = self.paginator.paginate_sources(sources, request, view=self)
+        LetterVersion.objects.fill_content([version for version in page if not version.archived])
+        context = {**self.get_serializer_context(), "letter_id": letter.id}
+        return self.get_paginated_response([
+            (ArchivedVersionSerializer if version.archived else LetterVersionSerializer)(version, context=context).data
+            for version in page
+        ])
 
-    def perform_create(self, serializer): # cite: uploaded:views.py
-        serializer.save(requested_by=self.request.user) # cite: uploaded:views.py
 
-    @action(detail=True, methods=['post']) # cite: uploaded:views.py
-    def approve(self, request, pk=None): # cite: uploaded:views.py
-        mod = self.get_object()
+class LetterVersionViewSet(mixins.RetrieveModelMixin, viewsets.GenericViewSet):
+    serializer_class = LetterVersionSerializer
+    permission_classes = [IsAuthenticated, IsSenderOrReceiver]
+
+    def get_queryset(self):
+        user = self.request.user
+        return LetterVersion.objects.filter(
+            Q(letter__sender=user) | Q(letter__receiver=user)
+        ).select_related("letter")
+
+    @action(detail=True, methods=["post"])
+    def approve(self, request, pk=None):
+        version = self.get_object()
 
         # Only the SENDER of the letter can approve the modification
-        if request.user != mod.letter.sender: # cite: uploaded:views.py
+        if request.user.id != version.letter.sender_id:
             return Response(
                 {"detail": "Only the letter sender can approve this modification."},
                 status=status.HTTP_403_FORBIDDEN
             )
 
-        # Use the model's approve method to handle versioning
-        if mod.status == 'PENDING': # cite: uploaded:views.py
-            mod.approve() 
-            return Response({'status': 'APPROVED'})
+        if version.approved:
+            return Response(
+                {"detail": "Version is already approved."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
 
-        return Response( # cite: uploaded:views.py
-            {"detail": f"Modification is already {mod.status}."},
-            status=status.HTTP_400_BAD_REQUEST
-        )
+        try:
+            services.approve_version(version)
+        except services.VersionConflict:
+            return Response(
+                {
+                    "detail": "The letter changed after this modification was proposed.",
+                    "current_version": Letter.objects.values_list("current_version_id", flat=True).get(
+                        pk=version.letter_id
+                    ),
+                },
+                status=status.HTTP_409_CONFLICT
+            )
+        return Response(self.get_serializer(version).data)
+
+    @action(detail=False, methods=["post"], url_path="bulk-approve")
+    def bulk_approve(self, request):
+        """Approve pending modifications of the user's letters; other ids are ignored."""
+        serializer = VersionIdsSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        try:
+            approved, stale = services.approve_versions(request.user, serializer.validated_data["ids"])
+        except services.VersionConflict:
+            return Response(
+                {"detail": "A letter changed while approving; try again."}, status=status.HTTP_409_CONFLICT
+            )
+        return Response({
+            "approved": [version.id for version in approved],
+            "conflicts": [version.id for version in stale],
+        })
 
-    @action(detail=True, methods=['post']) # cite: uploaded:views.py
-    def reject(self, request, pk=None): # cite: uploaded:views.py
-        mod = self.get_object()
+    @action(detail=False, methods=["post"], url_path="bulk-reject")
+    def bulk_reject(self, request):
+        """Discard pending modifications of the user's letters; other ids are ignored."""
+        serializer = VersionIdsSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return Response({"rejected": services.reject_versions(request.user, serializer.validated_data["ids"])})
+
+
+class ConnectionViewSet(mixins.ListModelMixin, mixins.CreateModelMixin, viewsets.GenericViewSet):
+    serializer_class = ConnectionSerializer
+    permission_classes = [IsAuthenticated, IsConnectionParticipant]
+    pagination_class = KeysetPagination
+
+    def get_queryset(self):
+        user = self.request.user
+        return Connection.objects.filter(
+            Q(requester=user) | Q(receiver=user)
+        ).select_related("requester", "receiver")
 
-        # Only the SENDER of the letter can reject the modification
-        if request.user != mod.letter.sender: # cite: uploaded:views.py
+    def perform_create(self, serializer):
+        conn, _ = services.request_connection(self.request.user, serializer.validated_data["receiver"])
+        serializer.instance = conn
+
+    @action(detail=True, methods=["post"])
+    def accept(self, request, pk=None):
+        conn = self.get_object()
+
+        if request.user.id != conn.receiver_id:
             return Response(
-                {"detail": "Only the letter sender can reject this modification."},
+                {"detail": "Only the receiver can accept this request."},
                 status=status.HTTP_403_FORBIDDEN
             )
 
-        if mod.status == 'PENDING': # cite: uploaded:views.py
-            mod.status = 'REJECTED' # cite: uploaded:views.py
-            mod.save()
-            return Response({'status': 'REJECTED'}) # cite: uploaded:views.py
+        services.accept_connection(conn)
+        return Response(self.get_serializer(conn).data)
+
+
+class ChangeFeedView(APIView):
+    """
+    Everything visible to the user that changed after ``?cursor=``, oldest
+    first, in batches of ``?limit=``, with the current state of each
+    letter, version and connection the batch touches. Start without a
+    cursor and keep passing back the returned one.
+
+    Letters since moved to the archive are returned from it, with
+    ``archived`` set. Archived versions have no id lookup, so a version
+    entry whose row has been archived is left out of ``versions``; its
+    letter's history, ``/api/letters/<id>/versions/``, still has it.
+    """
+
+    permission_classes = [IsAuthenticated]
+    default_limit = 200
+    max_limit = 1000
+    # Ids are handed out before commit, so a slow writer can commit an entry
+    # below one that is already visible. The cursor never moves past entries
+    # younger than this; they are sent again on the next call, so clients
+    # must apply changes idempotently.
+    settle = timedelta(seconds=5)
+
+    def get(self, request):
+        after = 0
+        if request.query_params.get("cursor"):
+            try:
+                after = decode_id_cursor(request.query_params["cursor"])
+            except BadRequest:
+                raise ParseError("Invalid cursor")
+        try:
+            limit = int(request.query_params.get("limit", self.default_limit))
+        except ValueError:
+            raise ParseError("Invalid limit")
+        limit = max(1, min(limit, self.max_limit))
+
+        entries = list(
+            ChangeLogEntry.objects.filter(user=request.user, id__gt=after).order_by("id")[:limit + 1]
+        )
+        has_more = len(entries) > limit
+        entries = entries[:limit]
+
+        position = after
+        settled = timezone.now() - self.settle
+        for entry in entries:
+            if entry.created_at > settled:
+                break
+            position = entry.id
+
+        ids = {kind: set() for kind, _ in ChangeLogEntry.KIND_CHOICES}
+        for entry in entries:
+            ids[entry.kind].add(entry.object_id)
+
+        letters = list(
+            Letter.objects.filter(id__in=ids[ChangeLogEntry.LETTER])
+            .select_related("sender", "receiver", "current_version")
+            .annotate(has_pending=pending_annotation())
+        )
+        versions = list(LetterVersion.objects.filter(id__in=ids[ChangeLogEntry.VERSION]))
+        LetterVersion.objects.fill_content(
+            versions + [letter.current_version for letter in letters if letter.current_version]
+        )
+        archived = ids[ChangeLogEntry.LETTER] - {letter.id for letter in letters}
+        if archived:
+            letters += ArchivedLetter.objects.filter(id__in=archived, whole=True).select_related("sender", "receiver")
+        connections = Connection.objects.filter(
+            id__in=ids[ChangeLogEntry.CONNECTION]
+        ).select_related("requester", "receiver")
+
+        context = {"request": request}
+        return Response({
+            "cursor": encode_id_cursor(position),
+            "has_more": has_more and position > after,
+            "changes": [
+                {
+                    "kind": entry.kind,
+                    "action": entry.action,
+                    "id": entry.object_id,
+                    "actor": entry.actor_id,
+                    "at": entry.created_at,
+                }
+                for entry in entries
+            ],
+            "letters": LetterSerializer(letters, many=True, context=context).data,
+            "versions": LetterVersionSerializer(versions, many=True, context=context).data,
+            "connections": ConnectionSerializer(connections, many=True, context=context).data,
+        })
+
+
+class StatsView(APIView):
+    """The user's counters and most active correspondents, as on the dashboard."""
+
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        counters = stats.for_user(request.user)
+        summaries = ContactSummary.objects.filter(
+            owner=request.user, accepted=True, letter_count__gt=0
+        ).select_related("contact")
+        return Response({
+            **{field: getattr(counters, field) for field in stats.FIELDS},
+            "top_correspondents": [
+                {"id": summary.contact_id, "username": summary.contact.username, "letters": summary.letter_count}
+                for summary in stats.top_correspondents(summaries)
+            ],
+        })
+
+
+class CacheStatsView(APIView):
+    """Page cache hits, misses and hit rate per page, for staff."""
+
+    permission_classes = [IsAdminUser]
 
-        return Response(
-            {"detail": f"Modification is already {mod.status}."},
-            status=status.HTTP_400_BAD_REQUEST
-        )
\ No newline at end of file
+    def get(self, request):
+        return Response(caching.stats())
@@ -1,18 +1,60 @@
-from django.shortcuts import render, redirect, get_object_or_404
+import hmac
+import json
+import math
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
+from django.shortcuts import aget_object_or_404, get_object_or_404, redirect, render
+from django.template.defaultfilters import pluralize
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
-from django.db.models import Q
+from django.db.models import Exists, F, OuterRef, Q
 from django.contrib import messages
-from .models import Connection, Letter, LetterVersion
+from . import caching, export, graph, metrics, services, stats, throttle
+from .models import ArchivedLetter, Connection, ContactSummary, Letter, LetterVersion
+from .pagination import amerged_keyset_page, keyset_page, merged_keyset_page
+from .realtime import get_broker
+from .search import (
+    MAX_RESULTS as MAX_SEARCH_RESULTS,
+    get_letter_search_backend,
+    get_user_search_backend,
+)
 from django.contrib.auth import login
 
+CONVERSATION_PAGE_SIZE = 20
+HISTORY_PAGE_SIZE = 20
+SEARCH_PAGE_SIZE = 20
+APPROVALS_PAGE_SIZE = 50
+# Seconds between keep-alive comments on an idle event stream, inside the
+# idle timeout of common proxies and load balancers.
+EVENTS_KEEPALIVE = 15
+
+def _throttled(request, template, retry_after):
+    seconds = math.ceil(retry_after)
+    response = render(request, template, {
+        "error": f"Too many attempts. Try again in {seconds} seconds.",
+    }, status=429)
+    response["Retry-After"] = str(seconds)
+    return response
+
+
 def login_view(request):
     if request.method == "POST":
+        username = request.POST.get("username", "")
+        # Checked before authenticate(), which hashes the password even for
+        # unknown usernames.
+        retry_after = throttle.check(
+            request, ("login-ip", throttle.client_ip(request)), ("login-user", username.lower())
+        )
+        if retry_after:
+            return _throttled(request, "letters/login.html", retry_after)
         user = authenticate(
             request,
-            username=request.POST["username"],
-            password=request.POST["password"]
+            username=username,
+            password=request.POST.get("password", "")
         )
         if user:
             login(request, user)
@@ -22,6 +64,10 @@ def login_view(request):
 
 def signup(request):
     if request.method == "POST":
+        retry_after = throttle.check(request, ("signup-ip", throttle.client_ip(request)))
+        if retry_after:
+            return _throttled(request, "letters/signup.html", retry_after)
+
         username = request.POST.get("username")
         password = request.POST.get("password")
         confirm = request.POST.get("confirm")
@@ -53,113 +99,368 @@ def logout_view(request):
     return redirect("login")
 
 
-@login_required
-def dashboard(request):
-    user = request.user
+async def _auser(request):
+    """
+    The logged-in user for an async view, also put on ``request.user`` so
+    templates and sync helpers read it without querying from the event loop.
+    """
+    user = request.user = await request.auser()
+    return user
 
-    pending_requests = Connection.objects.filter(
-        receiver=user, accepted=False
-    )
 
-    connections = Connection.objects.filter(
-        accepted=True
-    ).filter(
-        Q(requester=user) | Q(receiver=user)
+@login_required
+async def dashboard(request):
+    user = await _auser(request)
+
+    async def build():
+        summaries = ContactSummary.objects.filter(
+            owner=user
+        ).select_related("contact").order_by(
+            F("last_letter_at").desc(nulls_last=True), "id"
+        )
+        pending_requests = []
+        connections = []
+        async for summary in summaries:
+            (connections if summary.accepted else pending_requests).append(summary)
+        counters = await stats.afor_user(user)
+        activity = await stats.afeed(user)
+        return pending_requests, connections, counters, activity
+
+    # The rows are cached rather than the HTML so "last letter ... ago"
+    # stays current. Everything that changes them bumps the user's scope.
+    pending_requests, connections, counters, activity = await caching.acached(
+        "dashboard", (user.id,), [caching.user_scope(user.id)], build
     )
 
     return render(request, "letters/dashboard.html", {
         "pending_requests": pending_requests,
         "connections": connections,
+        "stats": counters,
+        "top_correspondents": stats.top_correspondents(connections),
+        "activity": activity,
     })
 
 
 @login_required
-def search_user(request):
+async def search_user(request):
+    user = await _auser(request)
+    query = (request.GET.get("username") or request.POST.get("username") or "").strip()
+    try:
+        page = max(int(request.GET.get("page", 1)), 1)
+    except ValueError:
+        page = 1
+
     users = []
-    if request.method == "POST":
-        users = User.objects.filter(
-            username__icontains=request.POST["username"]
-        ).exclude(id=request.user.id)
-    return render(request, "letters/search.html", {"users": users})
+    has_next = False
+    offset = (page - 1) * SEARCH_PAGE_SIZE
+    if query and offset < MAX_SEARCH_RESULTS:
+        limit = min(SEARCH_PAGE_SIZE, MAX_SEARCH_RESULTS - offset)
+        exclude_ids = await sync_to_async(graph.related)(user.id) | {user.id}
+        users = await sync_to_async(get_user_search_backend().search)(
+            query, exclude_ids=exclude_ids, limit=limit + 1, offset=offset
+        )
+        has_next = len(users) > limit and offset + limit < MAX_SEARCH_RESULTS
+        users = users[:limit]
+
+    return render(request, "letters/search.html", {
+        "users": users,
+        "query": query,
+        "page": page,
+        "has_next": has_next,
+    })
+
+
+@login_required
+def search_letters(request):
+    query = request.GET.get("q", "").strip()
+    try:
+        page = max(int(request.GET.get("page", 1)), 1)
+    except ValueError:
+        page = 1
+
+    versions = []
+    has_next = False
+    offset = (page - 1) * SEARCH_PAGE_SIZE
+    if query and offset < MAX_SEARCH_RESULTS:
+        limit = min(SEARCH_PAGE_SIZE, MAX_SEARCH_RESULTS - offset)
+        versions = get_letter_search_backend().search(
+            request.user, query, limit=limit + 1, offset=offset
+        )
+        has_next = len(versions) > limit and offset + limit < MAX_SEARCH_RESULTS
+        versions = LetterVersion.objects.fill_content(versions[:limit])
+
+    return render(request, "letters/search_letters.html", {
+        "versions": versions,
+        "query": query,
+        "page": page,
+        "has_next": has_next,
+    })
 
 
 @login_required
 def connect_user(request, user_id):
     other = get_object_or_404(User, id=user_id)
-    Connection.objects.get_or_create(
-        requester=request.user,
-        receiver=other
-    )
+    if other != request.user:
+        services.request_connection(request.user, other)
+    return redirect("dashboard")
+
+
+def _require_connection(request, other_user):
+    """Redirect to the dashboard unless the user is connected to ``other_user``."""
+    if graph.are_connected(request.user.id, other_user.id):
+        return None
+    messages.error(request, f"You are not connected to {other_user.username}")
     return redirect("dashboard")
 
 
 @login_required
 def accept_request(request, conn_id):
     conn = get_object_or_404(Connection, id=conn_id, receiver=request.user)
-    conn.accepted = True
-    conn.save()
+    services.accept_connection(conn)
     return redirect("dashboard")
 
 
 @login_required
-def conversation(request, user_id):
-    other_user = get_object_or_404(User, id=user_id)
+async def conversation(request, user_id):
+    user = await _auser(request)
+    other_user = await aget_object_or_404(User, id=user_id)
+    if denied := await sync_to_async(_require_connection)(request, other_user):
+        return denied
+
+    letters = Letter.objects.select_related("current_version").annotate(
+        has_pending=Exists(
+            LetterVersion.objects.filter(letter=OuterRef("pk"), approved=False)
+        ),
+    )
+    # Old letters moved out by ``manage.py archive_letters``, read back in place.
+    archived = ArchivedLetter.objects.filter(whole=True)
+    # One source per direction: each is a range scan of a pair index in
+    # page order, where an OR of the two would sort the pair's whole history.
+    sources = [
+        queryset.filter(sender=sender, receiver=receiver)
+        for sender, receiver in ((user, other_user), (other_user, user))
+        for queryset in (letters, archived)
+    ]
+
+    cursor = request.GET.get("before")
+
+    async def build():
+        page, older_cursor = await amerged_keyset_page(sources, cursor, CONVERSATION_PAGE_SIZE)
+        # Pages are fetched newest-first but read top to bottom oldest-first.
+        page.reverse()
+        await sync_to_async(LetterVersion.objects.fill_content)(
+            [letter.current_version for letter in page if not letter.archived and letter.current_version]
+        )
+        return page, older_cursor
 
-    letters = Letter.objects.filter(
-        Q(sender=request.user, receiver=other_user) |
-        Q(sender=other_user, receiver=request.user)
-    ).prefetch_related("versions")
+    page, older_cursor = await caching.acached(
+        "conversation",
+        (user.id, other_user.id, cursor or ""),
+        [caching.pair_scope(user.id, other_user.id)],
+        build,
+    )
+    if not cursor:
+        await sync_to_async(services.mark_conversation_read)(user, other_user)
 
-    return render(request, "letters/conversation.html", {
+    # Off the event loop: the template caches each card, and a database
+    # cache backend queries from inside the render.
+    return await sync_to_async(render)(request, "letters/conversation.html", {
         "other_user": other_user,
-        "letters": letters,
+        "letters": page,
+        "older_cursor": older_cursor,
+        "is_latest": not cursor,
+        "card_timeout": caching.TIMEOUT,
+    })
+
+
+@login_required
+def letter_history(request, letter_id):
+    mine = Q(sender=request.user) | Q(receiver=request.user)
+    # Either the whole letter or its superseded versions may be archived.
+    # The id is the key, so there is at most one row: first() would only add a sort.
+    archived = next(
+        iter(ArchivedLetter.objects.select_related("sender", "receiver").filter(mine, id=letter_id)), None
+    )
+    if archived and archived.whole:
+        letter, sources = archived, [archived.history]
+    else:
+        letter = get_object_or_404(Letter.objects.select_related("sender", "receiver").filter(mine), id=letter_id)
+        sources = [letter.versions.all()] + ([archived.history] if archived else [])
+    other_user = letter.receiver if letter.sender == request.user else letter.sender
+
+    versions, older_cursor = merged_keyset_page(sources, request.GET.get("before"), HISTORY_PAGE_SIZE)
+    LetterVersion.objects.fill_content([version for version in versions if not version.archived])
+
+    return render(request, "letters/letter_history.html", {
+        "letter": letter,
+        "other_user": other_user,
+        "versions": versions,
+        "older_cursor": older_cursor,
     })
 
 
 @login_required
 def send_letter(request, user_id):
     receiver = get_object_or_404(User, id=user_id)
+    if denied := _require_connection(request, receiver):
+        return denied
 
     if request.method == "POST":
-        letter = Letter.objects.create(
-            sender=request.user,
-            receiver=receiver
-        )
-
-        LetterVersion.objects.create(
-            letter=letter,
-            content=request.POST["content"],
-            approved=True
-        )
-
+        services.send_letter(request.user, receiver, request.POST["content"])
         return redirect("conversation", user_id=receiver.id)
 
     return render(request, "letters/send.html", {"receiver": receiver})
 
 
+@login_required
+def send_bulk(request):
+    if request.method == "POST":
+        ids = [int(i) for i in request.POST.getlist("receivers") if i.isdigit()]
+        letters = services.send_letters(
+            request.user, list(User.objects.filter(id__in=ids)), request.POST["content"]
+        )
+        messages.success(request, f"Sent {len(letters)} letters")
+        return redirect("dashboard")
+
+    contacts = ContactSummary.objects.filter(
+        owner=request.user, accepted=True
+    ).select_related("contact").order_by("contact__username")
+    return render(request, "letters/send_bulk.html", {"contacts": contacts})
+
+
 @login_required
 def modify_letter(request, letter_id):
-    letter = get_object_or_404(Letter, id=letter_id, receiver=request.user)
+    letter = get_object_or_404(
+        Letter.objects.select_related("current_version"), id=letter_id, receiver=request.user
+    )
 
     if request.method == "POST":
-        LetterVersion.objects.create(
-            letter=letter,
-            content=request.POST["proposed_content"],
-            approved=False
-        )
-        return redirect("conversation", user_id=letter.sender.id)
+        base = request.POST.get("base_version", "")
+        try:
+            services.propose_modification(
+                letter, request.POST["proposed_content"], int(base) if base.isdigit() else None
+            )
+        except services.VersionConflict:
+            # Keep the draft and show what changed; the form now carries the new base.
+            return render(request, "letters/modify.html", {
+                "letter": letter,
+                "draft": request.POST["proposed_content"],
+                "error": "The letter was changed while you were editing it.",
+            }, status=409)
+        return redirect("conversation", user_id=letter.sender_id)
 
     return render(request, "letters/modify.html", {"letter": letter})
 
 
 @login_required
 def approve_modification(request, version_id):
-    version = get_object_or_404(LetterVersion, id=version_id)
+    version = get_object_or_404(LetterVersion.objects.select_related("letter"), id=version_id)
 
-    if request.user != version.letter.sender:
+    if request.user.id != version.letter.sender_id:
         return redirect("dashboard")
 
-    version.approved = True
-    version.save()
+    try:
+        services.approve_version(version)
+    except services.VersionConflict:
+        messages.error(request, "The letter changed after this modification was proposed; review it again.")
+        return redirect("letter_history", letter_id=version.letter_id)
 
-    return redirect("conversation", user_id=version.letter.receiver.id)
+    return redirect("conversation", user_id=version.letter.receiver_id)
+
+
+@login_required
+def approvals(request):
+    if request.method == "POST":
+        ids = [int(i) for i in request.POST.getlist("versions") if i.isdigit()]
+        if request.POST.get("action") == "reject":
+            services.reject_versions(request.user, ids)
+        else:
+            try:
+                _, stale = services.approve_versions(request.user, ids)
+            except services.VersionConflict:
+                messages.error(request, "A letter changed while approving; nothing was approved.")
+            else:
+                if stale:
+                    messages.error(
+                        request, f"{len(stale)} modification{pluralize(len(stale))} left pending: "
+                        "the letter changed after they were proposed."
+                    )
+        return redirect("approvals")
+
+    versions, older_cursor = keyset_page(
+        LetterVersion.objects.filter(approver=request.user, approved=False).select_related(
+            "letter__receiver"
+        ),
+        request.GET.get("before"),
+        APPROVALS_PAGE_SIZE,
+    )
+    LetterVersion.objects.fill_content(versions)
+
+    return render(request, "letters/approvals.html", {
+        "versions": versions,
+        "older_cursor": older_cursor,
+    })
+
+
+@login_required
+def export_letters(request):
+    """Download all the user's letters, or one conversation with ``?with=``, as NDJSON, JSON or ZIP."""
+    fmt = request.GET.get("format", "ndjson")
+    if fmt not in export.FORMATS:
+        return HttpResponseBadRequest("Unknown format")
+    contact = None
+    if request.GET.get("with"):
+        if not request.GET["with"].isdigit():
+            return HttpResponseBadRequest("Invalid user")
+        contact = get_object_or_404(User, id=request.GET["with"])
+
+    chunks = export.export(
+        export.letters_of(request.user, contact), fmt, archived=export.archived_of(request.user, contact)
+    )
+    if isinstance(request, ASGIRequest):
+        chunks = export.aiter_chunks(chunks)
+    content_type, extension = export.FORMATS[fmt]
+    name = f"letters-{request.user.username}" + (f"-{contact.username}" if contact else "")
+    response = StreamingHttpResponse(chunks, content_type=content_type)
+    response["Content-Disposition"] = f'attachment; filename="{name}.{extension}"'
+    return response
+
+
+@login_required
+async def events(request):
+    """
+    Server-Sent Events stream of the user's changes (see ``letters.realtime``).
+    Needs an ASGI server: each open stream holds a subscription, not a worker.
+    """
+    user = await request.auser()
+
+    async def stream():
+        subscription = get_broker().subscribe(user.id)
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                event = await subscription.get(timeout=EVENTS_KEEPALIVE)
+                if event is None:
+                    yield ": keep-alive\n\n"
+                else:
+                    yield f"data: {json.dumps(event)}\n\n"
+        finally:
+            subscription.close()
+
+    response = StreamingHttpResponse(stream(), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    # Stop nginx from buffering the stream.
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+def metrics_view(request):
+    """
+    Request metrics in the Prometheus text format, for staff or for a
+    scraper sending ``Authorization: Bearer <LETTERS_METRICS_TOKEN>``.
+    """
+    token = getattr(settings, "LETTERS_METRICS_TOKEN", "")
+    sent = request.headers.get("Authorization", "").removeprefix("Bearer ")
+    if not request.user.is_staff and not (token and hmac.compare_digest(sent, token)):
+        return HttpResponse(status=403)
+    return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")